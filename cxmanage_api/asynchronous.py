@@ -0,0 +1,431 @@
+"""Calxeda: asynchronous.py"""
+
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+
+from time import time
+
+from pyipmi import IpmiError
+
+from cxmanage_api.tasks import DEFAULT_TASK_QUEUE, Task, PRIORITY_NORMAL
+from cxmanage_api.cx_exceptions import TimeoutError, TransferFailure
+
+
+def then(task, function):
+    """Chain a continuation onto a task.
+
+    When the task completes, function(result) is run. If it returns a Task,
+    the returned task finishes when that one does. If the first task fails,
+    function isn't called and the error is passed along.
+
+    >>> from cxmanage_api.asynchronous import then
+    >>> task = then(async_node.get_power(), lambda x: "on" if x else "off")
+
+    :param task: The task to wait for.
+    :type task: Task
+    :param function: The continuation.
+    :type function: function
+
+    :returns: A task for the result of the continuation.
+    :rtype: Task
+
+    """
+    promise = Task(None)
+
+    def callback(finished):
+        """ Run the continuation once the first task is done """
+        if finished.error is not None:
+            promise.set_error(finished.error)
+            return
+        try:
+            result = function(finished.result)
+        # pylint: disable=W0703
+        except Exception as err:
+            promise.set_error(err)
+            return
+        if isinstance(result, Task):
+            follow(result, promise)
+        else:
+            promise.set_result(result)
+
+    task.add_done_callback(callback)
+    return promise
+
+
+def follow(task, promise):
+    """Finish promise the same way as task, once task is done.
+
+    :param task: The task to follow.
+    :type task: Task
+    :param promise: The task to finish.
+    :type promise: Task
+
+    """
+    def callback(finished):
+        """ Copy the outcome over """
+        if finished.error is not None:
+            promise.set_error(finished.error)
+        else:
+            promise.set_result(finished.result)
+    task.add_done_callback(callback)
+
+
+def poll(check, interval=1, timeout=None, error=None, delay=None,
+         task_queue=None, attempt_timeout=None, **put_kwargs):
+    """Call check() on the task queue every interval seconds, until it
+    returns something other than None.
+
+    Between attempts the check is held on the task queue's timer, so a poll
+    doesn't tie up a worker thread while it waits.
+
+    >>> from cxmanage_api.asynchronous import poll
+    >>> task = poll(lambda: True if node.get_power() else None,
+    ...             interval=5, timeout=300)
+
+    :param check: The function to call. Errors it raises fail the poll.
+    :type check: function
+    :param interval: Seconds between attempts.
+    :type interval: float
+    :param timeout: Give up after this many seconds.
+    :type timeout: float
+    :param error: The error to fail with on timeout. Defaults to a
+                  TimeoutError.
+    :type error: Exception
+    :param delay: Seconds to wait before the first attempt. Defaults to
+                  interval.
+    :type delay: float
+    :param task_queue: Task queue to run the checks on.
+    :type task_queue: TaskQueue
+    :param attempt_timeout: Seconds each attempt has to finish once it
+                            comes off the timer. A timed out attempt fails
+                            the poll.
+    :type attempt_timeout: float
+    :param put_kwargs: Extra arguments (priority, lane, rate_keys) for
+                       TaskQueue.put_task().
+
+    :returns: A task for the first result that isn't None.
+    :rtype: Task
+
+    """
+    if task_queue is None:
+        task_queue = DEFAULT_TASK_QUEUE
+    if error is None:
+        error = TimeoutError("Polling timed out after %s seconds" % timeout)
+    if delay is None:
+        delay = interval
+    deadline = None if timeout is None else time() + timeout
+    promise = Task(None)
+
+    def attempt():
+        """ Make one attempt, then schedule the next """
+        if promise.done():
+            return  # Cancelled, or failed by the caller
+        try:
+            result = check()
+        # pylint: disable=W0703
+        except Exception as err:
+            promise.set_error(err)
+            return
+
+        if result is not None:
+            promise.set_result(result)
+        elif deadline is not None and time() >= deadline:
+            promise.set_error(error)
+        else:
+            schedule(interval)
+
+    def expired(task):
+        """ Fail the poll if an attempt timed out or was cancelled """
+        if task.error is not None:
+            promise.set_error(task.error)
+
+    def schedule(seconds):
+        """ Put the next attempt on the task queue's timer """
+        limit = None
+        if attempt_timeout is not None:
+            limit = seconds + attempt_timeout
+        try:
+            task = task_queue.put_task(Task(attempt), delay=seconds,
+                                       timeout=limit, **put_kwargs)
+        except RuntimeError as err:
+            promise.set_error(err)
+            return
+        task.add_done_callback(expired)
+
+    schedule(delay)
+    return promise
+
+
+class AsyncNode(object):
+    """A non-blocking front end for a Node.
+
+    Every Node method is available, and returns a Task instead of its
+    result. The method itself still runs on a worker thread, so any waiting
+    it does (the TFTP polls in get_linkmap and the other fabric TFTP
+    commands, or update_firmware's transfers) holds that worker until it's
+    done. Only mc_reset(wait=True), wait_for_transfer() and poll() wait on
+    the task queue's timer, without a thread for each node.
+
+    Given a fabric, commands share its task queue, lane, rate limits and
+    command timeout.
+
+    >>> from cxmanage_api.asynchronous import AsyncNode
+    >>> async_node = AsyncNode(node)
+    >>> task = async_node.get_power()
+    >>> task.get_result()
+    False
+
+    :param node: The node to drive.
+    :type node: Node
+    :param task_queue: Task queue to run commands on.
+    :type task_queue: TaskQueue
+    :param priority: Priority class for this node's commands.
+    :type priority: integer
+    :param lane: Lane (or lane name) for this node's commands.
+    :type lane: TaskLane or string
+    :param fabric: The fabric this node belongs to, if any.
+    :type fabric: Fabric
+
+    """
+
+    def __init__(self, node, task_queue=None, priority=PRIORITY_NORMAL,
+                 lane=None, fabric=None):
+        """Default constructor for the AsyncNode class."""
+        if task_queue is None:
+            if fabric is not None:
+                task_queue = fabric.task_queue
+            else:
+                task_queue = DEFAULT_TASK_QUEUE
+        if lane is None and fabric is not None:
+            lane = fabric.task_lane
+        self.node = node
+        self.task_queue = task_queue
+        self.priority = priority
+        self.lane = lane
+        self.fabric = fabric
+
+    def __getattr__(self, name):
+        """Wrap Node methods so that they return Tasks."""
+        method = getattr(self.node, name)
+        if not hasattr(method, "__call__"):
+            raise AttributeError("'AsyncNode' object has no attribute '%s'"
+                                 % name)
+
+        def function(*args, **kwargs):
+            """ Run the named Node method on the task queue. """
+            return self.submit(method, *args, **kwargs)
+        return function
+
+    def __str__(self):
+        return 'AsyncNode: %s' % self.node.ip_address
+
+    def submit(self, method, *args, **kwargs):
+        """Run a function on the task queue with this node's settings.
+
+        :param method: The function to run.
+        :type method: function
+
+        :returns: The queued task.
+        :rtype: Task
+
+        """
+        return self.task_queue.put_task(Task(method, *args, **kwargs),
+                                        **self._put_kwargs())
+
+    def poll(self, check, interval=1, timeout=None, error=None, delay=None):
+        """Poll check() on the task queue with this node's settings. See
+        cxmanage_api.asynchronous.poll().
+
+        :returns: A task for the first result that isn't None.
+        :rtype: Task
+
+        """
+        put_kwargs = self._put_kwargs()
+        return poll(check, interval, timeout, error, delay,
+                    task_queue=self.task_queue,
+                    attempt_timeout=put_kwargs.pop("timeout", None),
+                    **put_kwargs)
+
+    def mc_reset(self, wait=False):
+        """Send a Master Control reset command to the node.
+
+        >>> async_node.mc_reset(wait=True).join()
+
+        :param wait: Finish the task only once the node is back up.
+        :type wait: boolean
+
+        :returns: The reset task.
+        :rtype: Task
+
+        """
+        task = self.submit(self.node.mc_reset)
+        if not wait:
+            return task
+
+        def wait_for_reset(_):
+            """ Give the node a minute to go down, then poll for it """
+            return self.poll(self._check_mc_up, timeout=300, delay=60,
+                             error=Exception("Reset timed out"))
+
+        def reset_done(result):
+            """ Drop anything the node's caches picked up meanwhile """
+            self.node._invalidate_caches()  # pylint: disable=W0212
+            return result
+
+        return then(then(task, wait_for_reset), reset_done)
+
+    def wait_for_transfer(self, handle):
+        """Wait for a firmware transfer to finish.
+
+        :param handle: The TFTP handle ID of the transfer.
+        :type handle: integer
+
+        :returns: A task that completes once the transfer is done.
+        :rtype: Task
+
+        """
+        return self.poll(
+            lambda: self._check_transfer(handle), timeout=180, delay=0,
+            error=TimeoutError("Transfer timed out after 3 minutes")
+        )
+
+    def _put_kwargs(self):
+        """Get the put_task() arguments for this node's commands."""
+        if self.fabric is None:
+            return dict(priority=self.priority, lane=self.lane,
+                        rate_keys={"node": self.node.ip_address})
+        return dict(priority=self.priority, lane=self.lane,
+                    rate_keys=self.fabric.get_rate_keys(self.node),
+                    timeout=self.fabric.command_timeout)
+
+    def _check_mc_up(self):
+        """Return True if the node's MC responds, None if not yet."""
+        try:
+            self.node.bmc.get_info_basic()
+            return True
+        except IpmiError:
+            return None
+
+    def _check_transfer(self, handle):
+        """Return True if the transfer is complete, None if not yet."""
+        result = self.node.bmc.get_firmware_status(handle)
+        if result.status == "In progress":
+            return None
+        if result.status != "Complete":
+            raise TransferFailure("Node reported TFTP transfer failure")
+        return True
+
+
+class AsyncFabric(object):
+    """A non-blocking front end for a Fabric.
+
+    Every Node method is available, and returns a dictionary of node_id to
+    Task (like Fabric methods with async=True). Commands go on the fabric's
+    task queue, in its lane.
+
+    >>> from cxmanage_api.asynchronous import AsyncFabric
+    >>> async_fabric = AsyncFabric(fabric)
+    >>> tasks = async_fabric.mc_reset(wait=True)
+    >>> gather(tasks)
+
+    :param fabric: The fabric to drive.
+    :type fabric: Fabric
+    :param priority: Priority class for this fabric's commands.
+    :type priority: integer
+
+    """
+
+    def __init__(self, fabric, priority=PRIORITY_NORMAL):
+        """Default constructor for the AsyncFabric class."""
+        self.fabric = fabric
+        self.priority = priority
+        self._nodes = {}
+
+    def __getattr__(self, name):
+        """Fan Node methods out across the fabric."""
+        if name.startswith("_"):
+            raise AttributeError("'AsyncFabric' object has no attribute '%s'"
+                                 % name)
+
+        def function(*args, **kwargs):
+            """ Run the named AsyncNode method on every node. """
+            return dict(
+                (node_id, getattr(node, name)(*args, **kwargs))
+                for node_id, node in self.nodes.iteritems()
+            )
+        return function
+
+    def __str__(self):
+        return 'AsyncFabric: %s' % self.fabric.ip_address
+
+    @property
+    def nodes(self):
+        """AsyncNodes for the nodes in this fabric, keyed by node id.
+
+        :returns: The fabric's nodes.
+        :rtype: dictionary
+
+        """
+        nodes = self.fabric.nodes
+        for node_id in self._nodes.keys():
+            if self._nodes[node_id].node is not nodes.get(node_id):
+                del self._nodes[node_id]
+        for node_id, node in nodes.iteritems():
+            if not node_id in self._nodes:
+                self._nodes[node_id] = AsyncNode(
+                    node, priority=self.priority, fabric=self.fabric
+                )
+        return self._nodes
+
+    def refresh(self, wait=False, timeout=600, incremental=False):
+        """Refresh the fabric's node list on the task queue. See
+        Fabric.refresh for the arguments.
+
+        :returns: A task for the refresh. If the same refresh is already
+                  in flight, its task is returned instead of queueing
+                  another one that would just wait for it.
+        :rtype: Task
+
+        """
+        # pylint: disable=W0212
+        with self.fabric._refresh_lock:
+            flight = self.fabric._refreshes.get((wait, timeout, incremental))
+        if flight is not None:
+            return flight
+
+        return self.fabric.task_queue.put_task(
+            Task(self.fabric.refresh, wait, timeout, incremental),
+            priority=self.priority, lane=self.fabric.task_lane
+        )
+
+
+# End of file: ./asynchronous.py
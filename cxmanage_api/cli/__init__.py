@@ -33,10 +33,16 @@
 import sys
 import time
 
+from argparse import ArgumentTypeError
+
 from cxmanage_api.tftp import InternalTftp, ExternalTftp
 from cxmanage_api.node import Node
-from cxmanage_api.tasks import TaskQueue
-from cxmanage_api.cx_exceptions import TftpException
+from cxmanage_api.sharding import run_sharded
+from cxmanage_api.tasks import TaskQueue, TaskGraph, Task, gather, \
+        DEFAULT_THREADS
+from cxmanage_api.discovery_cache import DiscoveryCache
+from cxmanage_api.cx_exceptions import TftpException, TimeoutError, \
+        IpmiError
 
 
 COMPONENTS = [
@@ -56,6 +62,11 @@ COMPONENTS = [
     ("pmic_version", "PMIC version")
 ]
 
+_TASK_QUEUES = {}
+
+# Fabric head for each IP address discovered by get_nodes
+_FABRIC_HEADS = {}
+
 
 def get_tftp(args):
     """Get a TFTP server"""
@@ -105,34 +116,45 @@ def get_nodes(args, tftp, verify_prompt=False):
         "linux_password": args.linux_password
     }
 
-    nodes = [
-        Node(
-            ip_address=x, credentials=credentials, tftp=tftp,
+    def make_node(ip_address):
+        """ Make a node object for this IP address """
+        return Node(
+            ip_address=ip_address, credentials=credentials, tftp=tftp,
             ecme_tftp_port=args.ecme_tftp_port, verbose=args.verbose
         )
-        for x in hosts
-    ]
+
+    nodes = [make_node(x) for x in hosts]
 
     if args.all_nodes:
         if not args.quiet:
             print("Getting IP addresses...")
 
-        results, errors = run_command(
-            args, nodes, "get_fabric_ipinfo", args.force
-        )
+        cache = get_discovery_cache(args)
+        results, errors = {}, {}
+        if cache:
+            results = _load_cached_ipinfo(args, cache, nodes, make_node)
+
+        missing = [x for x in nodes if not x in results]
+        if missing:
+            new_results, errors = run_command(
+                args, missing, "get_fabric_ipinfo", args.force
+            )
+            results.update(new_results)
+            if cache:
+                _save_ipinfo(args, cache, new_results, make_node)
 
         all_nodes = []
+        seen = set()
         for node in nodes:
             if node in results:
                 for node_id, ip_address in sorted(results[node].iteritems()):
-                    new_node = Node(
-                        ip_address=ip_address, credentials=credentials,
-                        tftp=tftp, ecme_tftp_port=args.ecme_tftp_port,
-                        verbose=args.verbose
-                    )
+                    if ip_address in seen:
+                        continue
+                    seen.add(ip_address)
+                    _FABRIC_HEADS[ip_address] = node.ip_address
+                    new_node = make_node(ip_address)
                     new_node.node_id = node_id
-                    if not new_node in all_nodes:
-                        all_nodes.append(new_node)
+                    all_nodes.append(new_node)
 
         node_strings = get_node_strings(args, all_nodes, justify=False)
         if not args.quiet and all_nodes:
@@ -180,85 +202,233 @@ def get_node_strings(args, nodes, justify=False):
     return dict(zip(nodes, strings))
 
 
+def get_discovery_cache(args):
+    """Get the discovery cache to use with --all-nodes, if any"""
+    if not args.discovery_cache:
+        return None
+    return DiscoveryCache(ttl=args.discovery_cache_ttl)
+
+
+def get_task_queue(args):
+    """Get the TaskQueue to run commands on. Queues are kept for the life of
+    the process, so retries and follow-up commands reuse the same workers.
+    """
+    rate_limits = {}
+    if args.rate_limit:
+        rate_limits["global"] = args.rate_limit
+    if args.node_rate_limit:
+        rate_limits["node"] = args.node_rate_limit
+    if args.fabric_rate_limit:
+        rate_limits["fabric"] = args.fabric_rate_limit
+
+    key = (args.threads, args.command_delay,
+           tuple(sorted(rate_limits.items())), args.adaptive)
+    if not key in _TASK_QUEUES:
+        if args.threads != None:
+            _TASK_QUEUES[key] = TaskQueue(threads=args.threads,
+                                          delay=args.command_delay,
+                                          rate_limits=rate_limits,
+                                          concurrency=get_concurrency(args))
+        else:
+            _TASK_QUEUES[key] = TaskQueue(delay=args.command_delay,
+                                          rate_limits=rate_limits,
+                                          concurrency=get_concurrency(args))
+    return _TASK_QUEUES[key]
+
+
+def get_concurrency(args):
+    """Get adaptive concurrency settings for the task queue. With --adaptive,
+    the number of commands in flight starts low and grows while the BMCs keep
+    up, both overall and per fabric. Timeouts and IPMI/TFTP errors cut it
+    back down.
+    """
+    if not args.adaptive:
+        return None
+
+    settings = {
+        "maximum": args.threads or DEFAULT_THREADS,
+        "max_latency": args.command_timeout,
+        "congestion_errors": (IpmiError, TftpException, TimeoutError)
+    }
+    return {"global": dict(settings, initial=8), "fabric": settings}
+
+
+def get_rate_keys(node):
+    """Get the rate limiting keys for a command on this node."""
+    return {"node": node.ip_address, "fabric": get_lane(node)}
+
+
+def get_lane(node):
+    """Get the task lane for a command on this node. Each fabric gets its own
+    lane (named after its head), so a fabric whose commands are held back by
+    its rate or concurrency limits doesn't hold up the others.
+    """
+    return _FABRIC_HEADS.get(node.ip_address, node.ip_address)
+
+
+def print_task_stats():
+    """Print statistics for the task queues this process has used. Commands
+    sharded across worker processes (--processes) aren't included.
+    """
+    for task_queue in _TASK_QUEUES.itervalues():
+        stats = task_queue.get_stats()
+        print "[ Task queue stats ]"
+        print "Threads     : %i max, %i started, %i idle" % (
+            stats["threads"], stats["workers"], stats["idle"]
+        )
+        print "Tasks       : %i finished, %i in flight, %i pending" % (
+            stats["run_time"]["total"], stats["in_flight"], stats["pending"]
+        )
+        print "Utilization : %.1f%% of workers, %.1f%% of thread limit" % (
+            100 * stats["utilization"], 100 * stats["capacity"]
+        )
+        for scope, limit in sorted(stats["concurrency"].iteritems()):
+            print "Concurrency : %i (peak %i, %i up, %i down) for %s" % (
+                limit["limit"], limit["peak"], limit["increases"],
+                limit["decreases"], scope
+            )
+        for name in ["wait_time", "run_time"]:
+            summary = stats[name]
+            if not summary["count"]:
+                continue
+            label = name.replace("_", " ").capitalize().ljust(12)
+            print "%s: mean %.3fs, p50 %.3fs, p90 %.3fs, p99 %.3fs, " \
+                  "max %.3fs" % (label, summary["mean"], summary["p50"],
+                                 summary["p90"], summary["p99"],
+                                 summary["max"])
+            buckets = ["%s: %i" % ("<=%gs" % bound if bound != None
+                                   else "more", count)
+                       for bound, count in summary["buckets"] if count]
+            print "              %s" % ", ".join(buckets)
+        print
+
+
+def parse_rate_limit(entry):
+    """Parse a RATE[:BURST] rate limit argument into a (rate, burst) tuple"""
+    try:
+        rate, _, burst = entry.partition(':')
+        rate = float(rate)
+        burst = int(burst) if burst else 1
+    except ValueError:
+        raise ArgumentTypeError('%s is not a valid rate limit' % entry)
+
+    if rate <= 0 or burst < 1:
+        raise ArgumentTypeError('%s is not a valid rate limit' % entry)
+    return (rate, burst)
+
+
 # pylint: disable=R0915
 def run_command(args, nodes, name, *method_args):
     """Runs a command on nodes."""
-    if args.threads != None:
-        task_queue = TaskQueue(threads=args.threads, delay=args.command_delay)
+    task_queue = get_task_queue(args)
+
+    if args.processes and args.processes > 1:
+        tasks = dict(zip(nodes, run_sharded(
+            nodes, name, method_args, processes=args.processes,
+            threads=task_queue.threads, delay=task_queue.delay,
+            rate_limits=task_queue.rate_limits,
+            timeout=args.command_timeout,
+            concurrency=task_queue.concurrency
+        )))
     else:
-        task_queue = TaskQueue(delay=args.command_delay)
+        tasks = {}
+        for node in nodes:
+            target = node
+            for member in name.split("."):
+                target = getattr(target, member)
+            tasks[node] = task_queue.put_task(
+                Task(target, *method_args),
+                lane=get_lane(node),
+                rate_keys=get_rate_keys(node),
+                timeout=args.command_timeout
+            )
 
-    tasks = {}
-    for node in nodes:
-        target = node
-        for member in name.split("."):
-            target = getattr(target, member)
-        tasks[node] = task_queue.put(target, *method_args)
+    results, errors = _wait_for_tasks(args, tasks)
 
-    results = {}
-    errors = {}
-    try:
-        counter = 0
-        while any(x.is_alive() for x in tasks.values()):
-            if not args.quiet:
-                _print_command_status(tasks, counter)
-                counter += 1
-            time.sleep(0.25)
+    if _should_retry(args, nodes, errors):
+        nodes = [x for x in nodes if x in errors]
+        new_results, errors = run_command(args, nodes, name, *method_args)
+        results.update(new_results)
 
-        for node, task in tasks.iteritems():
-            if task.status == "Completed":
-                results[node] = task.result
-            else:
-                errors[node] = task.error
+    return results, errors
 
-    except KeyboardInterrupt:
-        args.retry = 0
 
-        for node, task in tasks.iteritems():
-            if task.status == "Completed":
-                results[node] = task.result
-            elif task.status == "Failed":
-                errors[node] = task.error
-            else:
-                errors[node] = KeyboardInterrupt(
-                    "Aborted by keyboard interrupt"
-                )
+def run_graph(args, nodes, build):
+    """Runs a multi-step workflow on nodes, as a TaskGraph.
 
-    if not args.quiet:
-        _print_command_status(tasks, counter)
-        print("\n")
+    build(graph, nodes) adds each node's chain of tasks to the graph, and
+    returns a map of node to the last task in its chain. Each node moves
+    through its chain on its own, so one slow node doesn't hold the others
+    up (except at gates). Status, errors and retries are handled like in
+    run_command, with a retry running failed nodes' chains from the start.
+    """
+    graph = TaskGraph(get_task_queue(args))
+    tasks = build(graph, nodes)
 
-    # Handle errors
-    should_retry = False
-    if errors:
-        _print_errors(args, nodes, errors)
-        if args.retry == None:
-            sys.stdout.write("Retry command on failed hosts? (y/n): ")
-            sys.stdout.flush()
-            while True:
-                command = raw_input().strip().lower()
-                if command in ['y', 'yes']:
-                    should_retry = True
-                    break
-                elif command in ['n', 'no']:
-                    print
-                    break
-        elif args.retry >= 1:
-            should_retry = True
-            if args.retry == 1:
-                print("Retrying command 1 more time...")
-            elif args.retry > 1:
-                print("Retrying command %i more times..." % args.retry)
-            args.retry -= 1
+    results, errors = _wait_for_tasks(args, tasks, cancel=graph.cancel)
 
-    if should_retry:
+    if _should_retry(args, nodes, errors):
         nodes = [x for x in nodes if x in errors]
-        new_results, errors = run_command(args, nodes, name, *method_args)
+        new_results, errors = run_graph(args, nodes, build)
         results.update(new_results)
 
     return results, errors
 
 
+def run_chains(args, nodes, commands):
+    """Runs a sequence of commands on each node.
+
+    Each node runs its commands one at a time, in order, whatever happens to
+    the earlier ones, and moves along independently of the other nodes.
+    Commands are (name, args) tuples, as in run_command.
+
+    :returns: A (results, errors) tuple for each command.
+    :rtype: list
+
+    """
+    chains = {}
+
+    def build(graph, nodes):
+        """ Add a chain of commands for each node """
+        last_tasks = {}
+        for node in nodes:
+            chains[node] = []
+            for name, method_args in commands:
+                target = node
+                for member in name.split("."):
+                    target = getattr(target, member)
+                chains[node].append(graph.put(
+                    Task(target, *method_args),
+                    after=chains[node][-1:],
+                    require_success=False,
+                    lane=get_lane(node),
+                    rate_keys=get_rate_keys(node),
+                    timeout=args.command_timeout
+                ))
+            # The node's chain fails if any of its commands failed
+            last_tasks[node] = graph.put(
+                Task(_raise_first_error, chains[node]),
+                after=chains[node][-1:], require_success=False,
+                lane=get_lane(node)
+            )
+        return last_tasks
+
+    run_graph(args, nodes, build)
+
+    outcomes = []
+    for index in xrange(len(commands)):
+        results = {}
+        errors = {}
+        for node in nodes:
+            task = chains[node][index]
+            if task.status == "Completed":
+                results[node] = task.result
+            else:
+                errors[node] = task.error
+        outcomes.append((results, errors))
+    return outcomes
+
+
 def prompt_yes(prompt):
     """Prompts the user. """
     sys.stdout.write("%s (y/n) " % prompt)
@@ -344,6 +514,147 @@ def parse_ip_range_entry(entry):
     return addresses
 
 
+def _get_guids(args, nodes):
+    """Look up node GUIDs in parallel. Nodes whose lookups fail are left
+    out.
+    """
+    task_queue = get_task_queue(args)
+    tasks = dict(
+        (x, task_queue.put_task(Task(getattr, x, "guid"),
+                                lane=get_lane(x),
+                                rate_keys=get_rate_keys(x),
+                                timeout=args.command_timeout))
+        for x in nodes
+    )
+    results = gather(tasks, return_exceptions=True)
+    return dict((x, y) for x, y in results.iteritems()
+                if tasks[x].status == "Completed")
+
+
+def _load_cached_ipinfo(args, cache, nodes, make_node):
+    """Get IP info for fabrics from the discovery cache. Returns the IP info
+    of each fabric head that had a fresh cache entry and passed its GUID spot
+    check.
+    """
+    entries = {}
+    checks = {}
+    for node in nodes:
+        entries[node] = cache.load(node.ip_address)
+        if entries[node]:
+            for entry in cache.sample(node.ip_address, entries[node]):
+                checks[make_node(entry["ip_address"])] = (node, entry["guid"])
+
+    guids = _get_guids(args, checks.keys())
+    for check_node, (node, guid) in checks.iteritems():
+        if guids.get(check_node) != guid:
+            entries[node] = None
+
+    return dict((x, dict((y["node_id"], y["ip_address"]) for y in entries[x]))
+                for x in nodes if entries[x])
+
+
+def _save_ipinfo(args, cache, results, make_node):
+    """Save fabric IP info to the discovery cache, along with node GUIDs.
+    Fabrics where a GUID lookup failed aren't saved.
+    """
+    fabric_nodes = dict(
+        (x, dict((node_id, make_node(ip_address))
+                 for node_id, ip_address in y.iteritems()))
+        for x, y in results.iteritems()
+    )
+    guids = _get_guids(args, sum([x.values() for x in
+                                  fabric_nodes.itervalues()], []))
+
+    for node, new_nodes in fabric_nodes.iteritems():
+        if all(x in guids for x in new_nodes.itervalues()):
+            cache.save(node.ip_address, [
+                {"node_id": x, "ip_address": y.ip_address, "guid": guids[y]}
+                for x, y in sorted(new_nodes.iteritems())
+            ])
+
+
+def _wait_for_tasks(args, tasks, cancel=None):
+    """Wait for a map of node to task, printing status as they finish.
+
+    :returns: Results and errors, keyed by node.
+    :rtype: tuple
+
+    """
+    results = {}
+    errors = {}
+    counter = 0
+    try:
+        while any(x.is_alive() for x in tasks.values()):
+            if not args.quiet:
+                _print_command_status(tasks, counter)
+                counter += 1
+            time.sleep(0.25)
+
+        for node, task in tasks.iteritems():
+            if task.status == "Completed":
+                results[node] = task.result
+            else:
+                errors[node] = task.error
+
+    except KeyboardInterrupt:
+        args.retry = 0
+
+        # Pull queued tasks off the queue, and ask running ones to stop
+        if cancel is not None:
+            cancel()
+        for task in tasks.itervalues():
+            task.cancel()
+
+        for node, task in tasks.iteritems():
+            if task.status == "Completed":
+                results[node] = task.result
+            elif task.status == "Failed":
+                errors[node] = task.error
+            else:
+                errors[node] = KeyboardInterrupt(
+                    "Aborted by keyboard interrupt"
+                )
+
+    if not args.quiet:
+        _print_command_status(tasks, counter)
+        print("\n")
+
+    return results, errors
+
+
+def _should_retry(args, nodes, errors):
+    """Print errors, and decide whether to retry the failed nodes."""
+    should_retry = False
+    if errors:
+        _print_errors(args, nodes, errors)
+        if args.retry == None:
+            sys.stdout.write("Retry command on failed hosts? (y/n): ")
+            sys.stdout.flush()
+            while True:
+                command = raw_input().strip().lower()
+                if command in ['y', 'yes']:
+                    should_retry = True
+                    break
+                elif command in ['n', 'no']:
+                    print
+                    break
+        elif args.retry >= 1:
+            should_retry = True
+            if args.retry == 1:
+                print("Retrying command 1 more time...")
+            elif args.retry > 1:
+                print("Retrying command %i more times..." % args.retry)
+            args.retry -= 1
+    return should_retry
+
+
+def _raise_first_error(tasks):
+    """Raise the error of the first task that didn't complete, if any."""
+    for task in tasks:
+        if task.status != "Completed":
+            raise task.error
+
+
 def _print_errors(args, nodes, errors):
     """ Print errors if they occured """
     if errors:
@@ -368,7 +679,8 @@ def _print_command_status(tasks, counter):
     """ Print the status of a command """
     message = "\r%i successes  |  %i errors  |  %i nodes left  |  %s"
     successes = len([x for x in tasks.values() if x.status == "Completed"])
-    errors = len([x for x in tasks.values() if x.status == "Failed"])
+    errors = len([x for x in tasks.values()
+                  if not x.is_alive() and x.status != "Completed"])
     nodes_left = len(tasks) - successes - errors
     dots = "".join(["." for x in range(counter % 4)]).ljust(3)
     sys.stdout.write(message % (successes, errors, nodes_left, dots))
@@ -34,63 +34,65 @@
 from pkg_resources import parse_version
 
 from cxmanage_api.cli import get_tftp, get_nodes, get_node_strings, \
-        run_command, prompt_yes
+        run_command, run_graph, prompt_yes, get_rate_keys, get_lane
 
 from cxmanage_api.image import Image
+from cxmanage_api.tasks import Task
 from cxmanage_api.firmware_package import FirmwarePackage
 
 # pylint: disable=R0912
 def fwupdate_command(args):
     """update firmware on a cluster or host"""
-    def do_update():
-        """ Do a single firmware check+update. Returns True on failure. """
-        if not args.force:
-            if not args.quiet:
-                print "Checking hosts..."
-
-            _, errors = run_command(args, nodes, "_check_firmware",
-                    package, args.partition, args.priority)
-            if errors:
-                print "ERROR: Firmware update aborted."
-                return True
-
-        if not args.quiet:
-            print "Updating firmware..."
-
-        _, errors = run_command(args, nodes, "update_firmware", package,
-            args.partition, args.priority)
-        if errors:
-            print "ERROR: Firmware update failed."
-            return True
-
-        return False
-
-    def do_reset():
-        """ Reset and wait. Returns True on failure. """
-        if not args.quiet:
-            print "Checking ECME versions..."
-
-        results, errors = run_command(args, nodes, "get_versions")
-        if errors:
-            print "ERROR: MC reset aborted. Backup partitions not updated."
-            return True
-
-        for result in results.values():
-            version = result.ecme_version.lstrip("v")
-            if parse_version(version) < parse_version("1.2.0"):
-                print "ERROR: MC reset is unsafe on ECME version v%s" % version
-                print "Please power cycle the system and start a new fwupdate."
-                return True
-
-        if not args.quiet:
-            print "Resetting nodes..."
-
-        results, errors = run_command(args, nodes, "mc_reset", True)
-        if errors:
-            print "ERROR: MC reset failed. Backup partitions not updated."
-            return True
+    def build(graph, nodes):
+        """ Build each node's chain of checks, updates and resets. Returns
+        the last task in each chain.
+        """
+        def put(node, after, name, *method_args):
+            """ Add a node command to the graph """
+            return graph.put(
+                Task(getattr(node, name), *method_args), after=after,
+                lane=get_lane(node), rate_keys=get_rate_keys(node),
+                timeout=args.command_timeout
+            )
 
-        return False
+        checks = {}
+        for node in nodes:
+            checks[node] = []
+            if not args.force:
+                checks[node].append(put(node, [], "_check_firmware",
+                        package, args.partition, args.priority))
+            if args.full:
+                checks[node].append(graph.put(
+                    Task(_check_mc_reset, node),
+                    lane=get_lane(node), rate_keys=get_rate_keys(node),
+                    timeout=args.command_timeout
+                ))
+
+        # Nothing gets updated unless every node passed its checks
+        gate = graph.gate(
+            sum(checks.values(), []),
+            "Firmware update aborted: checks failed on other hosts"
+        )
+        status["gate"] = gate
+
+        chains = {}
+        for node in nodes:
+            chains[node] = put(node, checks[node] + [gate],
+                    "update_firmware", package, args.partition,
+                    args.priority)
+
+        if args.full:
+            # Don't reset anything (node 0 especially) while other nodes
+            # are still transferring their first update over the fabric
+            updated = graph.gate(
+                chains.values(),
+                "Firmware update aborted: updates failed on other hosts"
+            )
+            for node in nodes:
+                task = put(node, [updated], "mc_reset", True)
+                chains[node] = put(node, [task], "update_firmware", package,
+                        args.partition, args.priority)
+        return chains
 
     if args.image_type == "PACKAGE":
         package = FirmwarePackage(args.filename)
@@ -126,17 +128,38 @@ def fwupdate_command(args):
     tftp = get_tftp(args)
     nodes = get_nodes(args, tftp, verify_prompt=True)
 
-    errors = do_update()
+    if not args.quiet:
+        if args.full:
+            print "Updating firmware and resetting nodes..."
+        else:
+            print "Updating firmware..."
 
-    if args.full and not errors:
-        errors = do_reset()
-        if not errors:
-            errors = do_update()
+    status = {}
+    _, errors = run_graph(args, nodes, build)
 
-    if not args.quiet and not errors:
+    if errors:
+        if status["gate"].status != "Completed":
+            print "ERROR: Firmware update aborted."
+        else:
+            print "ERROR: Firmware update failed."
+        return True
+
+    if not args.quiet:
         print "Command completed successfully.\n"
 
-    return errors
+    return False
+
+
+def _check_mc_reset(node):
+    """ Make sure it's safe to reset this node's MC. The running ECME version
+    doesn't change until the reset, so this can be checked up front.
+    """
+    version = node.get_versions().ecme_version.lstrip("v")
+    if parse_version(version) < parse_version("1.2.0"):
+        raise Exception(
+            "MC reset is unsafe on ECME version v%s. Please power cycle "
+            "the system and start a new fwupdate." % version
+        )
 
 
 def fwinfo_command(args):
@@ -50,7 +50,11 @@ import time
 
 import pyipmi
 import cxmanage_api
-from cxmanage_api.cli import get_tftp, get_nodes, run_command, COMPONENTS
+from cxmanage_api.cli import get_tftp, get_nodes, run_chains, COMPONENTS
+
+# The write_* functions all take (args, nodes, results, errors), whether
+# they use them or not.
+# pylint: disable=W0613
 
 
 def tspackage_command(args):
@@ -90,48 +94,26 @@ def tspackage_command(args):
     write_client_info()
 
     if not quiet:
-        print("Getting version information...")
-    write_version_info(args, nodes)
-
-    if not quit:
-        print("Getting LAN information...")
-    write_lan_info(args, nodes)
-
-    if not quiet:
-        print("Getting boot order...")
-    write_boot_order(args, nodes)
-
-    if not quiet:
-        print("Getting MAC addresses...")
-    write_mac_addrs(args, nodes)
-
-    if not quiet:
-        print("Getting sensor information...")
-    write_sensor_info(args, nodes)
-
-    if not quiet:
-        print("Getting firmware information...")
-    write_fwinfo(args, nodes)
-
-    if not quiet:
-        print("Getting system event logs...")
-    write_sel(args, nodes)
-
-    if not quiet:
-        print("Getting depth charts...")
-    write_depth_chart(args, nodes)
-
-    if not quiet:
-        print("Getting routing tables...")
-    write_routing_table(args, nodes)
-
-    if not quiet:
-        print("Getting serial log...")
-    write_serial_log(args, nodes)
-
-    if not quiet:
-        print("Getting crash log...")
-    write_crash_log(args, nodes)
+        print("Getting node information...")
+
+    # Each node works through the whole list on its own, so a slow node
+    # doesn't hold the others up between sections.
+    sections = [
+        (write_version_info, "get_versions", ()),
+        (write_lan_info, "bmc.lan_print", ()),
+        (write_boot_order, "get_boot_order", ()),
+        (write_mac_addrs, "get_fabric_macaddrs", ()),
+        (write_sensor_info, "get_sensors", ("",)),
+        (write_fwinfo, "get_firmware_info", ()),
+        (write_sel, "get_sel", ()),
+        (write_depth_chart, "get_depth_chart", ()),
+        (write_routing_table, "get_routing_table", ()),
+        (write_serial_log, "read_fru", (98,)),
+        (write_crash_log, "read_fru", (99,))
+    ]
+    outcomes = run_chains(args, nodes, [x[1:] for x in sections])
+    for (write, _, _), (results, errors) in zip(sections, outcomes):
+        write(args, nodes, results, errors)
 
     # Archive the files
     archive(os.getcwd(), original_dir)
@@ -168,13 +150,11 @@ def write_client_info():
         write_command("pip freeze")
 
 
-def write_version_info(args, nodes):
+def write_version_info(args, nodes, info_results, errors):
     """Write the version info (like cxmanage info) for each node
     to their respective files.
 
     """
-    info_results, _ = run_command(args, nodes, "get_versions")
-
 
     for node in nodes:
         lines = [
@@ -205,26 +185,21 @@ def write_version_info(args, nodes):
         write_to_file(node, lines)
 
 
-def write_lan_info(args, nodes):
+def write_lan_info(args, nodes, results, errors):
     """Write LAN info for each node"""
-    results, _ = run_command(args, nodes, "bmc.lan_print")
-
     for node in nodes:
         lines = ["\n[ LAN info for Node %s ]" % node.node_id]
-        for (key, value) in sorted(vars(results[node]).items()):
-            lines.append("%s: %s" % (key, value))
+        if node in results:
+            for (key, value) in sorted(vars(results[node]).items()):
+                lines.append("%s: %s" % (key, value))
+        else:
+            lines.append("Could not get LAN info!")
 
         write_to_file(node, lines)
 
 
-def write_mac_addrs(args, nodes):
+def write_mac_addrs(args, nodes, mac_addr_results, errors):
     """Write the MAC addresses for each node to their respective files."""
-    mac_addr_results, _ = run_command(
-        args,
-        nodes,
-        "get_fabric_macaddrs"
-    )
-
     for node in nodes:
         lines = []  # Lines of text to write to file
         # \n is used here to give a blank line before this section
@@ -243,34 +218,31 @@ def write_mac_addrs(args, nodes):
 
         write_to_file(node, lines)
 
+
 # pylint: disable=R0914
-def write_sensor_info(args, nodes):
+def write_sensor_info(args, nodes, results, errors):
     """Write sensor information for each node to their respective files."""
-    args.sensor_name = ""
-
-    results, _ = run_command(args, nodes, "get_sensors",
-                             args.sensor_name)
-
     for node in nodes:
         lines = ["\n[ Sensors for Node %s ]" % node.node_id]
 
-        justify_length = max(len(x) for x in results[node]) + 1
+        if node in results and results[node]:
+            justify_length = max(len(x) for x in results[node]) + 1
 
-        for sensor_name, sensor in results[node].items():
-            lines.append("%s: %s" % (
-                sensor_name.ljust(justify_length), sensor.sensor_reading
-            ))
+            for sensor_name, sensor in results[node].items():
+                lines.append("%s: %s" % (
+                    sensor_name.ljust(justify_length), sensor.sensor_reading
+                ))
+        else:
+            lines.append("Could not get sensor readings!")
 
         write_to_file(node, lines)
 
 
-def write_fwinfo(args, nodes):
+def write_fwinfo(args, nodes, results, errors):
     """Write information about each node's firware partitions
     to its respective file.
 
     """
-    results, _ = run_command(args, nodes, "get_firmware_info")
-
     for node in nodes:
         lines = []  # Lines of text to write to file
         # \n is used here to give a blank line before this section
@@ -298,10 +270,8 @@ def write_fwinfo(args, nodes):
         write_to_file(node, lines)
 
 
-def write_boot_order(args, nodes):
+def write_boot_order(args, nodes, results, errors):
     """Write the boot order of each node to their respective files."""
-    results, _ = run_command(args, nodes, "get_boot_order")
-
     for node in nodes:
         lines = []  # Lines of text to write to file
         # \n is used here to give a blank line before this section
@@ -315,10 +285,8 @@ def write_boot_order(args, nodes):
         write_to_file(node, lines)
 
 
-def write_sel(args, nodes):
+def write_sel(args, nodes, results, errors):
     """Write the SEL for each node to their respective files."""
-    results, _ = run_command(args, nodes, "get_sel")
-
     for node in nodes:
         lines = []  # Lines of text to write to file
         # \n is used here to give a blank line before this section
@@ -338,10 +306,8 @@ def write_sel(args, nodes):
         write_to_file(node, lines)
 
 
-def write_depth_chart(args, nodes):
+def write_depth_chart(args, nodes, depth_results, errors):
     """Write the depth chart for each node to their respective files."""
-    depth_results, _ = run_command(args, nodes, "get_depth_chart")
-
     for node in nodes:
         lines = []  # Lines of text to write to file
         # \n is used here to give a blank line before this section
@@ -374,10 +340,8 @@ def write_depth_chart(args, nodes):
         write_to_file(node, lines)
 
 
-def write_routing_table(args, nodes):
+def write_routing_table(args, nodes, routing_results, errors):
     """Write the routing table for each node to their respective files."""
-    routing_results, _ = run_command(args, nodes, "get_routing_table")
-
     for node in nodes:
         lines = []  # Lines of text to write to file
         # \n is used here to give a blank line before this section
@@ -393,9 +357,8 @@ def write_routing_table(args, nodes):
         write_to_file(node, lines)
 
 
-def write_serial_log(args, nodes):
+def write_serial_log(args, nodes, results, errors):
     """Write the serial log for each node"""
-    results, errors = run_command(args, nodes, "read_fru", 98)
     for node in nodes:
         lines = ["\n[ Serial log for Node %s ]" % node.node_id]
         if node in results:
@@ -405,9 +368,8 @@ def write_serial_log(args, nodes):
         write_to_file(node, lines)
 
 
-def write_crash_log(args, nodes):
+def write_crash_log(args, nodes, results, errors):
     """Write the crash log for each node"""
-    results, errors = run_command(args, nodes, "read_fru", 99)
     for node in nodes:
         lines = ["\n[ Crash log for Node %s ]" % node.node_id]
         if node in results:
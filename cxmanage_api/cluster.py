@@ -0,0 +1,259 @@
+"""Calxeda: cluster.py"""
+
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+
+from threading import Lock
+
+from cxmanage_api.fabric import Fabric
+from cxmanage_api.tasks import DEFAULT_TASK_QUEUE, TaskQueue, Task, \
+    PRIORITY_NORMAL, PRIORITY_LOW, gather
+from cxmanage_api.cx_exceptions import CommandFailedError
+
+
+class Cluster(object):
+    """ The Cluster class provides management of many fabrics at once.
+
+    Every fabric shares one task queue, so rate limits and adaptive
+    concurrency apply across the whole cluster, and each fabric gets a fair
+    share of it through its own lane. Nodes are indexed by GUID, so a node
+    reachable through more than one of the given addresses is only counted
+    (and commanded) once.
+
+    The cluster has the same per-node commands as Fabric (get_power,
+    get_sensors, update_firmware, ...). They run on every node of every
+    fabric, and their results are keyed by node GUID.
+
+    >>> from cxmanage_api.cluster import Cluster
+    >>> cluster = Cluster(['10.20.1.9', '10.20.2.9'])
+    >>> cluster.get_power()
+    {'99cfa980-2076-11e3-d5c7-76db821cea20': False, ...}
+
+    :param ip_addresses: An IP address of each fabric.
+    :type ip_addresses: list
+    :param credentials: Login credentials for ECME/Linux
+    :type credentials: Credentials
+    :param tftp: Tftp server to facilitate IPMI command responses.
+    :type tftp: `Tftp <tftp.html>`_
+    :param task_queue: TaskQueue to use for sending commands.
+    :type task_queue: `TaskQueue <tasks.html#cxmanage_api.tasks.TaskQueue>`_
+    :param verbose: Flag to turn on verbose output (cmd/response).
+    :type verbose: boolean
+    :param node: Node type, for dependency integration.
+    :type node: `Node <node.html>`_
+    :param command_timeout: Seconds each node gets to finish a command
+                            before it fails with a TimeoutError.
+    :type command_timeout: float
+    :param discovery_cache: Cache to reuse fabric topology from.
+    :type discovery_cache: `DiscoveryCache <discovery_cache.html>`_
+
+    """
+
+    # Fabric commands that run on every node. The cluster runs them on every
+    # node of every fabric.
+    FANOUT_COMMANDS = frozenset([
+        "get_power", "set_power", "get_power_policy", "set_power_policy",
+        "mc_reset", "get_sensors", "get_firmware_info",
+        "get_firmware_info_dict", "is_updatable", "update_firmware",
+        "config_reset", "set_boot_order", "get_boot_order",
+        "set_pxe_interface", "get_pxe_interface", "update_ubootenv",
+        "get_versions",
+        "get_versions_dict", "ipmitool_command", "get_ubootenv",
+        "get_server_ip", "get_uplink_info", "get_uplink_speed",
+        "get_link_stats", "get_linkmap", "get_routing_table",
+        "get_depth_chart"
+    ])
+
+    # Most fabrics to discover at once
+    DISCOVERY_CONCURRENCY = 8
+
+    def __init__(self, ip_addresses, credentials=None, tftp=None,
+                 ecme_tftp_port=5001, task_queue=None, verbose=False,
+                 node=None, command_timeout=None, discovery_cache=None):
+        """Default constructor for the Cluster class."""
+        self.task_queue = task_queue
+        if (not self.task_queue):
+            self.task_queue = DEFAULT_TASK_QUEUE
+
+        self.fabrics = {}
+        self._order = []
+        for ip_address in ip_addresses:
+            if ip_address in self.fabrics:
+                continue
+            self.fabrics[ip_address] = Fabric(
+                ip_address, credentials=credentials, tftp=tftp,
+                ecme_tftp_port=ecme_tftp_port, task_queue=self.task_queue,
+                verbose=verbose, node=node, command_timeout=command_timeout,
+                discovery_cache=discovery_cache
+            )
+            self._order.append(ip_address)
+
+        self._nodes = {}
+        self._owners = {}
+        self._lock = Lock()
+
+        # Fabric refreshes wait on GUID lookups that go on the main task
+        # queue, so they get a queue of their own.
+        self._discovery_queue = TaskQueue(threads=self.DISCOVERY_CONCURRENCY)
+
+    def __str__(self):
+        return 'Cluster %d fabrics, %d nodes' % (len(self.fabrics),
+                                                 len(self.nodes))
+
+    def __getattr__(self, name):
+        """ Fabric commands run on every node of every fabric. """
+        if not name in Cluster.FANOUT_COMMANDS:
+            raise AttributeError("'Cluster' object has no attribute '%s'"
+                                 % name)
+
+        def function(*args, **kwargs):
+            """ Run the named command on every node in the cluster. The
+            async keyword argument works like it does for Fabric commands.
+            """
+            async = kwargs.pop("async", False)
+            return self._run_on_all_nodes(async, name, *args, **kwargs)
+
+        function.__name__ = name
+        return function
+
+    @property
+    def nodes(self):
+        """List of nodes in this cluster, by GUID.
+
+        >>> cluster.nodes
+        {
+         '99cfa980-2076-11e3-d5c7-76db821cea20':
+            <cxmanage_api.node.Node object at 0x2052710>,
+         ...
+        }
+
+        .. note::
+            * Cluster nodes are lazily initialized.
+
+        :returns: A mapping of node GUIDs to node objects.
+        :rtype: dictionary
+
+        """
+        if not self._nodes:
+            self.refresh()
+        return self._nodes
+
+    def get_fabric(self, guid):
+        """Get the fabric that a node was found through.
+
+        >>> cluster.get_fabric('99cfa980-2076-11e3-d5c7-76db821cea20')
+        <cxmanage_api.fabric.Fabric object at 0x7f5ebbd20b90>
+
+        :param guid: GUID of the node.
+        :type guid: string
+
+        :returns: The node's fabric.
+        :rtype: `Fabric <fabric.html>`_
+
+        :raises KeyError: If there's no node with this GUID.
+
+        """
+        if not self._nodes:
+            self.refresh()
+        return self._owners[guid]
+
+    def refresh(self, wait=False, timeout=600, incremental=False):
+        """Discover the nodes of every fabric, several fabrics at a time.
+        See Fabric.refresh for the arguments.
+
+        >>> cluster.refresh()
+
+        :raises CommandFailedError: If any fabrics failed to refresh. Nodes
+                                    of the other fabrics are still indexed.
+                                    Errors are keyed by fabric IP address.
+
+        """
+        tasks = dict(
+            (x, self._discovery_queue.put(y.refresh, wait, timeout,
+                                          incremental))
+            for x, y in self.fabrics.iteritems()
+        )
+        try:
+            gather(tasks)
+            errors = {}
+        except CommandFailedError as err:
+            errors = err.errors
+
+        nodes = {}
+        owners = {}
+        for ip_address in self._order:
+            if ip_address in errors:
+                continue
+            fabric = self.fabrics[ip_address]
+            for node in fabric.nodes.itervalues():
+                if not node.guid in nodes:
+                    nodes[node.guid] = node
+                    owners[node.guid] = fabric
+
+        with self._lock:
+            self._nodes = nodes
+            self._owners = owners
+
+        if errors:
+            raise CommandFailedError(
+                dict((x, None) for x in self.fabrics if not x in errors),
+                errors
+            )
+
+    def _run_on_all_nodes(self, async, name, *args, **kwargs):
+        """Start a command on all nodes."""
+        if name in Fabric.BULK_COMMANDS:
+            priority = PRIORITY_LOW
+        else:
+            priority = PRIORITY_NORMAL
+
+        nodes = self.nodes
+        with self._lock:
+            owners = self._owners
+
+        tasks = {}
+        for guid, node in nodes.iteritems():
+            fabric = owners[guid]
+            tasks[guid] = self.task_queue.put_task(
+                Task(getattr(node, name), *args, **kwargs),
+                priority=priority, lane=fabric.task_lane,
+                rate_keys=fabric.get_rate_keys(node),
+                timeout=fabric.command_timeout
+            )
+
+        if async:
+            return tasks
+        else:
+            return gather(tasks)
+
+
+# End of file: ./cluster.py
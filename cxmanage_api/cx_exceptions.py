@@ -428,6 +428,58 @@ class IPDiscoveryError(Exception):
         return self.msg
 
 
+class TaskCancelledError(Exception):
+    """Raised when a task is cancelled before or while it runs.
+
+    >>> from cxmanage_api.cx_exceptions import TaskCancelledError
+    >>> raise TaskCancelledError('My custom exception text!')
+    Traceback (most recent call last):
+      File "<stdin>", line 1, in <module>
+    cxmanage_api.cx_exceptions.TaskCancelledError: My custom exception text!
+
+    :param msg: Exceptions message and details to return to the user.
+    :type msg: string
+    :raised: When a task is cancelled.
+
+    """
+
+    def __init__(self, msg):
+        """Default constructor for the TaskCancelledError class."""
+        super(TaskCancelledError, self).__init__()
+        self.msg = msg
+
+    def __str__(self):
+        """String representation of this Exception class."""
+        return self.msg
+
+
+class ShardError(Exception):
+    """Raised in place of an error (or result) that couldn't be sent back
+    from a worker process.
+
+    >>> from cxmanage_api.cx_exceptions import ShardError
+    >>> raise ShardError('My custom exception text!')
+    Traceback (most recent call last):
+      File "<stdin>", line 1, in <module>
+    cxmanage_api.cx_exceptions.ShardError: My custom exception text!
+
+    :param msg: Exceptions message and details to return to the user.
+    :type msg: string
+    :raised: When a sharded command's outcome can't be pickled.
+
+    """
+
+    def __init__(self, msg):
+        """Default constructor for the ShardError class."""
+        # Pass msg along so that this error can itself be pickled
+        super(ShardError, self).__init__(msg)
+        self.msg = msg
+
+    def __str__(self):
+        """String representation of this Exception class."""
+        return self.msg
+
+
 class ParseError(Exception):
     """Raised when there's an error parsing some output"""
     pass
@@ -32,7 +32,18 @@
 
 """ Decorators used in cxmanage_api """
 
+import sys
+import copy
 from functools import wraps
+from threading import Event, Lock
+
+from cxmanage_api.tasks import check_cancelled, current_task
+from cxmanage_api.cx_exceptions import TaskCancelledError
+
+
+# Calls in flight for coalesce, from every coalesced method
+_COALESCE_LOCK = Lock()
+_CALLS = {}
 
 
 def retry(count, allowed_errors=Exception):
@@ -68,3 +79,99 @@ def retry(count, allowed_errors=Exception):
         return wrapper
 
     return decorator
+
+
+def coalesce(function):
+    """ Decorator for read-only methods. While a call is in flight, identical
+    calls on the same object (same arguments) from other threads wait for it
+    and share its result or error, instead of running again.
+
+    Waiting callers get a deep copy of the result, so they can't affect each
+    other by modifying it. Calls with unhashable arguments aren't coalesced.
+    If the call in flight is stopped because its own task was cancelled or
+    timed out, the waiters aren't failed with it: one of them runs the call
+    again instead.
+
+    >>> class Node(object):
+    ...     @coalesce
+    ...     def get_power(self):
+    ...         return self.bmc.get_chassis_status().power_on
+
+    :param function: Method to wrap
+    :type function: function
+
+    :return: The wrapped method
+    :rtype: function
+
+    """
+    @wraps(function)
+    def wrapper(self, *args, **kwargs):
+        """ The wrapper function """
+        key = (function, id(self), args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return function(self, *args, **kwargs)
+
+        while True:
+            with _COALESCE_LOCK:
+                call = _CALLS.get(key)
+                if call is None:
+                    call = _CALLS[key] = _Call()
+                    leader = True
+                else:
+                    leader = False
+
+            if leader:
+                try:
+                    call.result = function(self, *args, **kwargs)
+                    return call.result
+                except BaseException as err:
+                    if _is_own_error(err):
+                        call.retry = True
+                    else:
+                        call.error = sys.exc_info()
+                    raise
+                finally:
+                    with _COALESCE_LOCK:
+                        del _CALLS[key]
+                    call.done.set()
+
+            while not call.done.wait(1):
+                check_cancelled()
+            if call.retry:
+                continue  # The leader was stopped; try again ourselves
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return copy.deepcopy(call.result)
+
+    return wrapper
+
+
+def _after_fork():
+    """ Forget the calls in flight in the parent process. Should only be
+    called in a child process right after fork: the threads making those
+    calls don't exist there, and the lock may have been held by one. """
+    global _COALESCE_LOCK   # pylint: disable=W0603
+    _COALESCE_LOCK = Lock()
+    _CALLS.clear()
+
+
+def _is_own_error(err):
+    """ Return True if an error came from the calling thread being stopped
+    (its task cancelled or past its deadline, or an interrupt) rather than
+    from the call itself. Those aren't passed on to coalesced callers. """
+    if not isinstance(err, Exception) or isinstance(err, TaskCancelledError):
+        return True
+    task = current_task()
+    return task is not None and task.cancel_requested()
+
+
+class _Call(object):
+    """ A call in flight, for coalesce """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.retry = False
@@ -0,0 +1,171 @@
+"""Calxeda: discovery_cache.py"""
+
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+
+import json
+import os
+import random
+import re
+import time
+
+
+DEFAULT_DIRECTORY = "~/.cxmanage/fabrics"
+DEFAULT_TTL = 3600
+
+
+class DiscoveryCache(object):
+    """An on-disk cache of fabric topology (node ID, IP address and GUID of
+    each node), with a file per fabric head.
+
+    Cached entries are only trusted for ttl seconds, and callers should spot
+    check a sample() of them (by reading their GUIDs) before using them.
+
+    >>> from cxmanage_api.discovery_cache import DiscoveryCache
+    >>> cache = DiscoveryCache(ttl=600)
+    >>> cache.load("10.20.1.9")
+    [{'node_id': 0, 'ip_address': '10.20.1.9', 'guid': '99cfa980-...'},
+     {'node_id': 1, 'ip_address': '10.20.1.10', 'guid': '99cfa981-...'}]
+
+    :param directory: Where to keep the cache files.
+    :type directory: string
+    :param ttl: How long cached entries are good for, in seconds.
+    :type ttl: float
+    :param spot_checks: Number of nodes (besides the fabric head) to check
+                        before trusting cached entries.
+    :type spot_checks: integer
+
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, ttl=DEFAULT_TTL,
+                 spot_checks=1):
+        """Default constructor for the DiscoveryCache class."""
+        self.directory = os.path.expanduser(directory)
+        self.ttl = ttl
+        self.spot_checks = spot_checks
+
+    def path(self, head):
+        """Get the path of the cache file for a fabric head.
+
+        :param head: IP address of the fabric head.
+        :type head: string
+
+        :returns: Path to the cache file.
+        :rtype: string
+
+        """
+        return os.path.join(self.directory,
+                            "%s.json" % re.sub(r"[^\w.-]", "_", head))
+
+    def load(self, head):
+        """Load the cached nodes of a fabric.
+
+        :param head: IP address of the fabric head.
+        :type head: string
+
+        :returns: A dictionary for each node, with node_id, ip_address and
+                  guid keys. None if nothing usable is cached.
+        :rtype: list
+
+        """
+        try:
+            with open(self.path(head)) as cache_file:
+                data = json.load(cache_file)
+            if (data["head"] != head or
+                    not 0 <= time.time() - data["timestamp"] <= self.ttl):
+                return None
+            return [dict((str(x), str(y) if isinstance(y, unicode) else y)
+                         for x, y in entry.iteritems())
+                    for entry in data["nodes"]]
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def save(self, head, entries):
+        """Cache the nodes of a fabric.
+
+        :param head: IP address of the fabric head.
+        :type head: string
+        :param entries: A dictionary for each node, with node_id, ip_address
+                        and guid keys.
+        :type entries: list
+
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        data = {
+            "head": head,
+            "timestamp": time.time(),
+            "nodes": [{"node_id": x["node_id"],
+                       "ip_address": x["ip_address"],
+                       "guid": x["guid"]} for x in entries]
+        }
+
+        # Write to a temporary file first, so readers never see half of it
+        path = self.path(head)
+        temp_path = "%s.%i.tmp" % (path, os.getpid())
+        with open(temp_path, "w") as cache_file:
+            json.dump(data, cache_file, indent=4)
+        os.rename(temp_path, path)
+
+    def invalidate(self, head):
+        """Drop the cached nodes of a fabric.
+
+        :param head: IP address of the fabric head.
+        :type head: string
+
+        """
+        try:
+            os.remove(self.path(head))
+        except OSError:
+            pass
+
+    def sample(self, head, entries):
+        """Pick the entries to spot check: the fabric head's own entry (if it
+        has one) and spot_checks others at random.
+
+        :param head: IP address of the fabric head.
+        :type head: string
+        :param entries: Entries from load().
+        :type entries: list
+
+        :returns: The entries to check.
+        :rtype: list
+
+        """
+        heads = [x for x in entries if x["ip_address"] == head]
+        others = [x for x in entries if x["ip_address"] != head]
+        return heads + random.sample(others, min(self.spot_checks,
+                                                 len(others)))
+
+
+# End of file: ./discovery_cache.py
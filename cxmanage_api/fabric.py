@@ -36,15 +36,22 @@
 
 """ Calxeda: fabric.py """
 
+import copy
 import time
 import re
-
-from cxmanage_api.tasks import DEFAULT_TASK_QUEUE
+from threading import Lock
+
+from cxmanage_api.tasks import DEFAULT_TASK_QUEUE, Task, PRIORITY_NORMAL, \
+    PRIORITY_LOW, FIRST_COMPLETED, as_completed, check_cancelled, \
+    TaskQueue, current_task, gather, wait
+from cxmanage_api.sharding import run_sharded
+from cxmanage_api.fabric_config import FabricConfig
+from cxmanage_api.topology import FabricTopology
 from cxmanage_api.tftp import InternalTftp
 from cxmanage_api.node import Node as NODE
 from cxmanage_api.credentials import Credentials
-from cxmanage_api.cx_exceptions import CommandFailedError, IpmiError, \
-    TftpException, ParseError, TimeoutError
+from cxmanage_api.cx_exceptions import IpmiError, TftpException, \
+    ParseError, TimeoutError, CommandFailedError
 
 
 class Fabric(object):
@@ -65,6 +72,16 @@ class Fabric(object):
     :type verbose: boolean
     :param node: Node type, for dependency integration.
     :type node: `Node <node.html>`_
+    :param command_timeout: Seconds each node gets to finish a command
+                            before it fails with a TimeoutError.
+    :type command_timeout: float
+    :param processes: Shard node commands across this many worker processes
+                      (see cxmanage_api.sharding). Useful for very large
+                      fabrics, where Python-side work is the bottleneck.
+    :type processes: integer
+    :param discovery_cache: Cache to reuse the fabric's topology from, instead
+                            of rediscovering it on every refresh.
+    :type discovery_cache: `DiscoveryCache <discovery_cache.html>`_
     """
 
     class CompositeBMC(object):
@@ -92,31 +109,37 @@ class Fabric(object):
 
             def function(*args, **kwargs):
                 """ Run the named BMC command in parallel across all nodes. """
+                lane = self.fabric.task_lane
                 tasks = {}
                 for node_id, node in nodes.iteritems():
-                    tasks[node_id] = task_queue.put(
-                        getattr(node.bmc, name),
-                        *args,
-                        **kwargs
+                    tasks[node_id] = task_queue.put_task(
+                        Task(getattr(node.bmc, name), *args, **kwargs),
+                        priority=PRIORITY_NORMAL,
+                        lane=lane,
+                        rate_keys=self.fabric.get_rate_keys(node),
+                        timeout=self.fabric.command_timeout
                     )
 
-                results = {}
-                errors = {}
-                for node_id, task in tasks.items():
-                    task.join()
-                    if task.status == "Completed":
-                        results[node_id] = task.result
-                    else:
-                        errors[node_id] = task.error
-                if errors:
-                    raise CommandFailedError(results, errors)
-                return results
+                return gather(tasks)
 
             return function
 
+    # Node commands that move images around or reset nodes. These go on the
+    # task queue at low priority, so that quick reads from other callers
+    # aren't stuck behind them.
+    BULK_COMMANDS = frozenset([
+        "update_firmware", "is_updatable", "config_reset", "mc_reset",
+        "set_boot_order", "set_pxe_interface", "update_ubootenv",
+        "get_server_ip"
+    ])
+
+    # Most GUID lookups to have in flight at once while refreshing
+    DISCOVERY_CONCURRENCY = 32
+
     def __init__(self, ip_address, credentials=None, tftp=None,
                  ecme_tftp_port=5001, task_queue=None, verbose=False,
-                 node=None):
+                 node=None, command_timeout=None, processes=None,
+                 discovery_cache=None):
         """Default constructor for the Fabric class."""
         self.ip_address = ip_address
         self.credentials = Credentials(credentials)
@@ -125,9 +148,16 @@ class Fabric(object):
         self.task_queue = task_queue
         self.verbose = verbose
         self.node = node
+        self.command_timeout = command_timeout
+        self.processes = processes
+        self.discovery_cache = discovery_cache
         self.cbmc = Fabric.CompositeBMC(self)
 
         self._nodes = {}
+        self._refresh_lock = Lock()
+        self._refreshes = {}
+        self._discovery_lock = Lock()
+        self._parent = None
 
         if (not self.node):
             self.node = NODE
@@ -135,6 +165,13 @@ class Fabric(object):
         if (not self.task_queue):
             self.task_queue = DEFAULT_TASK_QUEUE
 
+        # A refresh running on one of the task queue's workers can't wait on
+        # GUID lookups queued behind it, so those get a queue of their own.
+        self._discovery_queue = TaskQueue(
+            threads=self.DISCOVERY_CONCURRENCY,
+            rate_limits=self.task_queue.rate_limits
+        )
+
     def __eq__(self, other):
         return (isinstance(other, Fabric) and self.nodes == other.nodes)
 
@@ -171,6 +208,36 @@ class Fabric(object):
         for node in self.nodes.values():
             node.tftp = value
 
+    @property
+    def task_lane(self):
+        """The lane this fabric's commands are scheduled on. Each fabric gets
+        its own lane, so fabrics sharing a task queue get a fair share of it.
+
+        >>> fabric.task_lane
+        <cxmanage_api.tasks.TaskLane object at 0x7f5ebbd20b50>
+
+        :return: The task lane for this fabric.
+        :rtype: `TaskLane <tasks.html#cxmanage_api.tasks.TaskLane>`_
+
+        """
+        return self.task_queue.lane(self.ip_address)
+
+    def get_rate_keys(self, node):
+        """Get the rate limiting keys for commands sent to a node in this
+        fabric. See the rate_limits parameter of TaskQueue.
+
+        >>> fabric.get_rate_keys(fabric.nodes[1])
+        {'node': '10.20.2.131', 'fabric': '10.20.1.9'}
+
+        :param node: The node the command will be sent to.
+        :type node: `Node <node.html>`_
+
+        :return: A map of rate limit scope to key.
+        :rtype: dictionary
+
+        """
+        return {"node": node.ip_address, "fabric": self.ip_address}
+
     @property
     def nodes(self):
         """List of nodes in this fabric.
@@ -190,7 +257,7 @@ class Fabric(object):
         :rtype: dictionary
 
         """
-        if not self._nodes:
+        if not self._nodes and self._parent is None:
             self.refresh()
 
         return self._nodes
@@ -207,31 +274,246 @@ class Fabric(object):
         :return: Node object for primary node
         :rtype: Node object
         """
+        if self._parent is not None:
+            return self._parent.primary_node
         try:
             return self.nodes[0]
         except KeyError:
             return self.nodes["0.0"]
 
-    def refresh(self, wait=False, timeout=600):
-        """Gets the nodes of this fabric by pulling IP info from a BMC."""
-        def get_nodes():
-            """Returns a dictionary of nodes reported by the primary node IP"""
-            new_nodes = {}
-            root_node = self.node(
-                ip_address=self.ip_address, credentials=self.credentials,
+    def select(self, selector=None, every=None, offset=0):
+        """Get a view of this fabric with only some of its nodes. Commands
+        run on the view (get_sensors, set_power, ...) only touch those nodes.
+        Fabric-wide config commands still go through the primary node.
+
+        The selector can be:
+
+        * None, for every node.
+        * A node ID or GUID.
+        * A list, set or xrange of node IDs and/or GUIDs.
+        * A function that takes a node and returns whether to select it.
+          It's run on every node in parallel, on the task queue.
+
+        On top of that, every and offset pick every Nth of the selected
+        nodes (by node ID), for sampling.
+
+        >>> canary = fabric.select([0, 1])
+        >>> canary.update_firmware(package=fwpkg)
+        >>> fabric.select(xrange(0, 48, 4)).get_sensors("Node Power")
+        >>> fabric.select(every=8).get_power()
+        >>> old = fabric.select(
+        ...     lambda node: node.get_versions().firmware_version < "v2.0"
+        ... )
+
+        :param selector: Nodes to select.
+        :type selector: integer, string, list, set, xrange or function
+        :param every: Take every Nth selected node.
+        :type every: integer
+        :param offset: Node to start from when taking every Nth node.
+        :type offset: integer
+
+        :returns: A fabric with just the selected nodes.
+        :rtype: Fabric
+
+        :raises CommandFailedError: If a selector function failed on any
+                                    nodes.
+
+        """
+        nodes = self.nodes
+
+        if selector is None:
+            node_ids = nodes.keys()
+        elif hasattr(selector, "__call__"):
+            tasks = dict(
+                (x, self.task_queue.put_task(
+                    Task(selector, y), lane=self.task_lane,
+                    rate_keys=self.get_rate_keys(y),
+                    timeout=self.command_timeout
+                )) for x, y in nodes.iteritems()
+            )
+            node_ids = [x for x, y in gather(tasks).iteritems() if y]
+        else:
+            if isinstance(selector, (list, tuple, set, frozenset, xrange)):
+                keys = set(selector)
+            else:
+                keys = set([selector])
+            # Only look at GUIDs if there are keys that aren't node IDs
+            guids = keys - set(nodes)
+            node_ids = [x for x, y in nodes.iteritems()
+                        if x in keys or (guids and y.guid in guids)]
+
+        node_ids.sort()
+        if every:
+            node_ids = node_ids[offset::every]
+
+        selection = copy.copy(self)
+        selection._nodes = dict((x, nodes[x]) for x in node_ids)
+        selection._parent = self._parent or self
+        selection.cbmc = Fabric.CompositeBMC(selection)
+        return selection
+
+    def shards(self, count, selector=None):
+        """Split (some of) this fabric's nodes into shards, to run a command
+        on one shard after another instead of on every node at once.
+
+        >>> for shard in fabric.shards(4):
+        ...     shard.update_firmware(package=fwpkg)
+
+        :param count: Number of shards. Shards are contiguous ranges of node
+                      IDs, with sizes that differ by at most one.
+        :type count: integer
+        :param selector: Nodes to split up (see select()).
+        :type selector: integer, string, list, set, xrange or function
+
+        :returns: A fabric for each shard, in node ID order. Empty shards are
+                  left out.
+        :rtype: list
+
+        """
+        if count < 1:
+            raise ValueError("Shard count must be at least 1")
+
+        node_ids = sorted(self.select(selector).nodes)
+        size, extra = divmod(len(node_ids), count)
+        shards = []
+        start = 0
+        for index in xrange(count):
+            end = start + size + (1 if index < extra else 0)
+            if end > start:
+                shards.append(self.select(node_ids[start:end]))
+            start = end
+        return shards
+
+    def refresh(self, wait=False, timeout=600, incremental=False):
+        """Gets the nodes of this fabric by pulling IP info from a BMC.
+
+        Safe to call from several threads at once. Callers asking for the
+        same kind of refresh share a single discovery, and different kinds
+        run one at a time.
+
+        With a discovery_cache, a cached topology is used instead if it's
+        within its TTL and a spot check of node GUIDs matches. Waiting
+        refreshes always rediscover the fabric.
+
+        >>> fabric.refresh(incremental=True)
+
+        :param wait: Keep trying until the fabric reports at least as many
+                     nodes as before.
+        :type wait: boolean
+        :param timeout: Seconds to keep trying for, if waiting.
+        :type timeout: integer
+        :param incremental: Only look up nodes whose IP address changed.
+                            Nodes that are still at the same node ID and IP
+                            address are kept as they are, without checking
+                            their GUIDs.
+        :type incremental: boolean
+
+        """
+        if self._parent is not None:
+            # A selection keeps the same node IDs from its refreshed fabric
+            self._parent.refresh(wait, timeout, incremental)
+            nodes = self._parent.nodes
+            self._nodes = dict((x, nodes[x]) for x in self._nodes
+                               if x in nodes)
+            return
+
+        key = (wait, timeout, incremental)
+        while True:
+            with self._refresh_lock:
+                flight = self._refreshes.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._refreshes[key] = Task(None)
+
+            if leader:
+                break
+
+            # Someone else is already doing this refresh, so wait for theirs
+            flight.join()
+            if flight.status == "Completed":
+                return
+            elif flight.status == "Failed":
+                raise flight.error
+            check_cancelled()  # Theirs was cancelled, so try again
+
+        try:
+            with self._discovery_lock:
+                self._discover(wait, timeout, incremental)
+        except Exception as err:
+            flight.set_error(err)
+            raise
+        else:
+            flight.set_result(None)
+        finally:
+            with self._refresh_lock:
+                del self._refreshes[key]
+            # If we were interrupted (KeyboardInterrupt and the like), the
+            # flight isn't finished yet. Cancel it so the followers retry.
+            flight.cancel()
+
+    def _discover(self, wait, timeout, incremental):
+        """Discover this fabric's nodes. Should only be called by refresh(),
+        with the discovery lock held.
+        """
+        def make_node(ip_address, node_id=None):
+            """Returns a new node object"""
+            node = self.node(
+                ip_address=ip_address, credentials=self.credentials,
                 tftp=self.tftp, ecme_tftp_port=self.ecme_tftp_port,
                 verbose=self.verbose
             )
-            ipinfo = root_node.get_fabric_ipinfo()
-            for node_id, node_address in ipinfo.items():
-                node = self.node(
-                    ip_address=node_address, credentials=self.credentials,
-                    tftp=self.tftp, ecme_tftp_port=self.ecme_tftp_port,
-                    verbose=self.verbose
-                )
+            if node_id != None:
                 node.node_id = node_id
-                new_nodes[node.guid] = node
-            return new_nodes
+            return node
+
+        def get_nodes():
+            """Returns a dictionary of nodes reported by the primary node IP"""
+            ipinfo = make_node(self.ip_address).get_fabric_ipinfo()
+
+            kept_nodes = {}
+            if incremental:
+                kept_nodes = dict(
+                    (x, self._nodes[x]) for x, y in ipinfo.items()
+                    if x in self._nodes and self._nodes[x].ip_address == y
+                )
+            new_nodes = dict((x, make_node(y, x)) for x, y in ipinfo.items()
+                             if not x in kept_nodes)
+
+            guids = self._get_guids(new_nodes)
+            guids.update((x, y.guid) for x, y in kept_nodes.iteritems())
+            new_nodes.update(kept_nodes)
+            if self.discovery_cache:
+                self.discovery_cache.save(self.ip_address, [
+                    {"node_id": x, "ip_address": y.ip_address,
+                     "guid": guids[x]} for x, y in new_nodes.iteritems()
+                ])
+            return dict((guids[x], y) for x, y in new_nodes.iteritems())
+
+        def get_cached_nodes():
+            """Returns a dictionary of nodes from the discovery cache, or
+            None if the cache is missing, expired or fails its spot check.
+            """
+            entries = self.discovery_cache.load(self.ip_address)
+            if not entries:
+                return None
+
+            new_nodes = dict((x["node_id"], make_node(x["ip_address"],
+                                                      x["node_id"]))
+                             for x in entries)
+            sample = self.discovery_cache.sample(self.ip_address, entries)
+            try:
+                guids = self._get_guids(dict(
+                    (x["node_id"], new_nodes[x["node_id"]]) for x in sample
+                ))
+            except CommandFailedError:
+                return None
+            if any(guids[x["node_id"]] != x["guid"] for x in sample):
+                return None
+
+            for entry in entries:
+                new_nodes[entry["node_id"]].guid = entry["guid"]
+            return dict((x["guid"], new_nodes[x["node_id"]])
+                        for x in entries)
 
         initial_node_count = len(self._nodes)
         old_nodes = {node.guid: node for node in self._nodes.values()}
@@ -242,16 +524,22 @@ class Fabric(object):
             )
             deadline = time.time() + timeout
             while time.time() < deadline:
+                check_cancelled()
                 try:
                     new_nodes = get_nodes()
                     if len(new_nodes) >= initial_node_count:
                         break
-                except (IpmiError, TftpException, ParseError) as err:
+                except (IpmiError, TftpException, ParseError,
+                        CommandFailedError) as err:
                     error = err
             else:
                 raise error
         else:
-            new_nodes = get_nodes()
+            new_nodes = None
+            if self.discovery_cache:
+                new_nodes = get_cached_nodes()
+            if new_nodes is None:
+                new_nodes = get_nodes()
 
         for guid, node in new_nodes.items():
             if guid in old_nodes:
@@ -260,6 +548,49 @@ class Fabric(object):
 
         self._nodes = {node.node_id: node for node in new_nodes.values()}
 
+    def _get_guids(self, nodes):
+        """Look up the GUIDs of these nodes in parallel, on the task queue.
+        At most DISCOVERY_CONCURRENCY lookups are in flight at once. When
+        called from a worker of the same task queue, they go on the
+        discovery queue instead.
+
+        :param nodes: Nodes to look up, by node ID.
+        :type nodes: dictionary
+
+        :returns: The GUID of each node, by node ID.
+        :rtype: dictionary
+
+        :raises CommandFailedError: If any lookups failed. Its results and
+                                    errors are keyed by node ID.
+
+        """
+        task_queue = self.task_queue
+        task = current_task()
+        # pylint: disable=W0212
+        if task is not None and task._task_queue is task_queue:
+            # Other workers may be blocked waiting on this refresh, so
+            # queueing the lookups behind them could deadlock.
+            task_queue = self._discovery_queue
+
+        limit = self.DISCOVERY_CONCURRENCY
+
+        pending = sorted(nodes.iteritems(), reverse=True)
+        tasks = {}
+        in_flight = set()
+        while pending or in_flight:
+            while pending and len(in_flight) < limit:
+                node_id, node = pending.pop()
+                tasks[node_id] = task_queue.put_task(
+                    Task(getattr, node, "guid"),
+                    lane=self.ip_address,
+                    rate_keys=self.get_rate_keys(node),
+                    timeout=self.command_timeout
+                )
+                in_flight.add(tasks[node_id])
+            in_flight = wait(in_flight, return_when=FIRST_COMPLETED)[1]
+
+        return gather(tasks)
+
     def get_mac_addresses(self):
         """Gets MAC addresses from all nodes.
 
@@ -286,6 +617,12 @@ class Fabric(object):
          2: {'eth0': 0, 'eth1': 0, 'mgmt': 0}
          3: {'eth0': 0, 'eth1': 0, 'mgmt': 0}}
 
+        .. note::
+            * This uses the primary node's fabric-wide uplink info (one TFTP
+              transfer) when its firmware provides it, and only asks the
+              nodes missing from it one by one.
+            * With async, every node is asked for its own uplink info.
+
         :param async: Flag that determines if the command result (dictionary)
                       is returned or a Task object (can get status, etc.).
         :type async: boolean
@@ -294,7 +631,10 @@ class Fabric(object):
         :rtype: dictionary
 
         """
-        return self._run_on_all_nodes(async, "get_uplink_info")
+        if async:
+            return self._run_on_all_nodes(async, "get_uplink_info")
+        return self._get_from_primary("get_fabric_uplink_info",
+                                      "get_uplink_info")
 
     def get_uplink_mode(self):
         """Gets the fabric uplink mode
@@ -632,7 +972,7 @@ class Fabric(object):
 
         return results
 
-    def get_firmware_info(self, async=False):
+    def get_firmware_info(self, async=False, fresh=False):
         """Gets the firmware info from all nodes.
 
         >>> fabric.get_firmware_info()
@@ -646,14 +986,17 @@ class Fabric(object):
         :param async: Flag that determines if the command result (dictionary)
                       is returned or a Command object (can get status, etc.).
         :type async: boolean
+        :param fresh: Read the partition tables from the nodes, even if they
+                      have cached copies.
+        :type fresh: boolean
 
         :return: THe firmware info for all nodes.
         :rtype: dictionary or `Task <tasks.html>`__
 
         """
-        return self._run_on_all_nodes(async, "get_firmware_info")
+        return self._run_on_all_nodes(async, "get_firmware_info", fresh)
 
-    def get_firmware_info_dict(self, async=False):
+    def get_firmware_info_dict(self, async=False, fresh=False):
         """Gets the firmware info from all nodes.
 
         >>> fabric.get_firmware_info_dict()
@@ -685,12 +1028,15 @@ class Fabric(object):
         :param async: Flag that determines if the command result (dictionary)
                       is returned or a Command object (can get status, etc.).
         :type async: boolean
+        :param fresh: Read the partition tables from the nodes, even if they
+                      have cached copies.
+        :type fresh: boolean
 
         :return: The firmware info for all nodes.
         :rtype: dictionary or `Task <tasks.html>`__
 
         """
-        return self._run_on_all_nodes(async, "get_firmware_info_dict")
+        return self._run_on_all_nodes(async, "get_firmware_info_dict", fresh)
 
     def is_updatable(self, package, partition_arg="INACTIVE", priority=None,
                      async=False):
@@ -819,6 +1165,28 @@ class Fabric(object):
         """
         return self._run_on_all_nodes(async, "get_pxe_interface")
 
+    def update_ubootenv(self, boot_args=None, interface=None, variables=None,
+                        async=False):
+        """Change several u-boot environment settings on all nodes, with a
+        single download and upload per node. Nodes where nothing would change
+        aren't written to.
+
+        >>> fabric.update_ubootenv(boot_args=['pxe', 'disk'], interface='eth1')
+
+        :param boot_args: Boot order to set.
+        :type boot_args: list
+        :param interface: PXE interface to set.
+        :type interface: string
+        :param variables: Raw environment variables to set.
+        :type variables: dictionary
+        :param async: Flag that determines if the command result (dictionary)
+                      is returned or a Command object (can get status, etc.).
+        :type async: boolean
+
+        """
+        self._run_on_all_nodes(async, "update_ubootenv", boot_args, interface,
+                               variables)
+
     def get_versions(self, async=False):
         """Gets the version info from all nodes.
 
@@ -1010,6 +1378,35 @@ class Fabric(object):
         """
         self.primary_node.bmc.fabric_config_update_config()
 
+    def get_config(self):
+        """Read the whole fabric configuration in one parallel pass.
+
+        >>> config = fabric.get_config()
+        >>> config.save("fabric.json")
+
+        :return: The fabric configuration.
+        :rtype: `FabricConfig <fabric_config.html>`_
+
+        """
+        return FabricConfig.fetch(self)
+
+    def apply_config(self, config):
+        """Bring the fabric configuration in line with a desired one. Only
+        settings that differ are sent, followed by a single update_config.
+
+        >>> fabric.apply_config(FabricConfig.load("golden.json"))
+        {'linkspeed': (2.5, 10.0)}
+
+        :param config: The desired configuration. Settings it leaves out are
+                       left alone.
+        :type config: `FabricConfig <fabric_config.html>`_
+
+        :return: The changes that were made, as (old, new) tuples.
+        :rtype: dictionary
+
+        """
+        return self.get_config().apply(self, config)
+
     def get_linkspeed(self):
         """Get the global linkspeed for the fabric. In the partition world
         this means the linkspeed for Configuration 0, Partition 0, Profile 0.
@@ -1300,24 +1697,215 @@ class Fabric(object):
         """
         return self._run_on_all_nodes(async, "get_depth_chart")
 
-    def _run_on_all_nodes(self, async, name, *args, **kwargs):
-        """Start a command on all nodes."""
+    def get_topology(self):
+        """Get a model of the fabric's links and routes. The linkmaps,
+        routing tables and depth charts are read from every node in one
+        parallel pass. Requires NumPy.
+
+        >>> topology = fabric.get_topology()
+        >>> topology.diameter()
+        2
+        >>> topology.missing_routes()
+        []
+
+        :returns: The fabric topology.
+        :rtype: `FabricTopology <topology.html>`_
+
+        :raises CommandFailedError: If any node failed to report its linkmap,
+                                    routing table or depth chart.
+
+        """
+        tasks = {}
+        for name in ("get_linkmap", "get_routing_table", "get_depth_chart"):
+            for node_id, task in self._run_on_all_nodes(
+                    True, name).iteritems():
+                tasks[(name, node_id)] = task
+
+        results = {
+            "get_linkmap": {}, "get_routing_table": {}, "get_depth_chart": {}
+        }
+        for (name, node_id), result in gather(tasks).iteritems():
+            results[name][node_id] = result
+
+        return FabricTopology(
+            results["get_linkmap"], results["get_routing_table"],
+            results["get_depth_chart"]
+        )
+
+    def map(self, fn, *args, **kwargs):
+        """Run a function on every node, in parallel on the task queue.
+        fn(node, *args, **kwargs) can be anything, e.g. several node
+        commands with some logic in between, so a multi-step workflow takes
+        one parallel pass over the fabric.
+
+        >>> def reset_if_old(node):
+        ...     if node.get_versions().firmware_version < "v2.0":
+        ...         node.mc_reset(wait=True)
+        ...         return True
+        ...     return False
+        ...
+        >>> fabric.map(reset_if_old)
+        {0: True, 1: False, 2: False, 3: True}
+
+        :param fn: Function to run on each node.
+        :type fn: function
+        :param args: Extra arguments for the function.
+        :param kwargs: Extra keyword arguments for the function.
+
+        :return: The function's result for each node.
+        :rtype: dictionary
+
+        :raises CommandFailedError: If the function failed on any nodes.
+
+        """
+        return gather(self.for_each(fn, *args, **kwargs))
+
+    def map_partial(self, fn, *args, **kwargs):
+        """Like map(), but return whatever results there are instead of
+        raising CommandFailedError when some nodes fail.
+
+        >>> results, errors = fabric.map_partial(reset_if_old)
+        >>> errors
+        {2: IpmiError('...')}
+
+        :param fn: Function to run on each node.
+        :type fn: function
+        :param args: Extra arguments for the function.
+        :param kwargs: Extra keyword arguments for the function.
+
+        :return: A (results, errors) tuple of dictionaries, by node ID.
+        :rtype: tuple
+
+        """
+        tasks = self.for_each(fn, *args, **kwargs)
+        outcomes = gather(tasks, return_exceptions=True)
+
+        results = {}
+        errors = {}
+        for node_id, outcome in outcomes.iteritems():
+            if tasks[node_id].status == "Completed":
+                results[node_id] = outcome
+            else:
+                errors[node_id] = outcome
+        return results, errors
+
+    def for_each(self, fn, *args, **kwargs):
+        """Start a function on every node, without waiting for it. See
+        map() for the arguments.
+
+        >>> tasks = fabric.for_each(reset_if_old)
+        >>> for node_id, task in as_completed(tasks):
+        ...     print node_id, task.status
+
+        :return: A task for each node.
+        :rtype: dictionary
+
+        """
+        lane = self.task_lane
         tasks = {}
         for node_id, node in self.nodes.iteritems():
-            tasks[node_id] = self.task_queue.put(getattr(node, name), *args,
-                                                 **kwargs)
+            tasks[node_id] = self.task_queue.put_task(
+                Task(fn, node, *args, **kwargs), lane=lane,
+                rate_keys=self.get_rate_keys(node),
+                timeout=self.command_timeout
+            )
+        return tasks
+
+    def iter_results(self, name, *args, **kwargs):
+        """Run a node command on all nodes, and yield each node's outcome as
+        soon as it finishes.
+
+        Unlike the other fabric commands, this doesn't hold on to every
+        node's result until the end, so results can be processed (or
+        stored) while other nodes are still working. If the caller stops
+        early, commands that haven't finished yet are cancelled.
+
+        >>> for node_id, result in fabric.iter_results("get_sensors"):
+        ...     if isinstance(result, Exception):
+        ...         print "Node %i failed: %s" % (node_id, result)
+        ...     else:
+        ...         store(node_id, result)
+
+        :param name: Name of the node method to run. May be dotted, as in
+                     "bmc.get_chassis_status".
+        :type name: string
+        :param args: Arguments for the method.
+        :param kwargs: Keyword arguments for the method.
+
+        :returns: A generator of (node_id, result) pairs. If the command
+                  failed on a node, its result is the exception.
+        :rtype: generator
+
+        """
+        tasks = self._run_on_all_nodes(True, name, *args, **kwargs)
+        try:
+            for node_id, task in as_completed(tasks):
+                del tasks[node_id]
+                if task.status == "Completed":
+                    item = (node_id, task.result)
+                else:
+                    item = (node_id, task.error)
+                # Let the result go once the caller is done with it
+                task.result = task.error = None
+                yield item
+        finally:
+            for task in tasks.itervalues():
+                task.cancel()
+
+    def _get_from_primary(self, bulk_name, name):
+        """Get per-node data with one fabric-wide command on the primary
+        node, then run a node command on any nodes that it left out. If the
+        firmware doesn't have the fabric-wide command, every node is asked.
+        """
+        nodes = self.nodes
+        try:
+            data = getattr(self.primary_node, bulk_name)()
+        except (IpmiError, TftpException, ParseError):
+            data = {}
+
+        results = dict((x, data[x]) for x in nodes if x in data)
+        missing = [x for x in nodes if not x in data]
+        if missing:
+            try:
+                results.update(self.select(missing)._run_on_all_nodes(
+                    False, name
+                ))
+            except CommandFailedError as err:
+                results.update(err.results)
+                raise CommandFailedError(results, err.errors)
+        return results
+
+    def _run_on_all_nodes(self, async, name, *args, **kwargs):
+        """Start a command on all nodes."""
+        if self.processes and self.processes > 1:
+            tasks = run_sharded(
+                self.nodes, name, args, kwargs, processes=self.processes,
+                threads=self.task_queue.threads,
+                rate_limits=self.task_queue.rate_limits,
+                rate_keys={"fabric": self.ip_address},
+                concurrency=self.task_queue.concurrency,
+                timeout=self.command_timeout
+            )
+        else:
+            if name in self.BULK_COMMANDS:
+                priority = PRIORITY_LOW
+            else:
+                priority = PRIORITY_NORMAL
+            lane = self.task_lane
+
+            tasks = {}
+            for node_id, node in self.nodes.iteritems():
+                target = node
+                for member in name.split("."):
+                    target = getattr(target, member)
+                tasks[node_id] = self.task_queue.put_task(
+                    Task(target, *args, **kwargs),
+                    priority=priority, lane=lane,
+                    rate_keys=self.get_rate_keys(node),
+                    timeout=self.command_timeout
+                )
 
         if async:
             return tasks
         else:
-            results = {}
-            errors = {}
-            for node_id, task in tasks.iteritems():
-                task.join()
-                if task.status == "Completed":
-                    results[node_id] = task.result
-                else:
-                    errors[node_id] = task.error
-            if errors:
-                raise CommandFailedError(results, errors)
-            return results
+            return gather(tasks)
@@ -0,0 +1,313 @@
+"""Calxeda: fabric_config.py"""
+
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+
+import json
+
+from cxmanage_api.tasks import Task, gather
+
+
+# Fabric-wide settings, as (name, getter, setter, setter keyword) tuples.
+# Each one is a single value on the fabric's primary node.
+SETTINGS = [
+    ("ipsrc", "get_ipsrc", "set_ipsrc", "ipsrc_mode"),
+    ("uplink_mode", "get_uplink_mode", "set_uplink_mode", "uplink_mode"),
+    ("linkspeed", "get_linkspeed", "set_linkspeed", "linkspeed"),
+    ("linkspeed_policy", "get_linkspeed_policy", "set_linkspeed_policy",
+     "ls_policy"),
+    ("link_users_factor", "get_link_users_factor", "set_link_users_factor",
+     "lu_factor"),
+    ("macaddr_base", "get_macaddr_base", "set_macaddr_base", "macaddr"),
+    ("macaddr_mask", "get_macaddr_mask", "set_macaddr_mask", "mask")
+]
+
+# Node network interfaces that have an uplink and a network assignment
+INTERFACES = (0, 1, 2)
+
+
+class FabricConfig(object):
+    """A snapshot of a fabric's configuration, that can be saved, compared
+    against a desired configuration, and applied to a fabric.
+
+    Settings are kept in a dictionary:
+
+    * One entry per fabric-wide setting (ipsrc, uplink_mode, linkspeed,
+      linkspeed_policy, link_users_factor, macaddr_base, macaddr_mask).
+    * "uplinks", mapping each interface to its uplink.
+    * "networks", mapping each network name to whether it's private.
+    * "network_uplinks", mapping each network name to a sorted list of the
+      uplinks it's assigned to.
+    * "network_assignments", mapping each interface to its network.
+
+    A desired configuration may leave settings out, and they'll be left
+    alone when it's applied.
+
+    >>> from cxmanage_api.fabric_config import FabricConfig
+    >>> golden = FabricConfig.load("golden.json")
+    >>> for fabric in fabrics:
+    ...     FabricConfig.fetch(fabric).apply(fabric, golden)
+
+    :param settings: Configuration settings.
+    :type settings: dictionary
+
+    """
+
+    def __init__(self, settings=None):
+        """Default constructor for the FabricConfig class."""
+        self.settings = dict(settings or {})
+
+    def __eq__(self, other):
+        return (isinstance(other, FabricConfig) and
+                self.settings == other.settings)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'FabricConfig(%r)' % self.settings
+
+    @classmethod
+    def fetch(cls, fabric):
+        """Read a fabric's configuration. The reads are sent in parallel, on
+        the fabric's task queue.
+
+        >>> config = FabricConfig.fetch(fabric)
+        >>> config.settings["linkspeed"]
+        2.5
+
+        :param fabric: The fabric to read from.
+        :type fabric: `Fabric <fabric.html>`_
+
+        :returns: The fabric's configuration.
+        :rtype: FabricConfig
+
+        :raises CommandFailedError: If any reads failed. Errors are keyed by
+                                    setting name, or (name, interface).
+
+        """
+        calls = dict((name, (getattr(fabric, getter),))
+                     for name, getter, _, _ in SETTINGS)
+        calls["networks"] = (fabric.get_networks,)
+        calls["network_uplinks"] = (fabric.get_uplinks,)
+        for interface in INTERFACES:
+            calls[("uplinks", interface)] = (fabric.get_uplink, interface)
+            calls[("network_assignments", interface)] = (
+                fabric.get_network_assignment, interface
+            )
+
+        rate_keys = fabric.get_rate_keys(fabric.primary_node)
+        results = gather(dict(
+            (x, fabric.task_queue.put_task(Task(*y), lane=fabric.task_lane,
+                                           rate_keys=rate_keys,
+                                           timeout=fabric.command_timeout))
+            for x, y in calls.iteritems()
+        ))
+
+        settings = {"uplinks": {}, "network_assignments": {}}
+        for key, value in results.iteritems():
+            if isinstance(key, tuple):
+                settings[key[0]][key[1]] = value
+            else:
+                settings[key] = value
+        settings["network_uplinks"] = _by_network(settings["network_uplinks"])
+        return cls(settings)
+
+    @classmethod
+    def load(cls, path):
+        """Load a configuration saved with save().
+
+        :param path: Path to the file.
+        :type path: string
+
+        :returns: The configuration.
+        :rtype: FabricConfig
+
+        """
+        with open(path) as config_file:
+            settings = json.load(config_file)
+
+        # JSON object keys are always strings, so interfaces need converting
+        for name in ["uplinks", "network_assignments"]:
+            if name in settings:
+                settings[name] = dict((int(x), y) for x, y in
+                                      settings[name].iteritems())
+        return cls(_to_str(settings))
+
+    def save(self, path):
+        """Save this configuration to a JSON file.
+
+        :param path: Path to the file.
+        :type path: string
+
+        """
+        with open(path, "w") as config_file:
+            json.dump(self.settings, config_file, indent=4, sort_keys=True)
+
+    def diff(self, desired):
+        """Compare this configuration against a desired one.
+
+        >>> current.diff(golden)
+        {'linkspeed': (2.5, 10.0), 'uplinks': ({0: 0, 1: 0}, {0: 0, 1: 1})}
+
+        :param desired: The desired configuration.
+        :type desired: FabricConfig
+
+        :returns: A (current, desired) tuple for each setting that differs.
+                  For uplinks, networks and network_assignments, only the
+                  entries that differ are included.
+        :rtype: dictionary
+
+        """
+        changes = {}
+        for name, value in desired.settings.iteritems():
+            current = self.settings.get(name)
+            if isinstance(value, dict):
+                current = current or {}
+                keys = [x for x in set(value) | set(current)
+                        if current.get(x) != value.get(x)]
+                if name != "networks":
+                    keys = [x for x in keys if x in value]
+                if keys:
+                    changes[name] = (
+                        dict((x, current[x]) for x in keys if x in current),
+                        dict((x, value[x]) for x in keys if x in value)
+                    )
+            elif current != value:
+                changes[name] = (current, value)
+        return changes
+
+    def apply(self, fabric, desired):
+        """Apply the settings of a desired configuration that differ from
+        this one (which should be the fabric's current configuration), then
+        push them out with a single update_config.
+
+        Networks in the current configuration but not the desired one are
+        removed, and networks are added before interfaces are assigned to
+        them. A network whose private flag changes has to be removed and
+        added again, so its uplinks and interfaces are assigned to it again
+        afterwards. Nothing is sent if there are no differences.
+
+        >>> current = FabricConfig.fetch(fabric)
+        >>> current.apply(fabric, golden)
+        {'linkspeed': (2.5, 10.0)}
+
+        :param fabric: The fabric to configure.
+        :type fabric: `Fabric <fabric.html>`_
+        :param desired: The desired configuration.
+        :type desired: FabricConfig
+
+        :returns: The changes that were applied, as from diff().
+        :rtype: dictionary
+
+        """
+        changes = self.diff(desired)
+        if not changes:
+            return changes
+
+        for name, _, setter, keyword in SETTINGS:
+            if name in changes:
+                getattr(fabric, setter)(**{keyword: changes[name][1]})
+
+        readded = set()
+        if "networks" in changes:
+            current, wanted = changes["networks"]
+            for network in sorted(current):
+                if not network in wanted:
+                    fabric.remove_network(network)
+            for network, private in sorted(wanted.iteritems()):
+                if network in current:
+                    fabric.remove_network(network)
+                    readded.add(network)
+                fabric.add_network(network, private)
+
+        current, wanted = changes.get("network_uplinks", ({}, {}))
+        current, wanted = dict(current), dict(wanted)
+        if readded:
+            if "network_uplinks" in self.settings:
+                previous = self.settings["network_uplinks"]
+            else:
+                previous = _by_network(fabric.get_uplinks())
+            for network in readded:
+                current[network] = []
+                wanted.setdefault(network, previous.get(network, []))
+        for network, uplinks in sorted(wanted.iteritems()):
+            for uplink in current.get(network) or []:
+                if not uplink in uplinks:
+                    fabric.unassign_network_from_uplink(network, uplink)
+            for uplink in uplinks:
+                if not uplink in (current.get(network) or []):
+                    fabric.assign_network_to_uplink(network, uplink)
+
+        if "uplinks" in changes:
+            for interface, uplink in sorted(changes["uplinks"][1].items()):
+                fabric.set_uplink(uplink=uplink, iface=interface)
+
+        assignments = dict(changes.get("network_assignments", ({}, {}))[1])
+        for interface, network in self.settings.get("network_assignments",
+                                                    {}).iteritems():
+            if network in readded:
+                assignments.setdefault(interface, network)
+        for interface, network in sorted(assignments.items()):
+            fabric.assign_interface_to_network(interface, network)
+
+        fabric.update_config()
+        for name, value in desired.settings.iteritems():
+            if isinstance(value, dict) and name != "networks":
+                self.settings.setdefault(name, {}).update(value)
+            else:
+                self.settings[name] = value
+        return changes
+
+
+def _by_network(uplinks):
+    """Turn get_uplinks() results, a list of networks for each uplink, into
+    a sorted list of uplinks for each network."""
+    networks = {}
+    for uplink, names in uplinks.iteritems():
+        for name in names:
+            networks.setdefault(name, []).append(uplink)
+    return dict((x, sorted(y)) for x, y in networks.iteritems())
+
+
+def _to_str(value):
+    """Turn the unicode strings that json gives back into plain strings."""
+    if isinstance(value, unicode):
+        return str(value)
+    elif isinstance(value, dict):
+        return dict((_to_str(x), _to_str(y)) for x, y in value.iteritems())
+    elif isinstance(value, list):
+        return [_to_str(x) for x in value]
+    return value
+
+
+# End of file: ./fabric_config.py
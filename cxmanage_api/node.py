@@ -33,11 +33,15 @@
 """Calxeda: node.py"""
 
 import os
+import copy
 import re
 import time
 import tempfile
 import socket
 import subprocess
+from contextlib import contextmanager
+from threading import Lock, Thread
+from Queue import Queue, Empty
 
 from distutils.version import LooseVersion
 from pyipmi import make_bmc, IpmiError
@@ -50,7 +54,8 @@ from cxmanage_api.tftp import InternalTftp, ExternalTftp
 from cxmanage_api.image import Image as IMAGE
 from cxmanage_api.ubootenv import UbootEnv as UBOOTENV
 from cxmanage_api.ip_retriever import IPRetriever as IPRETRIEVER
-from cxmanage_api.decorators import retry
+from cxmanage_api.decorators import retry, coalesce
+from cxmanage_api.tasks import Task, check_cancelled
 from cxmanage_api.credentials import Credentials
 from cxmanage_api.cx_exceptions import TimeoutError, NoSensorError, \
         SocmanVersionError, FirmwareConfigError, PriorityIncrementError, \
@@ -83,6 +88,20 @@ class Node(object):
     :type ubootenv: `UbootEnv <ubootenv.html>`_
 
     """
+    # Seconds that a partition table read by get_firmware_info() stays valid.
+    # Firmware writes and resets through this node drop it, and the cached
+    # u-boot environment, sooner.
+    FIRMWARE_INFO_TTL = 30
+
+    # Seconds to remember which TFTP transport (the ECME's own TFTP server,
+    # or our "host" TFTP server) last worked for this node. Transfers go
+    # straight to that one, and only fall back to the other if it fails.
+    TRANSPORT_AFFINITY_TTL = 300
+
+    # Race both TFTP transports on reads and use whichever finishes first.
+    # Uploads are never raced.
+    RACE_TRANSPORTS = False
+
     # pylint: disable=R0913
     def __init__(self, ip_address, credentials=None, tftp=None,
                  ecme_tftp_port=5001, verbose=False, bmc=None, image=None,
@@ -118,6 +137,12 @@ class Node(object):
         self._node_id = None
         self._guid = None
 
+        self._firmware_info = None
+        self._ubootenv = None
+        self._transport = None
+        self._cache_lock = Lock()
+        self._cache_generation = 0
+
     def __eq__(self, other):
         return isinstance(other, Node) and self.ip_address == other.ip_address
 
@@ -181,6 +206,16 @@ class Node(object):
         """
         self._node_id = value
 
+    @guid.setter
+    def guid(self, value):
+        """ Sets the GUID for this node, e.g. from a discovery cache.
+
+        :param value: The value we want to set.
+        :type value: string
+
+        """
+        self._guid = value
+
     def refresh(self, new_node):
         """ Updates mutable properties for this node, based from another node
         object.
@@ -196,6 +231,9 @@ class Node(object):
             raise NodeMismatchError(
                 'Passed in node does not match node to be updated'
             )
+        if new_node.ip_address != self.ip_address:
+            # Anything cached may have come from whatever was at the old IP
+            self._invalidate_caches()
         self.ip_address = new_node.ip_address
         self.node_id = new_node.node_id
 
@@ -248,6 +286,7 @@ communication.
         """
         self.bmc.fabric_rm_macaddr(iface=iface, macaddr=macaddr)
 
+    @coalesce
     def get_power(self):
         """Returns the power status for this node.
 
@@ -291,6 +330,7 @@ communication.
                 return
         self.bmc.set_chassis_power(mode=mode)
 
+    @coalesce
     def get_power_policy(self):
         """Return power status reported by IPMI.
 
@@ -333,16 +373,23 @@ communication.
         :raises IPMIError: If there is an IPMI error communicating with the BMC.
 
         """
+        # Invalidate on both sides of the reset, so a read that was already
+        # in flight can't cache what the node reported before it
+        self._invalidate_caches()
         self.bmc.mc_reset("cold")
+        self._invalidate_caches()
 
         if wait:
             deadline = time.time() + 300.0
 
             # Wait for it to go down...
-            time.sleep(60)
+            for _ in xrange(60):
+                check_cancelled()
+                time.sleep(1)
 
             # Now wait to come back up!
             while time.time() < deadline:
+                check_cancelled()
                 time.sleep(1)
                 try:
                     self.bmc.get_info_basic()
@@ -351,6 +398,7 @@ communication.
                     pass
             else:
                 raise Exception("Reset timed out")
+            self._invalidate_caches()
 
     def get_sel(self):
         """Get the system event log for this node.
@@ -375,6 +423,7 @@ Initiated by power up | Asserted',
         """
         return self.bmc.sel_elist()
 
+    @coalesce
     def get_sensors(self, search=""):
         """Get a list of sensor objects that match search criteria.
 
@@ -563,7 +612,7 @@ Initiated by power up | Asserted',
         return dict((key, vars(value))
                     for key, value in self.get_sensors(search=search).items())
 
-    def get_firmware_info(self):
+    def get_firmware_info(self, fresh=False):
         """Gets firmware info for each partition on the Node.
 
         >>> node.get_firmware_info()
@@ -571,6 +620,15 @@ Initiated by power up | Asserted',
         <pyipmi.fw.FWInfo object at 0x2019b10>,
         <pyipmi.fw.FWInfo object at 0x2019610>, ...]
 
+        .. note::
+            * The partition table is cached for FIRMWARE_INFO_TTL seconds,
+              and dropped whenever this node writes firmware or resets.
+            * Concurrent reads of the partition table share one IPMI command.
+
+        :param fresh: Read the partition table from the node, even if there's
+                      a cached copy.
+        :type fresh: boolean
+
         :return: Returns a list of FWInfo objects for each
         :rtype: list
 
@@ -578,17 +636,22 @@ Initiated by power up | Asserted',
 communication.
 
         """
-        fwinfo = [x for x in self.bmc.get_firmware_info()
-                  if hasattr(x, "partition")]
+        with self._cache_lock:
+            cached = self._firmware_info
+            generation = self._cache_generation
 
-        # Clean up the fwinfo results
-        for entry in fwinfo:
-            if (entry.version == ""):
-                entry.version = "Unknown"
+        if (fresh or cached is None or
+                time.time() - cached[0] > self.FIRMWARE_INFO_TTL):
+            cached = self._read_firmware_info(generation)
 
-        return fwinfo
+            # Don't store it if something invalidated the cache meanwhile
+            with self._cache_lock:
+                if generation == self._cache_generation:
+                    self._firmware_info = cached
 
-    def get_firmware_info_dict(self):
+        return [copy.copy(x) for x in cached[1]]
+
+    def get_firmware_info_dict(self, fresh=False):
         """Gets firmware info for each partition on the Node.
 
         .. note::
@@ -622,6 +685,10 @@ communication.
              'size'      : '00005000'}
         ]
 
+        :param fresh: Read the partition table from the node, even if there's
+                      a cached copy.
+        :type fresh: boolean
+
         :return: Returns a list of FWInfo objects for each
         :rtype: list
 
@@ -629,7 +696,7 @@ communication.
 communication.
 
         """
-        return [vars(info) for info in self.get_firmware_info()]
+        return [vars(info) for info in self.get_firmware_info(fresh)]
 
     def is_updatable(self, package, partition_arg="INACTIVE", priority=None):
         """Checks to see if the node can be updated with this firmware package.
@@ -802,7 +869,7 @@ communication.
             self.bmc.set_firmware_version(package.version)
 
         # Post verify
-        fwinfo = self.get_firmware_info()
+        fwinfo = self.get_firmware_info(fresh=True)
         for old_partition in updated_partitions:
             partition_id = int(old_partition.partition)
             new_partition = fwinfo[partition_id]
@@ -925,6 +992,8 @@ updating the EEPROM
 communication.
 
         """
+        self._invalidate_caches()
+
         # Clear CDB. Retry it up to 3 times.
         for _ in range(2):
             try:
@@ -936,6 +1005,7 @@ communication.
                 time.sleep(5)  # pausing between retries seems to help a little
         else:
             self.bmc.reset_firmware()
+        self._invalidate_caches()
 
         # Reset ubootenv
         try:
@@ -960,23 +1030,7 @@ communication.
         :type boot_args: list
 
         """
-        fwinfo = self.get_firmware_info()
-        first_part = self._get_partition(fwinfo, "UBOOTENV", "FIRST")
-        active_part = self._get_partition(fwinfo, "UBOOTENV", "ACTIVE")
-
-        # Download active ubootenv, modify, then upload to first partition
-        image = self._download_image(active_part)
-        ubootenv = self.ubootenv(open(image.filename).read())
-        ubootenv.set_boot_order(boot_args)
-        priority = max(int(x.priority, 16) for x in [first_part, active_part])
-
-        filename = temp_file()
-        with open(filename, "w") as file_:
-            file_.write(ubootenv.get_contents())
-
-        ubootenv_image = self.image(filename, image.type, False, image.daddr,
-                                    image.skip_crc32, image.version)
-        self._upload_image(ubootenv_image, first_part, priority)
+        self.update_ubootenv(boot_args=boot_args)
 
     def get_boot_order(self):
         """Returns the boot order for this node.
@@ -996,23 +1050,7 @@ communication.
         :type boot_args: string
 
         """
-        fwinfo = self.get_firmware_info()
-        first_part = self._get_partition(fwinfo, "UBOOTENV", "FIRST")
-        active_part = self._get_partition(fwinfo, "UBOOTENV", "ACTIVE")
-
-        # Download active ubootenv, modify, then upload to first partition
-        image = self._download_image(active_part)
-        ubootenv = self.ubootenv(open(image.filename).read())
-        ubootenv.set_pxe_interface(interface)
-        priority = max(int(x.priority, 16) for x in [first_part, active_part])
-
-        filename = temp_file()
-        with open(filename, "w") as file_:
-            file_.write(ubootenv.get_contents())
-
-        ubootenv_image = self.image(filename, image.type, False, image.daddr,
-                                    image.skip_crc32, image.version)
-        self._upload_image(ubootenv_image, first_part, priority)
+        self.update_ubootenv(interface=interface)
 
     def get_pxe_interface(self):
         """Returns the current pxe interface for this node.
@@ -1022,6 +1060,7 @@ communication.
         """
         return self.get_ubootenv().get_pxe_interface()
 
+    @coalesce
     def get_versions(self):
         """Get version info from this node.
 
@@ -1167,14 +1206,84 @@ communication.
         >>> node.get_ubootenv()
         <cxmanage_api.ubootenv.UbootEnv instance at 0x209da28>
 
+        .. note::
+            * The last environment downloaded is kept, and used again as long
+              as the active partition's priority, flags and version are
+              unchanged.
+
         :return: U-Boot Environment object.
         :rtype: `UBootEnv <ubootenv.html>`_
 
         """
         fwinfo = self.get_firmware_info()
         partition = self._get_partition(fwinfo, "UBOOTENV", "ACTIVE")
-        image = self._download_image(partition)
-        return self.ubootenv(open(image.filename).read())
+        return self._get_ubootenv(partition)
+
+    @contextmanager
+    def edit_ubootenv(self):
+        """Edit the u-boot environment. Any number of changes made inside the
+        with block are written back together, in one upload to the first
+        UBOOTENV partition. If the block raises an exception, nothing is
+        written. If nothing changed, the upload is skipped.
+
+        >>> with node.edit_ubootenv() as ubootenv:
+        ...     ubootenv.set_boot_order(["pxe", "disk"])
+        ...     ubootenv.set_pxe_interface("eth1")
+        ...     ubootenv.variables["bootdelay"] = "3"
+
+        :return: U-Boot Environment object to modify.
+        :rtype: `UBootEnv <ubootenv.html>`_
+
+        """
+        fwinfo = self.get_firmware_info()
+        first_part = self._get_partition(fwinfo, "UBOOTENV", "FIRST")
+        active_part = self._get_partition(fwinfo, "UBOOTENV", "ACTIVE")
+
+        ubootenv = self._get_ubootenv(active_part)
+        variables = dict(ubootenv.variables)
+
+        yield ubootenv
+
+        # The first partition only needs writing if it's the one that's
+        # active, and its contents would change
+        if (first_part.partition == active_part.partition and
+                ubootenv.variables == variables):
+            return
+
+        priority = max(int(x.priority, 16) for x in [first_part, active_part])
+
+        filename = temp_file()
+        with open(filename, "w") as file_:
+            file_.write(ubootenv.get_contents())
+
+        image_type = active_part.type.split()[1][1:-1]
+        ubootenv_image = self.image(filename, image_type, False,
+                                    int(active_part.daddr, 16),
+                                    version=active_part.version)
+        self._upload_image(ubootenv_image, first_part, priority)
+
+    def update_ubootenv(self, boot_args=None, interface=None, variables=None):
+        """Change several u-boot environment settings at once, with a single
+        download and upload. The upload is skipped if nothing changed.
+
+        >>> node.update_ubootenv(boot_args=["pxe", "disk"], interface="eth1",
+        ...                      variables={"bootdelay": "3"})
+
+        :param boot_args: Boot order to set.
+        :type boot_args: list
+        :param interface: PXE interface to set.
+        :type interface: string
+        :param variables: Raw environment variables to set.
+        :type variables: dictionary
+
+        """
+        with self.edit_ubootenv() as ubootenv:
+            if boot_args is not None:
+                ubootenv.set_boot_order(boot_args)
+            if interface is not None:
+                ubootenv.set_pxe_interface(interface)
+            if variables:
+                ubootenv.variables.update(variables)
 
     @retry(3, allowed_errors=(IpmiError, TftpException, ParseError))
     def get_fabric_ipinfo(self, allow_errors=False):
@@ -1307,21 +1416,28 @@ communication.
 
         :raises IpmiError: If the IPMI command fails.
         :raises TftpException: If the TFTP transfer fails.
+        :raises ParseError: If we fail to parse uplink info
 
         """
         contents = self.run_fabric_tftp_command(
             function_name='fabric_config_get_uplink_info'
         )
 
-        # Parse addresses from ipinfo file
+        # Parse uplinks from uplink info file, one "Node N: iface U, ..."
+        # line per node
         results = {}
         for line in contents.splitlines():
-            node_id = int(line.replace('Node ', '')[0])
-            ul_info = line.replace('Node %s:' % node_id, '').strip().split(',')
-            node_data = {}
-            for ul_ in ul_info:
-                data = tuple(ul_.split())
-                node_data[data[0]] = int(data[1])
+            if not line.strip():
+                continue
+            try:
+                node_id, ul_info = line.split(':', 1)
+                node_id = int(node_id.replace('Node', '').strip())
+                node_data = {}
+                for ul_ in ul_info.split(','):
+                    data = tuple(ul_.split())
+                    node_data[data[0]] = int(data[1])
+            except (IndexError, ValueError):
+                raise ParseError("Failed to parse uplink info\n%s" % contents)
             results[node_id] = node_data
 
         return results
@@ -1635,23 +1751,29 @@ obtained.
         :rtype: string
 
         """
-        filename = temp_file()
-        basename = os.path.basename(filename)
-        try:
-            getattr(self.bmc, function_name)(filename=basename, **kwargs)
+        function = getattr(self.bmc, function_name)
+
+        def ecme():
+            """Have the ECME serve the file on its own TFTP server."""
+            filename = temp_file()
+            basename = os.path.basename(filename)
+            function(filename=basename, **kwargs)
             self.ecme_tftp.get_file(basename, filename)
+            return filename
 
-        except (IpmiError, TftpException):
-            getattr(self.bmc, function_name)(
-                filename=basename,
-                tftp_addr=self.tftp_address,
-                **kwargs
-            )
+        def host():
+            """Have the ECME send the file to our TFTP server."""
+            filename = temp_file()
+            basename = os.path.basename(filename)
+            function(filename=basename, tftp_addr=self.tftp_address, **kwargs)
 
             deadline = time.time() + 10
+            delay = 0.1
             while (time.time() < deadline):
+                check_cancelled()
                 try:
-                    time.sleep(1)
+                    time.sleep(delay)
+                    delay = min(delay * 2, 1.0)
                     self.tftp.get_file(src=basename, dest=filename)
                     if (os.path.getsize(filename) > 0):
                         break
@@ -1660,7 +1782,9 @@ obtained.
 
             if os.path.getsize(filename) == 0:
                 raise TftpException("Node failed to reach TFTP server")
+            return filename
 
+        filename = self._transfer(ecme, host, self.RACE_TRANSPORTS)
         return open(filename, "rb").read()
 
     @staticmethod
@@ -1723,53 +1847,220 @@ obtained.
         filename = image.render_to_simg(priority, daddr)
         basename = os.path.basename(filename)
 
-        for _ in xrange(2):
-            try:
-                self.bmc.register_firmware_write(
-                    basename,
-                    partition_id,
-                    image.type
-                )
-                self.ecme_tftp.put_file(filename, basename)
-                break
-            except (IpmiError, TftpException):
-                pass
-        else:
-            # Fall back and use TFTP server
+        def ecme():
+            """Write the image to the ECME's own TFTP server."""
+            self.bmc.register_firmware_write(
+                basename,
+                partition_id,
+                image.type
+            )
+            self.ecme_tftp.put_file(filename, basename)
+
+        def host():
+            """Have the ECME fetch the image from our TFTP server."""
             self.tftp.put_file(filename, basename)
             result = self.bmc.update_firmware(basename, partition_id,
                     image.type, self.tftp_address)
             self._wait_for_transfer(result.tftp_handle_id)
 
+        # Two writes to the same partition at once would be unsafe, so
+        # uploads never race
+        self._transfer(ecme, host)
+
         # Verify crc and activate
+        self._invalidate_caches()
         self.bmc.check_firmware(partition_id)
         self.bmc.activate_firmware(partition_id)
+        self._invalidate_caches()
+
+    def _get_ubootenv(self, partition):
+        """Get the u-boot environment in a partition, downloading it unless
+        the cached copy came from the same partition metadata."""
+        with self._cache_lock:
+            cached = self._ubootenv
+            generation = self._cache_generation
+
+        key = (partition.partition, partition.priority, partition.flags,
+               partition.version)
+
+        if cached is None or cached[0] != key:
+            image = self._download_image(partition)
+            cached = (key, open(image.filename).read())
+
+            with self._cache_lock:
+                if generation == self._cache_generation:
+                    self._ubootenv = cached
+
+        return self.ubootenv(cached[1])
+
+    def _transfer(self, ecme, host, race=False):
+        """Run a TFTP transfer, given functions that do it through the ECME's
+        own TFTP server and through ours. The transport that last worked for
+        this node is tried first (the ECME's gets a second try, as before),
+        then the other one. Whichever works is remembered.
+
+        If race is set, both run at once and the first to finish wins. Only
+        use that for reads.
+
+        """
+        if race:
+            return self._race_transfer(ecme, host)
+
+        transports = {"ecme": ecme, "host": host}
+        if self._get_transport() == "host":
+            order = ["host", "ecme"]
+        else:
+            order = ["ecme", "ecme", "host"]
+
+        for i, transport in enumerate(order):
+            try:
+                result = transports[transport]()
+            except (IpmiError, TftpException, TransferFailure, TimeoutError):
+                if i == len(order) - 1:
+                    self._transport = None
+                    raise
+                continue
+            self._set_transport(transport)
+            return result
+
+    def _race_transfer(self, ecme, host):
+        """Run a TFTP transfer through both transports at once, and return
+        the result of the first to succeed. The loser is asked to stop, and
+        if it finishes anyway its downloaded file is removed.
+
+        If we already know which transport works for this node, there's
+        nothing to race for, so that one is just tried first as usual.
+
+        """
+        if self._get_transport() is not None:
+            return self._transfer(ecme, host)
+
+        results = Queue()
+        lock = Lock()
+        state = {"winner": None, "closed": False, "returned": False}
+
+        def discard(task):
+            """Throw away a transfer that finished too late to be used."""
+            result = task.get_result() if task.status == "Completed" else None
+            if isinstance(result, basestring) and os.path.exists(result):
+                os.remove(result)
+
+        def finished(task):
+            """Hand a finished transfer to the caller, or discard it."""
+            with lock:
+                late = state["closed"] or state["winner"] is not None
+                if not late and task.status == "Completed":
+                    state["winner"] = task
+            if late:
+                discard(task)
+            else:
+                results.put(task)
+
+        tasks = {"ecme": Task(ecme), "host": Task(host)}
+        for task in tasks.values():
+            task.add_done_callback(finished)
+            # pylint: disable=W0212
+            thread = Thread(target=task._run)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            error = None
+            for _ in xrange(2):
+                while True:
+                    check_cancelled()
+                    try:
+                        task = results.get(timeout=1)
+                        break
+                    except Empty:
+                        pass
+                if task is state["winner"]:
+                    for transport, other in tasks.iteritems():
+                        if other is task:
+                            self._set_transport(transport)
+                    state["returned"] = True
+                    return task.get_result()
+                error = task.get_error()
+        finally:
+            with lock:
+                state["closed"] = True
+            for task in tasks.values():
+                task.cancel()
+            if state["winner"] is not None and not state["returned"]:
+                discard(state["winner"])
+
+        self._transport = None
+        raise error
+
+    def _after_fork(self):
+        """Replace this node's lock. Should only be called in a child
+        process right after fork, where the lock may have been held by one
+        of the parent's other threads."""
+        self._cache_lock = Lock()
+
+    def _get_transport(self):
+        """Get the TFTP transport that last worked, if it hasn't expired."""
+        transport = self._transport
+        if transport is not None and transport[1] > time.time():
+            return transport[0]
+        return None
+
+    def _set_transport(self, transport):
+        """Remember the TFTP transport that worked."""
+        expires = time.time() + self.TRANSPORT_AFFINITY_TTL
+        self._transport = (transport, expires)
+
+    @coalesce
+    def _read_firmware_info(self, generation):
+        """Read the partition table from the node. Reads are only shared
+        within the same cache generation, so a read that started before a
+        firmware write is never handed to a caller that came after it."""
+        # pylint: disable=W0613
+        fwinfo = [x for x in self.bmc.get_firmware_info()
+                  if hasattr(x, "partition")]
+
+        # Clean up the fwinfo results
+        for entry in fwinfo:
+            if (entry.version == ""):
+                entry.version = "Unknown"
+
+        return (time.time(), [copy.copy(x) for x in fwinfo])
+
+    def _invalidate_caches(self):
+        """Drop the cached partition table and u-boot environment."""
+        with self._cache_lock:
+            self._firmware_info = None
+            self._ubootenv = None
+            self._cache_generation += 1
 
     def _download_image(self, partition):
         """Download an image from the target."""
-        filename = temp_file()
-        basename = os.path.basename(filename)
         partition_id = int(partition.partition)
         image_type = partition.type.split()[1][1:-1]
 
-        for _ in xrange(2):
-            try:
-                self.bmc.register_firmware_read(
-                    basename,
-                    partition_id,
-                    image_type
-                )
-                self.ecme_tftp.get_file(basename, filename)
-                break
-            except (IpmiError, TftpException):
-                pass
-        else:
-            # Fall back and use TFTP server
+        def ecme():
+            """Read the image from the ECME's own TFTP server."""
+            filename = temp_file()
+            basename = os.path.basename(filename)
+            self.bmc.register_firmware_read(
+                basename,
+                partition_id,
+                image_type
+            )
+            self.ecme_tftp.get_file(basename, filename)
+            return filename
+
+        def host():
+            """Have the ECME send the image to our TFTP server."""
+            filename = temp_file()
+            basename = os.path.basename(filename)
             result = self.bmc.retrieve_firmware(basename, partition_id,
                     image_type, self.tftp_address)
             self._wait_for_transfer(result.tftp_handle_id)
             self.tftp.get_file(basename, filename)
+            return filename
 
+        filename = self._transfer(ecme, host, self.RACE_TRANSPORTS)
         return self.image(filename=filename, image_type=image_type,
                           daddr=int(partition.daddr, 16),
                           version=partition.version)
@@ -1777,12 +2068,15 @@ obtained.
     def _wait_for_transfer(self, handle):
         """Wait for a firmware transfer to finish."""
         deadline = time.time() + 180
+        delay = 0.1
         result = self.bmc.get_firmware_status(handle)
 
         while (result.status == "In progress"):
             if (time.time() >= deadline):
                 raise TimeoutError("Transfer timed out after 3 minutes")
-            time.sleep(1)
+            check_cancelled()
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
             result = self.bmc.get_firmware_status(handle)
 
         if (result.status != "Complete"):
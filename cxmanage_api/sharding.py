@@ -0,0 +1,274 @@
+"""Calxeda: sharding.py"""
+
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+
+import signal
+import cPickle as pickle
+from multiprocessing import Pool, cpu_count
+from threading import Lock, Thread
+
+from cxmanage_api import decorators
+from cxmanage_api.tasks import DEFAULT_TASK_QUEUE, TaskQueue, Task
+from cxmanage_api.cx_exceptions import ShardError
+
+
+# Work for the next pool of worker processes. It's set just before the pool
+# forks, so the workers inherit the nodes instead of having them pickled.
+_FORK_LOCK = Lock()
+_JOB = None
+
+# Each worker process's own TaskQueue
+_TASK_QUEUE = None
+
+
+def run_sharded(nodes, name, args=(), kwargs=None, processes=None,
+                threads=48, delay=0, rate_limits=None, rate_keys=None,
+                timeout=None, chunks_per_process=4, concurrency=None):
+    """Run a node command across a pool of worker processes.
+
+    The nodes are split into shards, and each worker process runs its shards
+    on a TaskQueue of its own. This spreads Python-side work (parsing,
+    SIMG/CRC handling) across CPU cores. Each node gets a task that finishes
+    when its outcome comes back from the workers, so the results can be
+    collected just like those of ordinary tasks.
+
+    Commands run on the workers' copies of the nodes, so any state they
+    change on a node (such as cached values) stays in the worker process.
+    Errors and results that can't be pickled come back as ShardErrors.
+
+    The worker processes are forked from this one, on every call, while
+    other threads may be running commands. A lock that one of them holds
+    at that moment stays held in the workers, so each worker starts by
+    replacing the locks that cxmanage_api knows about: coalesced calls,
+    the nodes' caches and the default task queue. Locks of your own (or
+    of other libraries) aren't covered, so don't call this while other
+    threads might be holding ones the nodes need.
+
+    >>> from cxmanage_api.sharding import run_sharded
+    >>> from cxmanage_api.tasks import gather
+    >>> gather(run_sharded(nodes, "get_power", processes=4))
+    [False, False, False, False]
+
+    :param nodes: The nodes to run the command on.
+    :type nodes: list or dictionary
+    :param name: Name of the node method to run. May be dotted, as in
+                 "bmc.get_chassis_status".
+    :type name: string
+    :param args: Arguments for the method.
+    :type args: tuple
+    :param kwargs: Keyword arguments for the method.
+    :type kwargs: dictionary
+    :param processes: Number of worker processes. Defaults to the number of
+                      CPUs.
+    :type processes: integer
+    :param threads: Total number of worker threads, split across processes.
+    :type threads: integer
+    :param delay: Per thread delay before each command.
+    :type delay: float
+    :param rate_limits: Token bucket settings (see TaskQueue). The "global"
+                        rate is split across processes.
+    :type rate_limits: dictionary
+    :param rate_keys: Extra rate limiting keys for every command, on top of
+                      {"node": ip_address}.
+    :type rate_keys: dictionary
+    :param timeout: Seconds each command has to finish.
+    :type timeout: float
+    :param chunks_per_process: Shards per process. More shards means
+                               results trickle back sooner.
+    :type chunks_per_process: integer
+    :param concurrency: Adaptive concurrency settings (see TaskQueue). Each
+                        process adapts its own limits.
+    :type concurrency: dictionary
+
+    :returns: A task for each node, in a list in the same order as nodes,
+              or as a dictionary with the same keys.
+    :rtype: list or dictionary
+
+    """
+    global _JOB   # pylint: disable=W0603
+
+    if isinstance(nodes, dict):
+        keys = nodes.keys()
+        node_list = [nodes[x] for x in keys]
+    else:
+        keys = None
+        node_list = list(nodes)
+
+    tasks = [Task(None) for _ in node_list]
+    if keys is None:
+        result = tasks
+    else:
+        result = dict(zip(keys, tasks))
+    if not node_list:
+        return result
+
+    if processes is None:
+        processes = cpu_count()
+    processes = max(1, min(processes, len(node_list)))
+    queue_kwargs = dict(
+        threads=max(1, -(-threads // processes)),
+        delay=delay,
+        rate_limits=_split_rate_limits(rate_limits, processes),
+        concurrency=concurrency
+    )
+    job = (node_list, name, tuple(args), dict(kwargs or {}),
+           dict(rate_keys or {}), timeout, queue_kwargs)
+
+    with _FORK_LOCK:
+        _JOB = job
+        try:
+            pool = Pool(processes, _init_worker)
+        finally:
+            _JOB = None
+
+    def deliver(outcomes):
+        """ Finish the tasks for a shard that came back """
+        for index, success, value in outcomes:
+            if success:
+                tasks[index].set_result(value)
+            else:
+                tasks[index].set_error(value)
+
+    shards = min(len(node_list), processes * chunks_per_process)
+    for i in xrange(shards):
+        indices = range(i, len(node_list), shards)
+        pool.apply_async(_run_shard, (indices,), callback=deliver)
+    pool.close()
+
+    def cleanup():
+        """ Wait for the workers, and fail anything they left behind """
+        pool.join()
+        for task in tasks:
+            task.set_error(ShardError("Worker process exited early"))
+
+    def on_cancel(task):
+        """ Stop the workers if a task is cancelled """
+        if task.cancelled():
+            pool.terminate()
+
+    for task in tasks:
+        task.add_done_callback(on_cancel)
+
+    thread = Thread(target=cleanup)
+    thread.daemon = True
+    thread.start()
+
+    return result
+
+
+def _split_rate_limits(rate_limits, processes):
+    """Divide the global rate limit between worker processes. Other scopes
+    are per key, and each node lives in just one shard.
+    """
+    rate_limits = dict(rate_limits or {})
+    if "global" in rate_limits:
+        rate, burst = rate_limits["global"]
+        rate_limits["global"] = (float(rate) / processes,
+                                 max(1, burst // processes))
+    return rate_limits
+
+
+def _init_worker():
+    """Set up a worker process. Keyboard interrupts are left to the parent,
+    which cancels the command and terminates the pool. Locks that the
+    parent's other threads might have held at fork time are replaced.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # pylint: disable=W0212
+    decorators._after_fork()
+    DEFAULT_TASK_QUEUE._after_fork()
+    for node in _JOB[0]:
+        if hasattr(node, "_after_fork"):
+            node._after_fork()
+
+
+def _run_shard(indices):
+    """Run the current job on some of its nodes, in a worker process.
+
+    :returns: An (index, success, result or error) tuple for each node.
+    :rtype: list
+
+    """
+    global _TASK_QUEUE   # pylint: disable=W0603
+
+    nodes, name, args, kwargs, rate_keys, timeout, queue_kwargs = _JOB
+    if _TASK_QUEUE is None:
+        _TASK_QUEUE = TaskQueue(**queue_kwargs)
+
+    tasks = []
+    for index in indices:
+        node = nodes[index]
+        keys = dict(rate_keys, node=node.ip_address)
+        try:
+            target = node
+            for member in name.split("."):
+                target = getattr(target, member)
+            task = _TASK_QUEUE.put_task(Task(target, *args, **kwargs),
+                                        rate_keys=keys, timeout=timeout)
+        except AttributeError as err:
+            task = Task(None)
+            task.set_error(err)
+        tasks.append(task)
+
+    outcomes = []
+    for index, task in zip(indices, tasks):
+        task.join()
+        if task.status == "Completed":
+            outcomes.append(_portable(index, True, task.result))
+        else:
+            outcomes.append(_portable(index, False, task.error))
+    return outcomes
+
+
+def _portable(index, success, value):
+    """Make sure an outcome survives the trip back to the parent process.
+
+    Many exceptions can't be unpickled (their constructors take arguments
+    that aren't kept in self.args), so this checks a full round trip.
+    """
+    try:
+        pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return index, success, value
+    # pylint: disable=W0703
+    except Exception:
+        if success:
+            return index, False, ShardError(
+                "Result of type %s could not be returned from a worker "
+                "process" % type(value).__name__
+            )
+        return index, False, ShardError("%s: %s" % (type(value).__name__,
+                                                    value))
+
+
+# End of file: ./sharding.py
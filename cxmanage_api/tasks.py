@@ -32,9 +32,35 @@
 # DAMAGE.
 
 
+import heapq
+
+from bisect import bisect_left
 from collections import deque
-from threading import Thread, Lock, Event
-from time import sleep
+from itertools import count
+from Queue import Queue, Empty
+from threading import Thread, Lock, Condition, Event, local
+from time import sleep, time
+
+from cxmanage_api.cx_exceptions import CommandFailedError, \
+    TaskCancelledError, TimeoutError
+
+
+# Priority classes. Lower numbers are always dispatched first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# Default maximum number of worker threads for a TaskQueue
+DEFAULT_THREADS = 48
+
+# Conditions for wait()
+FIRST_COMPLETED = "FIRST_COMPLETED"
+FIRST_EXCEPTION = "FIRST_EXCEPTION"
+ALL_COMPLETED = "ALL_COMPLETED"
+
+# Tracks which task each worker thread is running
+_CURRENT = local()
 
 
 class Task(object):
@@ -51,15 +77,39 @@ class Task(object):
         self.status = "Queued"
         self.result = None
         self.error = None
+        self.deadline = None
+        self.enqueue_time = None
+        self.start_time = None
+        self.finish_time = None
 
         self._method = method
         self._args = args
         self._kwargs = kwargs
+        self._lock = Lock()
         self._finished = Event()
+        self._callbacks = []
+        self._cancel_requested = False
+        self._task_queue = None
+        self._lane = None
+        self._priority = None
+        self._buckets = []
+        self._limits = []
+        self._limit_tokens = []
+
+    def join(self, timeout=None):
+        """Wait for this task to finish.
+
+        >>> task.join(timeout=30)
+        True
+
+        :param timeout: Maximum time to wait, in seconds.
+        :type timeout: float
+
+        :returns: Whether or not the task has finished.
+        :rtype: boolean
 
-    def join(self):
-        """Wait for this task to finish."""
-        self._finished.wait()
+        """
+        return self._finished.wait(timeout)
 
     def is_alive(self):
         """Return true if this task hasn't been finished.
@@ -70,39 +120,1085 @@ class Task(object):
         """
         return not self._finished.is_set()
 
+    @property
+    def wait_time(self):
+        """Seconds this task spent queued before it started, or None if it
+        hasn't started.
+
+        :returns: The queue wait time.
+        :rtype: float
+
+        """
+        if self.enqueue_time is None or self.start_time is None:
+            return None
+        return self.start_time - self.enqueue_time
+
+    @property
+    def run_time(self):
+        """Seconds this task ran for, or None if it hasn't run to the end.
+
+        :returns: The run time.
+        :rtype: float
+
+        """
+        if self.start_time is None or self.finish_time is None:
+            return None
+        return self.finish_time - self.start_time
+
+    def done(self):
+        """Return true if this task has finished, one way or another.
+
+        :returns: Whether or not the task is done.
+        :rtype: boolean
+
+        """
+        return self._finished.is_set()
+
+    def running(self):
+        """Return true if a worker is executing this task right now.
+
+        :returns: Whether or not the task is running.
+        :rtype: boolean
+
+        """
+        return self.status == "In Progress" and not self.done()
+
+    def cancelled(self):
+        """Return true if this task was cancelled.
+
+        :returns: Whether or not the task was cancelled.
+        :rtype: boolean
+
+        """
+        return self.status == "Cancelled"
+
+    def get_result(self, timeout=None):
+        """Wait for this task, and return its result or raise its error.
+
+        >>> task.get_result(timeout=30)
+        True
+
+        :param timeout: Maximum time to wait, in seconds.
+        :type timeout: float
+
+        :returns: The return value of the task's method.
+
+        :raises TimeoutError: If the task isn't done within the timeout.
+        :raises Exception: Whatever the task's method raised.
+
+        """
+        if not self.join(timeout):
+            raise TimeoutError("Task did not finish within %s seconds"
+                               % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def get_error(self, timeout=None):
+        """Wait for this task, and return its error (None on success).
+
+        :param timeout: Maximum time to wait, in seconds.
+        :type timeout: float
+
+        :returns: The error raised by the task, if any.
+        :rtype: Exception
+
+        :raises TimeoutError: If the task isn't done within the timeout.
+
+        """
+        if not self.join(timeout):
+            raise TimeoutError("Task did not finish within %s seconds"
+                               % timeout)
+        return self.error
+
+    def add_done_callback(self, function):
+        """Call function(task) when this task finishes. If it has already
+        finished, function is called right away.
+
+        Callbacks run in whichever thread finishes the task, so they should
+        be quick. Errors raised by callbacks are ignored.
+
+        >>> task.add_done_callback(lambda x: results.append(x.result))
+
+        :param function: The function to call.
+        :type function: function
+
+        """
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(function)
+                return
+        self._call(function)
+
+    def cancel(self):
+        """Cancel this task.
+
+        A task that is still queued is taken off the queue and never runs. A
+        task that is already running can't be interrupted, but it's asked to
+        stop: check_cancelled() will raise TaskCancelledError inside it.
+
+        >>> task.cancel()
+        True
+
+        :returns: Whether the task was stopped before it started.
+        :rtype: boolean
+
+        """
+        with self._lock:
+            if self._finished.is_set():
+                return False
+            self._cancel_requested = True
+            if self.status != "Queued":
+                return False
+
+        # pylint: disable=W0212
+        if (self._task_queue is not None and
+                not self._task_queue._remove_task(self)):
+            return False  # A worker got to it first
+
+        return self._finish(
+            "Cancelled", error=TaskCancelledError("Task was cancelled")
+        )
+
+    def cancel_requested(self):
+        """Return true if someone has asked for this task to be cancelled.
+
+        :returns: Whether or not cancellation was requested.
+        :rtype: boolean
+
+        """
+        return self._cancel_requested
+
     def _run(self):
         """Execute this task. Should only be called by TaskWorker."""
-        self.status = "In Progress"
+        with self._lock:
+            if self._finished.is_set():
+                return
+            if not self._cancel_requested:
+                self.status = "In Progress"
+                self.start_time = time()
+
+        if self._cancel_requested:
+            self._finish(
+                "Cancelled", error=TaskCancelledError("Task was cancelled")
+            )
+            return
+
+        _CURRENT.task = self
         try:
-            self.result = self._method(*self._args, **self._kwargs)
-            self.status = "Completed"
+            result = self._method(*self._args, **self._kwargs)
+            self._finish("Completed", result=result)
+        except TaskCancelledError as err:
+            self._finish("Cancelled", error=err)
         # pylint: disable=W0703
         except Exception as err:
-            self.error = err
-            self.status = "Failed"
+            self._finish("Failed", error=err)
+        finally:
+            _CURRENT.task = None
+
+    def _expire(self):
+        """Fail this task because its deadline passed. Should only be called
+        by TaskQueue.
+        """
+        self._cancel_requested = True
+        self._finish("Failed", error=TimeoutError(
+            "Task did not finish before its deadline"
+        ))
+
+    def set_result(self, result):
+        """Complete this task with a result, without running it. This is for
+        tasks that stand in for work done by other tasks (see
+        cxmanage_api.asynchronous).
+
+        :param result: The result of the task.
+
+        :returns: Whether this call finished the task.
+        :rtype: boolean
+
+        """
+        return self._finish("Completed", result=result)
+
+    def set_error(self, error):
+        """Fail this task with an error, without running it.
+
+        :param error: The error the task failed with.
+        :type error: Exception
+
+        :returns: Whether this call finished the task.
+        :rtype: boolean
+
+        """
+        if isinstance(error, TaskCancelledError):
+            return self._finish("Cancelled", error=error)
+        return self._finish("Failed", error=error)
+
+    def _finish(self, status, result=None, error=None):
+        """Record the outcome of this task. Only the first outcome counts.
+
+        :returns: Whether this call finished the task.
+        :rtype: boolean
+
+        """
+        with self._lock:
+            if self._finished.is_set():
+                return False
+            self.result = result
+            self.error = error
+            self.status = status
+            self.finish_time = time()
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for function in callbacks:
+            self._call(function)
+        return True
+
+    def _call(self, function):
+        """Run a done callback, ignoring any errors."""
+        try:
+            function(self)
+        # pylint: disable=W0703
+        except Exception:
+            pass
+
+
+def current_task():
+    """Get the task that the calling thread is running, if any.
+
+    :returns: The current task, or None outside of a TaskWorker.
+    :rtype: Task
+
+    """
+    return getattr(_CURRENT, "task", None)
+
+
+def check_cancelled():
+    """Raise TaskCancelledError if the task the calling thread is running
+    has been cancelled or has timed out. Long-running or polling code should
+    call this now and then. Outside of a task, it does nothing.
+
+    >>> from cxmanage_api.tasks import check_cancelled
+    >>> while not done():
+    ...     check_cancelled()
+    ...     time.sleep(1)
+
+    :raises TaskCancelledError: If the current task should stop.
+
+    """
+    task = current_task()
+    if task is not None and task.cancel_requested():
+        raise TaskCancelledError("Task was cancelled")
+
+
+def as_completed(tasks, timeout=None):
+    """Iterate over tasks in the order they finish.
+
+    If tasks is a dictionary (like the ones that Fabric methods return with
+    async=True), (key, task) pairs are yielded instead of tasks.
+
+    >>> from cxmanage_api.tasks import as_completed
+    >>> for node_id, task in as_completed(fabric.get_sensors(async=True)):
+    ...     print node_id, task.status
+
+    :param tasks: The tasks to wait for.
+    :type tasks: list or dictionary
+    :param timeout: Maximum total time to wait, in seconds.
+    :type timeout: float
+
+    :raises TimeoutError: If the tasks aren't all done within the timeout.
+
+    """
+    if isinstance(tasks, dict):
+        items = tasks.items()
+    else:
+        items = [(None, x) for x in tasks]
+    deadline = None if timeout is None else time() + timeout
+
+    finished = Queue()
+    for key, task in items:
+        task.add_done_callback(lambda x, key=key: finished.put((key, x)))
+
+    for _ in xrange(len(items)):
+        try:
+            if deadline is None:
+                # Without a timeout, Queue.get() ignores KeyboardInterrupt
+                key, task = finished.get(True, 2 ** 31)
+            else:
+                key, task = finished.get(True, max(0, deadline - time()))
+        except Empty:
+            raise TimeoutError("Tasks did not finish within %s seconds"
+                               % timeout)
+        yield task if key is None else (key, task)
+
+
+def wait(tasks, timeout=None, return_when=ALL_COMPLETED, num_tasks=None):
+    """Wait for some or all of the tasks to finish.
+
+    >>> from cxmanage_api.tasks import wait, FIRST_COMPLETED
+    >>> done, not_done = wait(tasks, return_when=FIRST_COMPLETED)
+    >>> # Wait for any 3 of the tasks
+    >>> done, not_done = wait(tasks, num_tasks=3)
+
+    :param tasks: The tasks to wait for.
+    :type tasks: list or dictionary
+    :param timeout: Maximum time to wait, in seconds.
+    :type timeout: float
+    :param return_when: FIRST_COMPLETED, FIRST_EXCEPTION or ALL_COMPLETED.
+    :type return_when: string
+    :param num_tasks: Return as soon as this many tasks are done.
+                      Overrides return_when.
+    :type num_tasks: integer
+
+    :returns: A (done, not_done) tuple. These are sets of tasks, or
+              dictionaries if tasks was a dictionary. When the timeout
+              expires, the tasks that finished so far are returned.
+    :rtype: tuple
+
+    """
+    if isinstance(tasks, dict):
+        items = tasks.items()
+    else:
+        items = [(x, x) for x in tasks]
+
+    if num_tasks is None:
+        if return_when in (ALL_COMPLETED, FIRST_EXCEPTION):
+            num_tasks = len(items)
+        elif return_when == FIRST_COMPLETED:
+            num_tasks = 1
+        else:
+            raise ValueError("Invalid return_when: %s" % return_when)
+    num_tasks = min(num_tasks, len(items))
+
+    state = {"done": 0, "failed": False}
+    condition = Condition()
+
+    def callback(task):
+        """ Count finished tasks and wake up the waiter """
+        with condition:
+            state["done"] += 1
+            if task.status != "Completed":
+                state["failed"] = True
+            condition.notify()
+
+    for _, task in items:
+        task.add_done_callback(callback)
+
+    deadline = None if timeout is None else time() + timeout
+    with condition:
+        while state["done"] < num_tasks:
+            if return_when == FIRST_EXCEPTION and state["failed"]:
+                break
+            if deadline is None:
+                condition.wait()
+            else:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+
+    if isinstance(tasks, dict):
+        done = dict((k, v) for k, v in items if v.done())
+        not_done = dict((k, v) for k, v in items if not v.done())
+    else:
+        done = set(x for _, x in items if x.done())
+        not_done = set(x for _, x in items if not x.done())
+    return done, not_done
+
+
+def gather(tasks, timeout=None, return_exceptions=False):
+    """Wait for all of the tasks and collect their results.
+
+    >>> from cxmanage_api.tasks import gather
+    >>> gather(fabric.get_power(async=True))
+    {0: False, 1: False, 2: False, 3: False}
+
+    :param tasks: The tasks to wait for.
+    :type tasks: list or dictionary
+    :param timeout: Maximum time to wait, in seconds.
+    :type timeout: float
+    :param return_exceptions: Put errors in with the results, instead of
+                              raising CommandFailedError.
+    :type return_exceptions: boolean
+
+    :returns: The results, as a list in the same order as tasks, or as a
+              dictionary with the same keys.
+
+    :raises CommandFailedError: If any task failed. Its results and errors
+                                are keyed like the tasks that were passed in
+                                (list indexes, for a list).
+    :raises TimeoutError: If the tasks aren't all done within the timeout.
+
+    """
+    if isinstance(tasks, dict):
+        items = tasks.items()
+    else:
+        items = list(enumerate(tasks))
+
+    _, not_done = wait([x for _, x in items], timeout=timeout)
+    if not_done:
+        raise TimeoutError("Tasks did not finish within %s seconds"
+                           % timeout)
+
+    results = {}
+    errors = {}
+    for key, task in items:
+        if task.status == "Completed":
+            results[key] = task.result
+        elif return_exceptions:
+            results[key] = task.error
+        else:
+            errors[key] = task.error
+    if errors:
+        raise CommandFailedError(results, errors)
+
+    if isinstance(tasks, dict):
+        return results
+    return [results[i] for i in xrange(len(items))]
+
+
+class TaskGraph(object):
+    """A set of tasks with dependencies between them.
+
+    Each task is put on the task queue as soon as the tasks it depends on
+    have finished, so independent chains of work (one per node, say) move
+    along at their own pace instead of waiting at fabric-wide barriers. Use
+    gate() where every chain really does need to wait for all the others.
+
+    If a task that another depends on fails, the dependent task fails with
+    the same error without running, and so on down the chain.
+
+    >>> from cxmanage_api.tasks import TaskGraph, Task
+    >>> graph = TaskGraph(task_queue)
+    >>> check = graph.put(Task(node._check_firmware, package))
+    >>> update = graph.put(Task(node.update_firmware, package), after=[check])
+    >>> graph.join()
+
+    :param task_queue: Task queue to run the tasks on.
+    :type task_queue: TaskQueue
+
+    """
+
+    def __init__(self, task_queue=None):
+        """Default constructor for the TaskGraph class."""
+        if task_queue is None:
+            task_queue = DEFAULT_TASK_QUEUE
+        self.task_queue = task_queue
+        self.tasks = []
+        self._lock = Lock()
+
+    def put(self, task, after=(), require_success=True, **put_kwargs):
+        """Add a task to the graph.
+
+        :param task: The task to run.
+        :type task: Task
+        :param after: Tasks that must finish before this one starts.
+        :type after: list
+        :param require_success: Fail this task (with the same error) if any
+                                task in after fails, instead of running it.
+        :type require_success: boolean
+        :param put_kwargs: Extra arguments (priority, lane, rate_keys,
+                           timeout) for TaskQueue.put_task().
+
+        :returns: The task that was passed in.
+        :rtype: Task
+
+        """
+        after = list(after)
+        with self._lock:
+            self.tasks.append(task)
+            remaining = [len(after)]
+
+        def callback(_):
+            """ Start the task once all of its dependencies are done """
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            self._start(task, after, require_success, put_kwargs)
+
+        if not after:
+            self._start(task, after, require_success, put_kwargs)
+        for dependency in after:
+            dependency.add_done_callback(callback)
+        return task
+
+    def gate(self, tasks, message="A task that this one depends on failed"):
+        """Add a gate: a task that completes once all of the given tasks
+        have completed, or fails as soon as one of them fails. Tasks that
+        come after a failed gate are cancelled.
+
+        >>> gate = graph.gate(checks)
+        >>> update = graph.put(Task(node.update_firmware, package),
+        ...                    after=[gate])
+
+        :param tasks: The tasks to wait for.
+        :type tasks: list
+        :param message: Message for the TaskCancelledError that the gate
+                        fails with.
+        :type message: string
+
+        :returns: The gate, which completes with a list of the results.
+        :rtype: Task
+
+        """
+        tasks = list(tasks)
+        gate = Task(None)
+        with self._lock:
+            self.tasks.append(gate)
+            remaining = [len(tasks)]
+
+        def callback(finished):
+            """ Fail the gate early, or open it once everything is done """
+            if finished.status != "Completed":
+                gate.set_error(TaskCancelledError(message))
+                return
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            gate.set_result([x.result for x in tasks])
+
+        if not tasks:
+            gate.set_result([])
+        for task in tasks:
+            task.add_done_callback(callback)
+        return gate
+
+    def cancel(self):
+        """Cancel every task in the graph that hasn't finished."""
+        with self._lock:
+            tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+
+    def join(self, timeout=None):
+        """Wait for every task in the graph to finish.
+
+        :param timeout: Maximum time to wait, in seconds.
+        :type timeout: float
+
+        :returns: Whether all of the tasks finished.
+        :rtype: boolean
+
+        """
+        with self._lock:
+            tasks = list(self.tasks)
+        _, not_done = wait(tasks, timeout=timeout)
+        return not not_done
+
+    def _start(self, task, after, require_success, put_kwargs):
+        """Put a task on the queue, now that its dependencies are done."""
+        if task.done():
+            return  # Cancelled while it waited
+        if require_success:
+            for dependency in after:
+                if dependency.status != "Completed":
+                    task.set_error(dependency.error)
+                    return
+        try:
+            self.task_queue.put_task(task, **put_kwargs)
+        except RuntimeError as err:
+            task.set_error(err)
+
+
+class TokenBucket(object):
+    """A token bucket rate limiter.
+
+    Tokens are added at a steady rate, up to the burst size. Each command
+    takes one token, so the long-term rate is limited to rate commands per
+    second while still allowing short bursts.
+
+    >>> from cxmanage_api.tasks import TokenBucket
+    >>> bucket = TokenBucket(rate=10, burst=5)
+    >>> bucket.consume()
+    0.0
+
+    :param rate: Number of tokens added per second.
+    :type rate: float
+    :param burst: Maximum number of tokens the bucket can hold.
+    :type burst: integer
+
+    """
+
+    def __init__(self, rate, burst=1):
+        """Default constructor for the TokenBucket class."""
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be positive")
+        if burst < 1:
+            raise ValueError("Token bucket burst size must be at least 1")
+
+        self.rate = float(rate)
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._last = time()
+        self._lock = Lock()
+
+    def __str__(self):
+        return 'TokenBucket %s/s (burst %s)' % (self.rate, self.burst)
+
+    def available(self):
+        """Get the time until a token is available.
+
+        :returns: Seconds until a token can be taken, or 0 if one is ready.
+        :rtype: float
+
+        """
+        with self._lock:
+            self._fill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def consume(self):
+        """Take a token if one is available.
+
+        :returns: 0 if a token was taken, otherwise the number of seconds
+                  until one will be available.
+        :rtype: float
+
+        """
+        with self._lock:
+            self._fill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def _fill(self):
+        """Add the tokens that accrued since the last fill."""
+        now = time()
+        self._tokens = min(
+            float(self.burst), self._tokens + (now - self._last) * self.rate
+        )
+        self._last = now
 
-        self._finished.set()
+
+class RollingHistogram(object):
+    """A histogram of the most recent samples of some measurement, such as
+    task wait times.
+
+    >>> from cxmanage_api.tasks import RollingHistogram
+    >>> histogram = RollingHistogram(window=100)
+    >>> histogram.add(0.25)
+    >>> histogram.percentile(50)
+    0.25
+
+    :param window: Number of recent samples to keep.
+    :type window: integer
+    :param bounds: Upper bounds of the histogram buckets, in ascending order.
+                   Samples above the last bound go in an overflow bucket.
+    :type bounds: tuple
+
+    """
+
+    DEFAULT_BOUNDS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    def __init__(self, window=1024, bounds=DEFAULT_BOUNDS):
+        """Default constructor for the RollingHistogram class."""
+        self.bounds = tuple(bounds)
+        self.total = 0
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, value):
+        """Add a sample, pushing out the oldest one if the window is full.
+
+        :param value: The sample.
+        :type value: float
+
+        """
+        self._samples.append(value)
+        self.total += 1
+
+    def percentile(self, percent):
+        """Get a percentile of the samples in the window.
+
+        :param percent: The percentile, from 0 to 100.
+        :type percent: float
+
+        :returns: The sample at that percentile, or None with no samples.
+        :rtype: float
+
+        """
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = int(round((len(ordered) - 1) * percent / 100.0))
+        return ordered[index]
+
+    def buckets(self):
+        """Count the samples in the window that fall in each bucket.
+
+        :returns: (upper bound, count) pairs. The overflow bucket's bound is
+                  None.
+        :rtype: list
+
+        """
+        counts = [0] * (len(self.bounds) + 1)
+        for value in self._samples:
+            counts[bisect_left(self.bounds, value)] += 1
+        return zip(self.bounds + (None,), counts)
+
+    def summary(self):
+        """Summarize the samples in the window.
+
+        :returns: The sample count, lifetime total, mean, min, max, p50, p90,
+                  p99 and bucket counts.
+        :rtype: dictionary
+
+        """
+        samples = self._samples
+        return {
+            "count": len(samples),
+            "total": self.total,
+            "mean": (float(sum(samples)) / len(samples)) if samples else None,
+            "min": min(samples) if samples else None,
+            "max": max(samples) if samples else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": self.buckets()
+        }
+
+
+class AdaptiveLimit(object):
+    """An adaptive concurrency limit, using AIMD (additive increase,
+    multiplicative decrease).
+
+    While tasks succeed with the limit mostly used, the limit grows by about
+    `increase` per limit's worth of tasks. When a task fails with a
+    congestion error, or takes longer than max_latency, the limit is cut by
+    the `decrease` factor. Only one cut is made per round of tasks, so a
+    burst of failures from tasks that were all in flight together counts
+    once.
+
+    TaskQueue makes all of the calls on this object under its own lock.
+
+    >>> from cxmanage_api.tasks import AdaptiveLimit
+    >>> limit = AdaptiveLimit(initial=8, maximum=48, max_latency=30)
+    >>> limit.limit
+    8.0
+
+    :param initial: Starting concurrency.
+    :type initial: integer
+    :param minimum: Lowest concurrency to go down to.
+    :type minimum: integer
+    :param maximum: Highest concurrency to go up to.
+    :type maximum: integer
+    :param increase: How much to add per round of successful tasks.
+    :type increase: float
+    :param decrease: Factor to multiply the limit by on congestion.
+    :type decrease: float
+    :param max_latency: Run time, in seconds, past which a task counts as a
+                        sign of congestion.
+    :type max_latency: float
+    :param congestion_errors: Error types that count as congestion. Defaults
+                              to any failure.
+    :type congestion_errors: tuple
+
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=48, increase=1.0,
+                 decrease=0.5, max_latency=None, congestion_errors=None):
+        """Default constructor for the AdaptiveLimit class."""
+        if not 0 < decrease < 1:
+            raise ValueError("AIMD decrease factor must be between 0 and 1")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.max_latency = max_latency
+        self.congestion_errors = congestion_errors
+
+        self.limit = float(max(minimum, min(maximum, initial)))
+        self.in_flight = 0
+        self.peak = self.limit
+        self.increases = 0
+        self.decreases = 0
+        self._epoch = 0
+
+    def __str__(self):
+        return 'AdaptiveLimit %i (%i in flight)' % (self.limit,
+                                                    self.in_flight)
+
+    def available(self):
+        """Return true if another task may start now.
+
+        :rtype: boolean
+
+        """
+        return self.in_flight < int(self.limit)
+
+    def acquire(self):
+        """Record that a task started.
+
+        :returns: A token to pass to release() when the task is done.
+        :rtype: integer
+
+        """
+        self.in_flight += 1
+        return self._epoch
+
+    def release(self, token, task, run_time):
+        """Record that a task finished, and adjust the limit.
+
+        :param token: The token from acquire().
+        :type token: integer
+        :param task: The finished task.
+        :type task: Task
+        :param run_time: How long the task ran for, in seconds.
+        :type run_time: float
+
+        """
+        # Only grow when the limit is what's holding things back, i.e. when
+        # at least half of it is in use.
+        saturated = self.in_flight * 2 >= self.limit
+        self.in_flight -= 1
+
+        if self.is_congested(task, run_time):
+            if token == self._epoch:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._epoch += 1
+                self.decreases += 1
+        elif task.status == "Completed" and saturated:
+            limit = min(self.maximum, self.limit + self.increase / self.limit)
+            if int(limit) > int(self.limit):
+                self.increases += 1
+            self.limit = limit
+            self.peak = max(self.peak, self.limit)
+
+    def is_congested(self, task, run_time):
+        """Return true if this task's outcome is a sign of congestion.
+
+        :rtype: boolean
+
+        """
+        if self.max_latency != None and run_time > self.max_latency:
+            return True
+        if task.status != "Failed":
+            return False
+        return (self.congestion_errors is None or
+                isinstance(task.error, self.congestion_errors))
+
+    def get_stats(self):
+        """Get the current limit and how it got there.
+
+        :returns: The limit, tasks in flight, peak limit, and the number of
+                  increases and decreases.
+        :rtype: dictionary
+
+        """
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "peak": int(self.peak),
+            "increases": self.increases,
+            "decreases": self.decreases
+        }
+
+
+class TaskLane(object):
+    """A lane is one submitter's share of a TaskQueue.
+
+    Within a priority class, the queue takes turns between lanes in
+    proportion to their weights, so one submitter's big fan-out can't starve
+    everybody else. Use TaskQueue.lane() to get one.
+
+    >>> lane = task_queue.lane('10.20.1.9', weight=2)
+    >>> task = lane.put(node.get_power)
+    >>> lane.depth
+    0
+
+    :param task_queue: The TaskQueue this lane belongs to.
+    :type task_queue: TaskQueue
+    :param name: Name of this lane.
+    :type name: string
+    :param weight: Relative share of the workers this lane gets.
+    :type weight: float
+    :param priority: Default priority for tasks put on this lane.
+    :type priority: integer
+
+    """
+
+    def __init__(self, task_queue, name, weight=1, priority=PRIORITY_NORMAL):
+        """Default constructor for the TaskLane class."""
+        if weight <= 0:
+            raise ValueError("Lane weight must be positive")
+
+        self.name = name
+        self.weight = weight
+        self.priority = priority
+
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self._task_queue = task_queue
+        self._queues = dict((x, deque()) for x in PRIORITIES)
+        self._vtime = 0.0
+
+    def __str__(self):
+        return 'TaskLane %s (weight %s)' % (self.name, self.weight)
+
+    @property
+    def depth(self):
+        """Number of tasks waiting in this lane.
+
+        :returns: The queue depth.
+        :rtype: integer
+
+        """
+        return sum(len(x) for x in self._queues.itervalues())
+
+    @property
+    def average_wait(self):
+        """Average time, in seconds, that dispatched tasks spent queued.
+
+        :returns: The average queue wait time.
+        :rtype: float
+
+        """
+        if not self.dispatched:
+            return 0.0
+        return self.total_wait / self.dispatched
+
+    def put(self, method, *args, **kwargs):
+        """Add a task to this lane, at the lane's default priority.
+
+        :param method: Named method to run.
+        :type method: string
+        :param args: Arguments to pass to the named method to run.
+        :type args: list
+
+        :returns: A Task that will be executed by a worker at a later time.
+        :rtype: Task
+
+        """
+        return self._task_queue.put_task(
+            Task(method, *args, **kwargs), priority=self.priority, lane=self
+        )
 
 
 class TaskQueue(object):
-    """A task queue, consisting of a queue and a number of workers.
+    """A task queue, consisting of a queue and a pool of persistent workers.
+
+    Workers are started on demand, up to the thread limit, and then stay
+    alive waiting for more work. Workers that sit idle for idle_timeout
+    seconds are retired, so the pool shrinks back down when it's not in use.
+    A single TaskQueue is meant to be shared by everything in the process
+    (see DEFAULT_TASK_QUEUE).
+
+    Tasks are dispatched by priority class first (PRIORITY_HIGH, then
+    PRIORITY_NORMAL, then PRIORITY_LOW). Within a class, the queue does
+    weighted-fair scheduling across lanes, and FIFO within each lane.
 
-    :param threads: Number of threads to create (if needed).
+    >>> from cxmanage_api.tasks import TaskQueue
+    >>> task_queue = TaskQueue(threads=16)
+    >>> task = task_queue.put(node.get_power)
+    >>> task.join()
+    >>> task_queue.shutdown()
+
+    :param threads: Maximum number of worker threads to create.
     :type threads: integer
-    :param delay: Time to wait between
+    :param delay: Time to wait before executing each task, per worker.
+    :type delay: float
+    :param idle_timeout: Seconds a worker may stay idle before it exits.
+    :type idle_timeout: float
+    :param rate_limits: Token bucket settings, as a map of scope to
+                        (rate, burst). The "global" scope applies to every
+                        task. Other scopes (such as "node" or "fabric") apply
+                        per key, to tasks put with matching rate_keys.
+    :type rate_limits: dictionary
+    :param concurrency: Adaptive concurrency settings, as a map of scope to
+                        AdaptiveLimit keyword arguments. Scopes work like
+                        they do for rate_limits. For example,
+                        {"global": {}, "fabric": {"maximum": 16}}.
+    :type concurrency: dictionary
+
     """
 
-    def __init__(self, threads=48, delay=0):
+    # How far into each lane to look for a task that isn't rate limited
+    RATE_LIMIT_SCAN = 64
+
+    def __init__(self, threads=DEFAULT_THREADS, delay=0, idle_timeout=60,
+                 rate_limits=None, concurrency=None):
         """Default constructor for the TaskQueue class."""
         self.threads = threads
         self.delay = delay
+        self.idle_timeout = idle_timeout
+        self.rate_limits = dict(rate_limits or {})
+        self.concurrency = dict(concurrency or {})
 
         self._lock = Lock()
-        self._queue = deque()
-        self._workers = 0
+        self._condition = Condition(self._lock)
+        self._lanes = {}
+        self._default_lane = self.lane("default")
+        self._active = dict((x, set()) for x in PRIORITIES)
+        self._pending = 0
+        self._vtime = 0.0
+        self._buckets = {}
+        self._limits = {}
+        self._timers = []
+        self._timer_condition = Condition(self._lock)
+        self._sequence = count()
+        self._watchdog = None
+        self._workers = set()
+        self._idle = 0
+        self._idle_low = 0
+        self._retiring = 0
+        self._reaper = None
+        self._shutdown = False
+
+        self._running = 0
+        self._wait_times = RollingHistogram()
+        self._run_times = RollingHistogram()
+        self._stats_start = time()
+        self._usage_time = self._stats_start
+        self._busy_time = 0.0
+        self._worker_time = 0.0
+
+    def lane(self, name, weight=None, priority=None):
+        """Get the lane with this name, creating it if necessary.
+
+        >>> lane = task_queue.lane('10.20.1.9')
+
+        :param name: Name of the lane, for example a fabric's IP address.
+        :type name: string
+        :param weight: Relative share of the workers for this lane.
+        :type weight: float
+        :param priority: Default priority for tasks put on this lane.
+        :type priority: integer
+
+        :returns: The lane with this name.
+        :rtype: TaskLane
+
+        """
+        with self._lock:
+            if not name in self._lanes:
+                self._lanes[name] = TaskLane(self, name)
+            lane = self._lanes[name]
+            if weight != None:
+                if weight <= 0:
+                    raise ValueError("Lane weight must be positive")
+                lane.weight = weight
+            if priority != None:
+                lane.priority = priority
+            return lane
+
+    @property
+    def lanes(self):
+        """All of the lanes on this task queue.
+
+        :returns: A mapping of lane names to lanes.
+        :rtype: dictionary
+
+        """
+        with self._lock:
+            return dict(self._lanes)
 
     def put(self, method, *args, **kwargs):
-        """Add a task to the task queue, and spawn a worker if we're not full.
+        """Add a task to the task queue, and wake or spawn a worker for it.
 
         :param method: Named method to run.
         :type method: string
@@ -112,22 +1208,96 @@ class TaskQueue(object):
         :returns: A Task that will be executed by a worker at a later time.
         :rtype: Task
 
+        :raises RuntimeError: If the task queue has been shut down.
+
         """
-        self._lock.acquire()
+        return self.put_task(Task(method, *args, **kwargs))
+
+    def put_task(self, task, priority=PRIORITY_NORMAL, lane=None,
+                 rate_keys=None, timeout=None, delay=None):
+        """Add an existing Task to the task queue.
 
-        task = Task(method, *args, **kwargs)
-        self._queue.append(task)
+        >>> from cxmanage_api.tasks import Task, PRIORITY_HIGH
+        >>> task = task_queue.put_task(Task(node.get_power),
+        ...                            priority=PRIORITY_HIGH,
+        ...                            lane='10.20.1.9',
+        ...                            rate_keys={'node': node.ip_address},
+        ...                            timeout=30)
+        >>> # Check again in 5 seconds, without tying up a worker until then
+        >>> task = task_queue.put_task(Task(node.get_power), delay=5)
+
+        :param task: The task to run.
+        :type task: Task
+        :param priority: Priority class for the task.
+        :type priority: integer
+        :param lane: Lane (or lane name) to put the task on.
+        :type lane: TaskLane or string
+        :param rate_keys: Rate limiting keys for this task, as a map of
+                          scope to key. For example, {"node": ip_address}.
+        :type rate_keys: dictionary
+        :param timeout: Seconds the task has to finish, counting from now.
+                        Past its deadline the task fails with TimeoutError,
+                        whether it's still queued or already running.
+        :type timeout: float
+        :param delay: Seconds to hold the task back before queuing it. No
+                      worker is used while the task is held back.
+        :type delay: float
+
+        :returns: The task that was passed in.
+        :rtype: Task
 
-        if self._workers < self.threads:
-            TaskWorker(task_queue=self, delay=self.delay)
-            self._workers += 1
+        :raises RuntimeError: If the task queue has been shut down.
+        :raises ValueError: If the priority is invalid.
+
+        """
+        if not priority in PRIORITIES:
+            raise ValueError("Invalid task priority: %s" % priority)
+        if lane is None:
+            lane = self._default_lane
+        elif not isinstance(lane, TaskLane):
+            lane = self.lane(lane)
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Can't put tasks on a TaskQueue that has "
+                                   "been shut down")
+
+            if timeout != None:
+                task.deadline = time() + timeout
+                self._add_timer(task.deadline, "expire", task)
+
+            if delay:
+                self._add_timer(time() + delay, "start", task,
+                                dict(priority=priority, lane=lane,
+                                     rate_keys=rate_keys))
+                return task
+
+            # pylint: disable=W0212
+            if not lane.depth:
+                # Don't let a lane bank up credit while it has nothing queued
+                lane._vtime = max(lane._vtime, self._vtime)
+            task._task_queue = self
+            task._lane = lane
+            task._priority = priority
+            task.enqueue_time = time()
+            task._buckets = self._get_buckets(rate_keys)
+            task._limits = self._get_limits(rate_keys)
+            lane._queues[priority].append(task)
+            self._active[priority].add(lane)
+            self._pending += 1
+
+            if (self._pending > self._idle - self._retiring and
+                    len(self._workers) < self._max_workers()):
+                self._spawn_worker()
+            self._condition.notify()
 
-        self._lock.release()
         return task
 
     def get(self):
         """
-        Get a task from the task queue. Mainly used by workers.
+        Get the next task from the task queue, without waiting. The task
+        counts as running until it finishes, so run it: only then are its
+        rate and concurrency limit slots given back.
 
         :returns: A Task object that hasn't been executed yet.
         :rtype: Task
@@ -135,17 +1305,387 @@ class TaskQueue(object):
         :raises IndexError: If there are no tasks in the queue.
 
         """
-        self._lock.acquire()
+        with self._lock:
+            task, _ = self._pop_task()
+        if task is None:
+            raise IndexError("No runnable tasks in the TaskQueue")
+        task.add_done_callback(
+            lambda x: self._task_done(x, x.run_time or 0.0)
+        )
+        return task
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Stop accepting tasks and let the workers exit once the queue is
+        drained.
+
+        >>> task_queue.shutdown()
+
+        :param wait: Wait for the worker threads to exit.
+        :type wait: boolean
+        :param cancel_pending: Cancel queued tasks instead of running them.
+        :type cancel_pending: boolean
+
+        """
+        with self._lock:
+            self._shutdown = True
+            self._condition.notify_all()
+            workers = list(self._workers)
+            if cancel_pending:
+                # pylint: disable=W0212
+                pending = [task for lane in self._lanes.itervalues()
+                           for queue in lane._queues.itervalues()
+                           for task in queue]
+            else:
+                pending = []
+
+        for task in pending:
+            task.cancel()
+
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def get_stats(self):
+        """Get a snapshot of this queue's statistics.
+
+        Wait times run from when a task is put on the queue until a worker
+        picks it up. Run times cover how long the worker was busy with it.
+        Utilization is the fraction of live worker time spent running tasks,
+        and capacity is the fraction of the thread limit that was in use. If
+        capacity is near 1 while wait times grow, the pool (not the BMCs) is
+        the bottleneck, and more threads will help.
+
+        >>> stats = task_queue.get_stats()
+        >>> stats["wait_time"]["p90"]
+        0.0123
+
+        :returns: Counters, histograms and per-lane statistics since the
+                  queue was created (or reset_stats() was called).
+        :rtype: dictionary
+
+        """
+        with self._lock:
+            now = time()
+            self._update_usage(now)
+            elapsed = now - self._stats_start
+            lanes = {}
+            for name, lane in self._lanes.iteritems():
+                lanes[name] = {
+                    "weight": lane.weight,
+                    "depth": lane.depth,
+                    "dispatched": lane.dispatched,
+                    "average_wait": lane.average_wait,
+                    "max_wait": lane.max_wait
+                }
+
+            return {
+                "threads": self.threads,
+                "workers": len(self._workers),
+                "idle": self._idle,
+                "in_flight": self._running,
+                "pending": self._pending,
+                "elapsed": elapsed,
+                "utilization": (self._busy_time / self._worker_time
+                                if self._worker_time else 0.0),
+                "capacity": (self._busy_time / (self.threads * elapsed)
+                             if elapsed and self.threads else 0.0),
+                "wait_time": self._wait_times.summary(),
+                "run_time": self._run_times.summary(),
+                "lanes": lanes,
+                "concurrency": dict(
+                    (scope if key is None else "%s %s" % (scope, key),
+                     limit.get_stats())
+                    for (scope, key), limit in self._limits.iteritems()
+                )
+            }
+
+    def reset_stats(self):
+        """Start collecting statistics from scratch.
+
+        >>> task_queue.reset_stats()
+
+        """
+        with self._lock:
+            now = time()
+            self._wait_times = RollingHistogram()
+            self._run_times = RollingHistogram()
+            self._stats_start = now
+            self._usage_time = now
+            self._busy_time = 0.0
+            self._worker_time = 0.0
+            for lane in self._lanes.itervalues():
+                lane.dispatched = 0
+                lane.total_wait = 0.0
+                lane.max_wait = 0.0
+
+    def _after_fork(self):
+        """Start over with no workers, timers or queued tasks, keeping the
+        settings. Should only be called in a child process right after fork,
+        where the parent's worker threads don't exist and its lock may have
+        been held by one of them.
+        """
+        self.__init__(self.threads, self.delay, self.idle_timeout,
+                      self.rate_limits, self.concurrency)
+
+    def _update_usage(self, now):
+        """Account busy and live worker time up to now. Call this before the
+        number of running tasks or workers changes. Caller must hold the
+        lock.
+        """
+        elapsed = now - self._usage_time
+        if elapsed > 0:
+            self._busy_time += self._running * elapsed
+            self._worker_time += len(self._workers) * elapsed
+        self._usage_time = now
+
+    def _task_done(self, task, run_time):
+        """Record that a worker finished running a task. Should only be used
+        by TaskWorker, or for tasks handed out by get().
+        """
+        with self._lock:
+            self._update_usage(time())
+            self._running -= 1
+            self._run_times.add(run_time)
+
+            # pylint: disable=W0212
+            for limit, token in task._limit_tokens:
+                slots = int(limit.limit)
+                limit.release(token, task, run_time)
+                for _ in xrange(max(1, int(limit.limit) - slots + 1)):
+                    self._condition.notify()
+            task._limit_tokens = []
+
+            # The global limit may have grown past the number of workers.
+            # This worker counts as idle, since it's about to ask for work.
+            if (("global", None) in self._limits and
+                    self._pending > self._idle - self._retiring + 1 and
+                    len(self._workers) < self._max_workers()):
+                self._spawn_worker()
+
+    def _get_limits(self, rate_keys):
+        """Get the adaptive concurrency limits that apply to a task with these
+        rate keys. Caller must hold the lock.
+        """
+        keys = [("global", None)] + sorted((rate_keys or {}).items())
+
+        limits = []
+        for scope, key in keys:
+            if not scope in self.concurrency:
+                continue
+            if not (scope, key) in self._limits:
+                self._limits[(scope, key)] = AdaptiveLimit(
+                    **self.concurrency[scope]
+                )
+            limits.append(self._limits[(scope, key)])
+        return limits
+
+    def _max_workers(self):
+        """Get the current cap on worker threads. Caller must hold the lock.
+        """
+        limit = self._limits.get(("global", None))
+        if limit is None:
+            return self.threads
+        return min(self.threads, int(limit.limit))
+
+    def _get_buckets(self, rate_keys):
+        """Get the token buckets that apply to a task with these rate keys.
+        Caller must hold the lock.
+        """
+        keys = [("global", None)] + sorted((rate_keys or {}).items())
+
+        buckets = []
+        for scope, key in keys:
+            if not scope in self.rate_limits:
+                continue
+            if not (scope, key) in self._buckets:
+                rate, burst = self.rate_limits[scope]
+                self._buckets[(scope, key)] = TokenBucket(rate, burst)
+            buckets.append(self._buckets[(scope, key)])
+        return buckets
+
+    def _pop_task(self):
+        """Take the next runnable task off the queue. Caller must hold the
+        lock.
+
+        Returns a (task, wait) tuple. If every queued task is held back by a
+        rate limit, task is None and wait is the time until one may be ready.
+        """
+        # pylint: disable=W0212
+        wait = None
+        for priority in PRIORITIES:
+            active = self._active[priority]
+            for lane in sorted(active, key=lambda x: x._vtime):
+                queue = lane._queues[priority]
+                for index in xrange(min(len(queue), self.RATE_LIMIT_SCAN)):
+                    task = queue[index]
+                    if not all(x.available() for x in task._limits):
+                        continue  # Woken up again when a slot frees up
+                    task_wait = max([x.available() for x in task._buckets]
+                                    + [0.0])
+                    if task_wait > 0:
+                        wait = min(wait, task_wait) if wait else task_wait
+                        continue
+
+                    for bucket in task._buckets:
+                        bucket.consume()
+                    task._limit_tokens = [(x, x.acquire())
+                                          for x in task._limits]
+                    del queue[index]
+                    if not queue:
+                        active.discard(lane)
+
+                    self._pending -= 1
+                    self._vtime = lane._vtime
+                    lane._vtime += 1.0 / lane.weight
+
+                    now = time()
+                    task_wait = now - task.enqueue_time
+                    lane.dispatched += 1
+                    lane.total_wait += task_wait
+                    lane.max_wait = max(lane.max_wait, task_wait)
+
+                    self._update_usage(now)
+                    self._running += 1
+                    self._wait_times.add(task_wait)
+                    return task, 0.0
+
+        return None, wait
+
+    def _remove_task(self, task):
+        """Take a queued task off the queue without running it.
+
+        :returns: Whether the task was still on the queue.
+        :rtype: boolean
+
+        """
+        with self._lock:
+            return self._remove_queued(task)
+
+    def _remove_queued(self, task):
+        """Take a queued task off the queue. Caller must hold the lock."""
+        # pylint: disable=W0212
+        lane, priority = task._lane, task._priority
+        if lane is None:
+            return False
+
+        queue = lane._queues[priority]
         try:
-            return self._queue.popleft()
-        finally:
-            self._lock.release()
+            queue.remove(task)
+        except ValueError:
+            return False
+
+        if not queue:
+            self._active[priority].discard(lane)
+        self._pending -= 1
+        return True
 
-    def _remove_worker(self):
-        """Decrement the worker count. Should only be used by TaskWorker."""
-        self._lock.acquire()
-        self._workers -= 1
-        self._lock.release()
+    def _add_timer(self, when, action, task, put_kwargs=None):
+        """Schedule a timer action for a task. Caller must hold the lock."""
+        heapq.heappush(self._timers, (when, next(self._sequence), action,
+                                      task, put_kwargs))
+        if self._watchdog is None:
+            self._watchdog = Thread(target=self._watch_timers)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+        else:
+            self._timer_condition.notify()
+
+    def _watch_timers(self):
+        """Queue delayed tasks, and fail tasks that are still alive when
+        their deadline passes.
+
+        Queued tasks are taken off the queue when they expire. Running tasks
+        are failed right away and asked to cancel; whatever they return later
+        is discarded.
+        """
+        while True:
+            expired = []
+            started = []
+            with self._lock:
+                now = time()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, action, task, put_kwargs = heapq.heappop(
+                        self._timers
+                    )
+                    if not task.is_alive():
+                        continue
+                    if action == "expire":
+                        self._remove_queued(task)
+                        expired.append(task)
+                    else:
+                        started.append((task, put_kwargs))
+
+                if not (expired or started):
+                    if not self._timers:
+                        self._watchdog = None
+                        return
+                    self._timer_condition.wait(self._timers[0][0] - now)
+                    continue
+
+            for task in expired:
+                # pylint: disable=W0212
+                task._expire()
+            for task, put_kwargs in started:
+                try:
+                    self.put_task(task, **put_kwargs)
+                except RuntimeError:
+                    task.cancel()  # Shut down while the task was delayed
+
+    def _spawn_worker(self):
+        """Start a new worker thread. Caller must hold the lock."""
+        self._update_usage(time())
+        self._workers.add(TaskWorker(task_queue=self, delay=self.delay))
+
+        if self._reaper is None:
+            self._reaper = Thread(target=self._reap_idle_workers)
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _wait_for_task(self, worker):
+        """Block until there's a task for this worker. Returns None when the
+        worker should exit. Should only be used by TaskWorker.
+        """
+        with self._lock:
+            while True:
+                wait = None
+                if self._pending:
+                    task, wait = self._pop_task()
+                    if task is not None:
+                        return task
+                elif self._shutdown or self._retiring > 0:
+                    if not self._shutdown:
+                        self._retiring -= 1
+                    self._update_usage(time())
+                    self._workers.discard(worker)
+                    return None
+
+                self._idle += 1
+                self._condition.wait(wait)
+                self._idle -= 1
+                self._idle_low = min(self._idle_low, self._idle)
+
+    def _reap_idle_workers(self):
+        """Retire workers that stayed idle for a whole idle_timeout period.
+
+        Idle workers block on the condition variable without a timeout, so
+        they cost nothing while they wait. This thread wakes up once per
+        period and retires as many workers as were idle for all of it.
+        """
+        while True:
+            with self._lock:
+                self._idle_low = self._idle
+            sleep(self.idle_timeout)
+
+            with self._lock:
+                if self._shutdown or not self._workers:
+                    self._reaper = None
+                    return
+
+                excess = min(self._idle_low, self._idle) - self._retiring
+                if excess > 0 and not self._pending:
+                    self._retiring += excess
+                    for _ in xrange(excess):
+                        self._condition.notify()
 
 
 class TaskWorker(Thread):
@@ -153,7 +1693,7 @@ class TaskWorker(Thread):
 
     :param task_queue: Task queue to get tasks from.
     :type task_queue: TaskQueue
-    :param delay: Time to wait in-between execution.
+    :param delay: Time to wait before executing each task.
 
     """
     def __init__(self, task_queue, delay=0):
@@ -166,17 +1706,18 @@ class TaskWorker(Thread):
         self.start()
 
     def run(self):
-        """Repeatedly get tasks from the TaskQueue and execute them."""
-        try:
-            while True:
-                sleep(self._delay)
-                task = self._task_queue.get()
-                # pylint: disable=W0212
-                task._run()
-        # pylint: disable=W0703
-        except Exception:
+        """Repeatedly wait for tasks from the TaskQueue and execute them."""
+        while True:
             # pylint: disable=W0212
-            self._task_queue._remove_worker()
+            task = self._task_queue._wait_for_task(self)
+            if task is None:
+                return
+
+            start = time()
+            if self._delay:
+                sleep(self._delay)
+            task._run()
+            self._task_queue._task_done(task, time() - start)
 
 DEFAULT_TASK_QUEUE = TaskQueue()
 
@@ -0,0 +1,176 @@
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-public-methods
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+"""Unit tests for the asynchronous front end."""
+
+import time
+import unittest
+from threading import Event
+
+from cxmanage_api.tests import DummyBMC, DummyUbootEnv, DummyIPRetriever
+from cxmanage_api.tests import TestImage, DummyNode
+from cxmanage_api.node import Node
+from cxmanage_api.fabric import Fabric
+from cxmanage_api.tasks import TaskQueue, Task, gather
+from cxmanage_api.asynchronous import AsyncNode, AsyncFabric, poll, then
+from cxmanage_api.cx_exceptions import TimeoutError
+
+
+class AsynchronousTest(unittest.TestCase):
+    """ Tests for the asynchronous front end """
+
+    def setUp(self):
+        self.task_queue = TaskQueue(threads=2)
+        self.nodes = [
+            AsyncNode(Node(
+                ip_address=ip, tftp=DummyBMC.tftp, bmc=DummyBMC,
+                image=TestImage, ubootenv=DummyUbootEnv,
+                ipretriever=DummyIPRetriever
+            ), self.task_queue) for ip in DummyBMC.ip_addresses
+        ]
+
+    def tearDown(self):
+        self.task_queue.shutdown()
+
+    def test_node_methods(self):
+        """ Test that node methods return tasks """
+        tasks = [x.get_power() for x in self.nodes]
+        self.assertEqual(gather(tasks, timeout=5), [False] * len(tasks))
+
+    def test_delayed_tasks(self):
+        """ Test that delayed tasks don't hold a worker while waiting """
+        task_queue = TaskQueue(threads=1)
+        start = time.time()
+        delayed = task_queue.put_task(Task(time.time), delay=0.2)
+        self.assertEqual(task_queue.put(int, "1").get_result(timeout=5), 1)
+        self.assertLess(time.time() - start, 0.2)
+        self.assertGreaterEqual(delayed.get_result(timeout=5) - start, 0.19)
+
+        # Cancelling a delayed task keeps it from ever running
+        counter = []
+        delayed = task_queue.put_task(Task(counter.append, 1), delay=0.1)
+        self.assertTrue(delayed.cancel())
+        time.sleep(0.2)
+        self.assertEqual(counter, [])
+        task_queue.shutdown()
+
+    def test_poll(self):
+        """ Test polling until a result is ready """
+        values = [None, None, 3]
+        task = poll(lambda: values.pop(0), interval=0.05,
+                    task_queue=self.task_queue)
+        self.assertEqual(task.get_result(timeout=5), 3)
+
+        task = poll(lambda: None, interval=0.05, timeout=0.2,
+                    task_queue=self.task_queue)
+        self.assertRaises(TimeoutError, task.get_result, 5)
+
+    def test_fabric_settings(self):
+        """ Test that fabric nodes use the fabric's limits and timeout """
+        fabric = Fabric(DummyNode.ip_addresses[0], node=DummyNode,
+                        task_queue=self.task_queue, command_timeout=0.2)
+        fabric._nodes = {0: DummyNode(DummyNode.ip_addresses[0])}
+        async_node = AsyncFabric(fabric).nodes[0]
+        self.assertEqual(async_node._put_kwargs()["rate_keys"],
+                         fabric.get_rate_keys(async_node.node))
+        self.assertEqual(async_node.lane, fabric.task_lane)
+
+        task = async_node.submit(time.sleep, 1)
+        self.assertRaises(TimeoutError, task.get_result, 5)
+
+        # Poll attempts get the timeout after their delay, not before it
+        task = async_node.poll(lambda: True, delay=0.5)
+        self.assertEqual(task.get_result(timeout=5), True)
+        task = async_node.poll(lambda: time.sleep(1), delay=0)
+        self.assertRaises(TimeoutError, task.get_result, 5)
+
+    def test_then(self):
+        """ Test chaining continuations onto tasks """
+        task = then(self.nodes[0].get_power(), lambda x: not x)
+        self.assertEqual(task.get_result(timeout=5), True)
+
+        inner = Event()
+        task = then(self.task_queue.put(int, "1"),
+                    lambda x: self.task_queue.put(inner.wait))
+        self.assertFalse(task.join(timeout=0.05))
+        inner.set()
+        self.assertTrue(task.get_result(timeout=5))
+
+        task = then(self.task_queue.put(int, "x"), lambda x: x)
+        self.assertRaises(ValueError, task.get_result, 5)
+
+    def test_mc_reset(self):
+        """ Test an mc_reset that doesn't wait """
+        node = self.nodes[0]
+        node.node.get_firmware_info()
+        node.mc_reset().get_result(timeout=5)
+        self.assertTrue(node.node.bmc.mc_reset.called)
+
+        # The node's caches are dropped
+        node.node.get_firmware_info()
+        self.assertEqual(node.node.bmc.get_firmware_info.call_count, 2)
+
+    def test_wait_for_transfer(self):
+        """ Test waiting for a firmware transfer """
+        node = self.nodes[0]
+        self.assertTrue(node.wait_for_transfer(0).get_result(timeout=5))
+
+    def test_fabric_tftp_command(self):
+        """ Test a fabric TFTP command that falls back to the TFTP server """
+        node = self.nodes[0]
+        task = node.run_fabric_tftp_command("fabric_config_get_ip_info")
+        contents = task.get_result(timeout=15)
+        self.assertTrue(contents.startswith("Node 0: "))
+
+        # The working transport is remembered, so the ECME isn't retried
+        self.assertEqual(node.node._get_transport(), "host")
+        get_ip_info = node.node.bmc.fabric_config_get_ip_info
+        node.run_fabric_tftp_command("fabric_config_get_ip_info").join()
+        self.assertEqual(get_ip_info.call_count, 4)
+
+    def test_concurrent_fabric_refresh(self):
+        """ Test concurrent async refreshes on a small task queue """
+        class FabricNode(DummyNode):
+            """ Dummy node that reports a whole fabric, slowly """
+            @staticmethod
+            def get_fabric_ipinfo():
+                """ Report every dummy IP address """
+                time.sleep(0.1)
+                return dict(enumerate(DummyNode.ip_addresses))
+
+        fabric = AsyncFabric(Fabric(DummyNode.ip_addresses[0],
+                                    node=FabricNode,
+                                    task_queue=self.task_queue))
+        tasks = [fabric.refresh(), fabric.refresh(), fabric.refresh(True, 5)]
+        gather(tasks, timeout=10)
+        self.assertEqual(len(fabric.nodes), len(DummyNode.ip_addresses))
@@ -0,0 +1,103 @@
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-public-methods
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+"""Unit tests for the Cluster class."""
+
+import unittest
+from mock import call
+
+from cxmanage_api.cluster import Cluster
+from cxmanage_api.cx_exceptions import CommandFailedError
+from cxmanage_api.tests import DummyNode
+
+
+FABRICS = {
+    "10.0.0.1": ["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+    "10.0.1.1": ["10.0.1.1", "10.0.1.2"],
+    # Overlaps with the first fabric
+    "10.0.0.2": ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+}
+
+
+class ClusterNode(DummyNode):
+    """ Dummy node that reports its fabric, with GUIDs by IP address """
+
+    @property
+    def guid(self):
+        """ GUID of this node """
+        return "GUID %s" % self.ip_address
+
+    def get_fabric_ipinfo(self):
+        """ Report the nodes of this node's fabric """
+        return dict(enumerate(FABRICS[self.ip_address]))
+
+
+class ClusterTest(unittest.TestCase):
+    """ Tests for Cluster """
+
+    def setUp(self):
+        self.cluster = Cluster(sorted(FABRICS), node=ClusterNode)
+
+    def test_nodes(self):
+        """ Test that nodes are discovered and deduplicated by GUID """
+        nodes = self.cluster.nodes
+        self.assertEqual(sorted(nodes), sorted(
+            "GUID %s" % x for x in FABRICS["10.0.0.1"] + FABRICS["10.0.1.1"]
+        ))
+        self.assertEqual(len(self.cluster.fabrics), 3)
+        self.assertEqual(self.cluster.get_fabric("GUID 10.0.1.2").ip_address,
+                         "10.0.1.1")
+        self.assertEqual(self.cluster.get_fabric("GUID 10.0.0.3").ip_address,
+                         "10.0.0.1")
+
+    def test_fanout(self):
+        """ Test running fabric commands across the cluster """
+        results = self.cluster.get_power()
+        self.assertEqual(results, dict((x, False) for x in self.cluster.nodes))
+
+        tasks = self.cluster.set_power("on", async=True)
+        for guid, task in tasks.iteritems():
+            task.join()
+            node = self.cluster.nodes[guid]
+            self.assertEqual(node.method_calls[-1], call.set_power("on"))
+
+        with self.assertRaises(AttributeError):
+            self.cluster.get_uplink_mode()
+
+    def test_refresh_failure(self):
+        """ Test that one failed fabric doesn't hide the others """
+        cluster = Cluster(["10.0.0.1", "10.0.9.9"], node=ClusterNode)
+        with self.assertRaises(CommandFailedError) as context:
+            cluster.refresh()
+        self.assertEqual(context.exception.errors.keys(), ["10.0.9.9"])
+        self.assertEqual(len(cluster.nodes), 3)
@@ -0,0 +1,140 @@
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-public-methods
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+"""Unit tests for the fabric discovery cache."""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cxmanage_api.discovery_cache import DiscoveryCache
+from cxmanage_api.fabric import Fabric
+from cxmanage_api.tests import DummyNode
+
+
+ENTRIES = [
+    {"node_id": x, "ip_address": y, "guid": "GUID %s" % y}
+    for x, y in enumerate(DummyNode.ip_addresses)
+]
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+    """ Tests for DiscoveryCache """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cxmanage_test-")
+        self.cache = DiscoveryCache(os.path.join(self.directory, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_load(self):
+        """ Test saving, loading and invalidating cached nodes """
+        head = ENTRIES[0]["ip_address"]
+        self.assertEqual(self.cache.load(head), None)
+
+        self.cache.save(head, ENTRIES)
+        self.assertEqual(self.cache.load(head), ENTRIES)
+        self.assertEqual(self.cache.load(ENTRIES[1]["ip_address"]), None)
+        self.assertEqual(os.listdir(os.path.dirname(self.cache.path(head))),
+                         ["%s.json" % head])
+
+        self.cache.invalidate(head)
+        self.assertEqual(self.cache.load(head), None)
+        self.cache.invalidate(head)
+
+    def test_ttl(self):
+        """ Test that expired or corrupt entries aren't used """
+        head = ENTRIES[0]["ip_address"]
+        self.cache.save(head, ENTRIES)
+        with open(self.cache.path(head)) as cache_file:
+            data = json.load(cache_file)
+        data["timestamp"] = time.time() - self.cache.ttl - 1
+        with open(self.cache.path(head), "w") as cache_file:
+            json.dump(data, cache_file)
+        self.assertEqual(self.cache.load(head), None)
+
+        with open(self.cache.path(head), "w") as cache_file:
+            cache_file.write("{")
+        self.assertEqual(self.cache.load(head), None)
+
+    def test_sample(self):
+        """ Test that spot checks include the fabric head """
+        head = ENTRIES[2]["ip_address"]
+        sample = self.cache.sample(head, ENTRIES)
+        self.assertEqual(len(sample), 2)
+        self.assertEqual(sample[0], ENTRIES[2])
+        self.assertNotEqual(sample[1], ENTRIES[2])
+
+        self.cache.spot_checks = 100
+        self.assertEqual(len(self.cache.sample(head, ENTRIES)), len(ENTRIES))
+
+    def test_fabric_refresh(self):
+        """ Test that a fabric reuses its cached topology """
+        class FabricNode(DummyNode):
+            """ Dummy node that reports a whole fabric """
+            ipinfo_calls = []
+
+            @staticmethod
+            def get_fabric_ipinfo():
+                """ Report every dummy IP address """
+                FabricNode.ipinfo_calls.append(1)
+                return dict(enumerate(DummyNode.ip_addresses))
+
+        head = DummyNode.ip_addresses[0]
+        fabric = Fabric(head, node=FabricNode, discovery_cache=self.cache)
+        guids = dict((x, y.guid) for x, y in fabric.nodes.iteritems())
+        self.assertEqual(len(FabricNode.ipinfo_calls), 1)
+        self.assertEqual([x["guid"] for x in self.cache.load(head)],
+                         [guids[x] for x in sorted(guids)])
+
+        # GUIDs of dummy nodes are unique, so fake a matching spot check
+        self.cache.save(head, [
+            {"node_id": x, "ip_address": y, "guid": "FAKEGUID%s" % x}
+            for x, y in enumerate(DummyNode.ip_addresses)
+        ])
+        self.cache.sample = lambda head, entries: []
+        fabric = Fabric(head, node=FabricNode, discovery_cache=self.cache)
+        self.assertEqual(len(fabric.nodes), len(DummyNode.ip_addresses))
+        self.assertEqual(len(FabricNode.ipinfo_calls), 1)
+        self.assertEqual(fabric.nodes[3].guid, "FAKEGUID3")
+
+        # A failed spot check means a full refresh
+        del self.cache.sample
+        fabric = Fabric(head, node=FabricNode, discovery_cache=self.cache)
+        self.assertEqual(len(fabric.nodes), len(DummyNode.ip_addresses))
+        self.assertEqual(len(FabricNode.ipinfo_calls), 2)
+
@@ -67,6 +67,11 @@ class DummyNode(Dummy):
         """Returns the node GUID"""
         return self.bmc.unique_guid
 
+    @guid.setter
+    def guid(self, value):
+        """Sets the node GUID"""
+        self.bmc.unique_guid = value
+
     @property
     def chassis_id(self):
         """Returns the chasis ID."""
@@ -41,5 +41,5 @@ class DummyUbootEnv(UbootEnv):
         return ["disk", "pxe"]
 
     def set_boot_order(self, boot_args):
-        """ Do nothing """
-        pass
+        """ Just store the boot order """
+        self.variables["bootcmd0"] = " ".join(boot_args)
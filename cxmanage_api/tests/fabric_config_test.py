@@ -0,0 +1,205 @@
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-public-methods
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+"""Unit tests for fabric configuration snapshots."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cxmanage_api.fabric import Fabric
+from cxmanage_api.fabric_config import FabricConfig
+from cxmanage_api.tests import DummyNode
+
+
+SETTINGS = {
+    "ipsrc": 2,
+    "uplink_mode": 0,
+    "linkspeed": 2.5,
+    "linkspeed_policy": 1,
+    "link_users_factor": 1,
+    "macaddr_base": "08:00:00:00:08:5c",
+    "macaddr_mask": "ff:ff:ff:00:00:00",
+    "uplinks": {0: 0, 1: 0, 2: 0},
+    "networks": {"default_eth0": False, "foo": True},
+    "network_uplinks": {"default_eth0": [0], "foo": [0, 1]},
+    "network_assignments": {0: "default_eth0", 1: "foo", 2: "foo"}
+}
+
+
+class ConfigFabric(Fabric):
+    """ Fabric with its configuration kept in memory """
+
+    def __init__(self, settings):
+        super(ConfigFabric, self).__init__(DummyNode.ip_addresses[0],
+                                           node=DummyNode)
+        self._nodes = {0: DummyNode(DummyNode.ip_addresses[0])}
+        self.settings = settings
+        self.calls = []
+
+    def __getattribute__(self, name):
+        settings = object.__getattribute__(self, "__dict__").get("settings")
+        if settings is None or not name[:4] in ("get_", "set_"):
+            return object.__getattribute__(self, name)
+
+        key = name[4:]
+        if key in ("uplink", "network_assignment"):
+            def function(*args, **kwargs):
+                """ Per-interface settings """
+                if name.startswith("get_"):
+                    return settings[key + "s"][args[0]]
+                self.calls.append((name, kwargs))
+                settings["uplinks"][kwargs["iface"]] = kwargs["uplink"]
+            return function
+        if key == "networks":
+            return lambda: dict(settings["networks"])
+        if name == "get_uplinks":
+            def get_uplinks():
+                """ Networks on each uplink """
+                uplinks = {}
+                for network, values in settings["network_uplinks"].items():
+                    for uplink in values:
+                        uplinks.setdefault(uplink, []).append(network)
+                return uplinks
+            return get_uplinks
+        if key in settings:
+            if name.startswith("get_"):
+                return lambda: settings[key]
+            def setter(**kwargs):
+                """ Fabric-wide settings """
+                self.calls.append((name, kwargs))
+                settings[key] = kwargs.values()[0]
+            return setter
+        return object.__getattribute__(self, name)
+
+    def add_network(self, name, private=False):
+        """ Record adding a network """
+        self.calls.append(("add_network", name, private))
+
+    def remove_network(self, name):
+        """ Record removing a network """
+        self.calls.append(("remove_network", name))
+
+    def assign_network_to_uplink(self, name, uplink):
+        """ Record assigning a network to an uplink """
+        self.calls.append(("assign_network_to_uplink", name, uplink))
+
+    def unassign_network_from_uplink(self, name, uplink):
+        """ Record unassigning a network from an uplink """
+        self.calls.append(("unassign_network_from_uplink", name, uplink))
+
+    def assign_interface_to_network(self, interface, network):
+        """ Record a network assignment """
+        self.calls.append(("assign_interface_to_network", interface,
+                           network))
+
+    def update_config(self):
+        """ Record pushing out the config """
+        self.calls.append(("update_config",))
+
+
+class FabricConfigTest(unittest.TestCase):
+    """ Tests for FabricConfig """
+
+    def setUp(self):
+        self.fabric = ConfigFabric(dict(
+            (x, dict(y) if isinstance(y, dict) else y)
+            for x, y in SETTINGS.iteritems()
+        ))
+
+    def test_fetch(self):
+        """ Test reading a fabric's configuration """
+        self.assertEqual(self.fabric.get_config(), FabricConfig(SETTINGS))
+
+    def test_save_load(self):
+        """ Test saving and loading a configuration """
+        directory = tempfile.mkdtemp(prefix="cxmanage_test-")
+        try:
+            path = os.path.join(directory, "config.json")
+            FabricConfig(SETTINGS).save(path)
+            self.assertEqual(FabricConfig.load(path), FabricConfig(SETTINGS))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_diff(self):
+        """ Test comparing configurations """
+        current = FabricConfig(SETTINGS)
+        self.assertEqual(current.diff(current), {})
+        desired = FabricConfig({
+            "linkspeed": 10.0,
+            "ipsrc": 2,
+            "uplinks": {1: 1},
+            "networks": {"default_eth0": False, "bar": False}
+        })
+        self.assertEqual(current.diff(desired), {
+            "linkspeed": (2.5, 10.0),
+            "uplinks": ({1: 0}, {1: 1}),
+            "networks": ({"foo": True}, {"bar": False})
+        })
+
+    def test_apply(self):
+        """ Test applying only the settings that changed """
+        desired = FabricConfig({
+            "linkspeed": 10.0, "ipsrc": 2, "uplinks": {1: 1}
+        })
+        changes = self.fabric.apply_config(desired)
+        self.assertEqual(sorted(changes), ["linkspeed", "uplinks"])
+        self.assertEqual(self.fabric.calls, [
+            ("set_linkspeed", {"linkspeed": 10.0}),
+            ("set_uplink", {"uplink": 1, "iface": 1}),
+            ("update_config",)
+        ])
+
+        del self.fabric.calls[:]
+        self.assertEqual(self.fabric.apply_config(desired), {})
+        self.assertEqual(self.fabric.calls, [])
+
+    def test_apply_private(self):
+        """ Test that a network re-added to change its private flag gets its
+        uplinks and interfaces back """
+        desired = FabricConfig({
+            "networks": {"default_eth0": False, "foo": False},
+            "network_uplinks": {"default_eth0": [0, 1]}
+        })
+        self.fabric.apply_config(desired)
+        self.assertEqual(self.fabric.calls, [
+            ("remove_network", "foo"),
+            ("add_network", "foo", False),
+            ("assign_network_to_uplink", "default_eth0", 1),
+            ("assign_network_to_uplink", "foo", 0),
+            ("assign_network_to_uplink", "foo", 1),
+            ("assign_interface_to_network", 1, "foo"),
+            ("assign_interface_to_network", 2, "foo"),
+            ("update_config",)
+        ])
@@ -34,10 +34,13 @@
 """Calxeda: fabric_test.py """
 
 import random
+import time
 import unittest
+from threading import Thread
 from mock import call
 
 from cxmanage_api.fabric import Fabric
+from cxmanage_api.tasks import TaskQueue
 from cxmanage_api.tftp import InternalTftp, ExternalTftp
 from cxmanage_api.firmware_package import FirmwarePackage
 from cxmanage_api.cx_exceptions import CommandFailedError
@@ -79,8 +82,19 @@ class FabricTest(unittest.TestCase):
 
     def test_get_uplink_info(self):
         """ Test get_uplink_info command """
-        self.fabric.get_uplink_info()
-        for node in self.nodes:
+        results = self.fabric.get_uplink_info()
+        self.assertEqual(sorted(results), range(len(self.nodes)))
+
+        # Node 0 isn't in the dummy fabric-wide info, so it's asked directly
+        self.assertEqual(self.nodes[0].method_calls, [
+            call.get_fabric_uplink_info(), call.get_uplink_info()
+        ])
+        for node in self.nodes[1:]:
+            self.assertEqual(node.method_calls, [])
+
+        for task in self.fabric.get_uplink_info(async=True).values():
+            task.join()
+        for node in self.nodes[1:]:
             self.assertEqual(node.method_calls, [call.get_uplink_info()])
 
     def test_get_uplink_speed(self):
@@ -115,7 +129,8 @@ class FabricTest(unittest.TestCase):
         """ Test get_firmware_info command """
         self.fabric.get_firmware_info()
         for node in self.nodes:
-            self.assertEqual(node.method_calls, [call.get_firmware_info()])
+            self.assertEqual(node.method_calls,
+                             [call.get_firmware_info(False)])
 
     def test_is_updatable(self):
         """ Test is_updatable command """
@@ -170,6 +185,15 @@ class FabricTest(unittest.TestCase):
         for node in self.nodes:
             self.assertEqual(node.method_calls, [call.get_pxe_interface()])
 
+    def test_update_ubootenv(self):
+        """ Test update_ubootenv command """
+        self.fabric.update_ubootenv(boot_args=["disk", "pxe"],
+                                    interface="eth1")
+        for node in self.nodes:
+            self.assertEqual(node.method_calls, [
+                call.update_ubootenv(["disk", "pxe"], "eth1", None)
+            ])
+
     def test_get_versions(self):
         """ Test get_versions command """
         self.fabric.get_versions()
@@ -212,6 +236,16 @@ class FabricTest(unittest.TestCase):
             for node in fail_nodes:
                 self.assertEqual(node.method_calls, [call.get_power()])
 
+    def test_sharded_command(self):
+        """ Test a command sharded across worker processes """
+        self.fabric.processes = 2
+        self.assertEqual(
+            self.fabric.get_power_policy(),
+            dict((i, "always-off") for i in xrange(len(self.nodes)))
+        )
+        tasks = self.fabric.get_power_policy(async=True)
+        self.assertEqual(sorted(tasks.keys()), range(len(self.nodes)))
+
     def test_primary_node(self):
         """Test the primary_node property
 
@@ -423,6 +457,86 @@ class FabricTest(unittest.TestCase):
             else:
                 self.assertEqual(node.bmc.method_calls, [])
 
+    def test_select(self):
+        """ Test selecting some of the fabric's nodes """
+        self.assertEqual(sorted(self.fabric.select().nodes),
+                         range(len(self.nodes)))
+        self.assertEqual(self.fabric.select(1).nodes, {1: self.nodes[1]})
+        self.assertEqual(sorted(self.fabric.select(xrange(1, 3)).nodes),
+                         [1, 2])
+        self.assertEqual(sorted(self.fabric.select(
+            set([self.nodes[0].guid, 3])
+        ).nodes), [0, 3])
+        self.assertEqual(sorted(self.fabric.select(
+            lambda node: node.ip_address != DummyNode.ip_addresses[0]
+        ).nodes), range(1, len(self.nodes)))
+        self.assertEqual(sorted(self.fabric.select(every=2, offset=1).nodes),
+                         range(1, len(self.nodes), 2))
+
+        selection = self.fabric.select([1, 3])
+        self.assertEqual(sorted(selection.get_power()), [1, 3])
+        self.assertTrue(selection.primary_node is self.nodes[0])
+        for node in self.nodes:
+            self.assertEqual(len(node.method_calls),
+                             1 if node in [self.nodes[1], self.nodes[3]]
+                             else 0)
+
+    def test_shards(self):
+        """ Test splitting the fabric into shards """
+        shards = self.fabric.shards(3)
+        self.assertEqual([sorted(x.nodes) for x in shards],
+                         [[0, 1], [2], [3]])
+        shards = self.fabric.shards(8, xrange(2))
+        self.assertEqual([sorted(x.nodes) for x in shards], [[0], [1]])
+        with self.assertRaises(ValueError):
+            self.fabric.shards(0)
+
+    def test_map(self):
+        """ Test running a function on every node """
+        def get_ip_address(node, suffix=""):
+            """ Check the node's power and return its address """
+            node.get_power()
+            return node.ip_address + suffix
+
+        results = self.fabric.map(get_ip_address, suffix="!")
+        self.assertEqual(results, dict(
+            (x, y.ip_address + "!") for x, y in self.fabric.nodes.iteritems()
+        ))
+
+        self.fabric._nodes[2] = DummyFailNode(DummyNode.ip_addresses[2])
+        with self.assertRaises(CommandFailedError):
+            self.fabric.map(get_ip_address)
+
+        results, errors = self.fabric.map_partial(get_ip_address)
+        self.assertEqual(sorted(results), [0, 1, 3])
+        self.assertEqual(errors.keys(), [2])
+        self.assertTrue(isinstance(errors[2], DummyFailNode.DummyFailError))
+
+        tasks = self.fabric.for_each(get_ip_address)
+        for node_id, task in tasks.iteritems():
+            task.join()
+            self.assertEqual(task.status,
+                             "Failed" if node_id == 2 else "Completed")
+
+    def test_iter_results(self):
+        """ Test streaming results as nodes finish """
+        self.nodes[2] = DummyFailNode(DummyNode.ip_addresses[2])
+        self.fabric._nodes[2] = self.nodes[2]
+
+        results = dict(self.fabric.iter_results("get_power"))
+        self.assertEqual(sorted(results), range(len(self.nodes)))
+        for node_id, result in results.iteritems():
+            if node_id == 2:
+                self.assertTrue(isinstance(result,
+                                           DummyFailNode.DummyFailError))
+            else:
+                self.assertEqual(result, False)
+
+        results = list(self.fabric.iter_results("bmc.get_chassis_status"))
+        self.assertEqual(len(results), len(self.nodes))
+        for _, result in results:
+            self.assertFalse(result.power_on)
+
     def test_composite_bmc(self):
         """ Test the CompositeBMC member """
         with self.assertRaises(AttributeError):
@@ -441,4 +555,165 @@ class FabricTest(unittest.TestCase):
                 call.get_chassis_status()
             ])
 
-
+    def test_refresh(self):
+        """ Test that refresh() looks up GUIDs in parallel """
+        class FabricNode(DummyNode):
+            """ Dummy node that reports a whole fabric """
+            in_flight = []
+            peak = []
+
+            @property
+            def guid(self):
+                """ Track the number of GUID lookups at once """
+                FabricNode.in_flight.append(self)
+                FabricNode.peak.append(len(FabricNode.in_flight))
+                time.sleep(0.01)
+                FabricNode.in_flight.remove(self)
+                if self.ip_address == DummyNode.ip_addresses[2]:
+                    raise DummyFailNode.DummyFailError
+                return "GUID %s" % self.ip_address
+
+            @staticmethod
+            def get_fabric_ipinfo():
+                """ Report every dummy IP address """
+                return dict(enumerate(DummyNode.ip_addresses))
+
+        fabric = Fabric(DummyNode.ip_addresses[0], node=FabricNode)
+        fabric.DISCOVERY_CONCURRENCY = 2
+        with self.assertRaises(CommandFailedError) as context:
+            fabric.refresh()
+        self.assertEqual(context.exception.errors.keys(), [2])
+        self.assertEqual(len(context.exception.results),
+                         len(DummyNode.ip_addresses) - 1)
+        self.assertLessEqual(max(FabricNode.peak), 2)
+
+        FabricNode.get_fabric_ipinfo = staticmethod(
+            lambda: dict(enumerate(DummyNode.ip_addresses[:2]))
+        )
+        fabric.refresh()
+        self.assertEqual(sorted(fabric.nodes), [0, 1])
+        for node_id, node in fabric.nodes.iteritems():
+            self.assertEqual(node.node_id, node_id)
+            self.assertEqual(node.ip_address,
+                             DummyNode.ip_addresses[node_id])
+
+    def test_refresh_on_worker(self):
+        """ Test that a refresh on the fabric's own task queue still looks up
+        GUIDs in parallel """
+        class FabricNode(DummyNode):
+            """ Dummy node that reports a whole fabric """
+            in_flight = []
+            peak = []
+
+            @property
+            def guid(self):
+                """ Track the number of GUID lookups at once """
+                FabricNode.in_flight.append(self)
+                FabricNode.peak.append(len(FabricNode.in_flight))
+                time.sleep(0.05)
+                FabricNode.in_flight.remove(self)
+                return "GUID %s" % self.ip_address
+
+            @staticmethod
+            def get_fabric_ipinfo():
+                """ Report every dummy IP address """
+                return dict(enumerate(DummyNode.ip_addresses))
+
+        task_queue = TaskQueue(threads=1)
+        fabric = Fabric(DummyNode.ip_addresses[0], node=FabricNode,
+                        task_queue=task_queue)
+        task_queue.put(fabric.refresh).get_result(timeout=10)
+        self.assertEqual(len(fabric.nodes), len(DummyNode.ip_addresses))
+        self.assertGreater(max(FabricNode.peak), 1)
+        task_queue.shutdown()
+
+    def test_refresh_single_flight(self):
+        """ Test that concurrent refreshes share one discovery """
+        class FabricNode(DummyNode):
+            """ Dummy node that reports a whole fabric, slowly """
+            ipinfo_calls = []
+
+            @staticmethod
+            def get_fabric_ipinfo():
+                """ Report every dummy IP address """
+                FabricNode.ipinfo_calls.append(1)
+                time.sleep(0.1)
+                return dict(enumerate(DummyNode.ip_addresses))
+
+        fabric = Fabric(DummyNode.ip_addresses[0], node=FabricNode)
+        threads = [Thread(target=lambda: fabric.nodes) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(FabricNode.ipinfo_calls), 1)
+        self.assertEqual(len(fabric.nodes), len(DummyNode.ip_addresses))
+
+    def test_refresh_interrupted(self):
+        """ Test that an interrupted refresh doesn't strand its followers """
+        class FabricNode(DummyNode):
+            """ Dummy node whose first fabric lookup is interrupted """
+            ipinfo_calls = []
+
+            @staticmethod
+            def get_fabric_ipinfo():
+                """ Report every dummy IP address, slowly """
+                FabricNode.ipinfo_calls.append(1)
+                time.sleep(0.1)
+                if len(FabricNode.ipinfo_calls) == 1:
+                    raise KeyboardInterrupt
+                return dict(enumerate(DummyNode.ip_addresses))
+
+        fabric = Fabric(DummyNode.ip_addresses[0], node=FabricNode)
+        interrupted = []
+
+        def leader():
+            """ The refresh that gets interrupted """
+            try:
+                fabric.refresh()
+            except KeyboardInterrupt:
+                interrupted.append(1)
+
+        threads = [Thread(target=leader)]
+        threads[0].start()
+        time.sleep(0.05)
+        threads.append(Thread(target=fabric.refresh))
+        threads[1].daemon = True
+        threads[1].start()
+        for thread in threads:
+            thread.join(5)
+        self.assertFalse(threads[1].is_alive())
+        self.assertEqual(interrupted, [1])
+        self.assertEqual(len(FabricNode.ipinfo_calls), 2)
+        self.assertEqual(len(fabric.nodes), len(DummyNode.ip_addresses))
+
+    def test_refresh_incremental(self):
+        """ Test that incremental refreshes keep unchanged nodes """
+        ipinfo = dict(enumerate(DummyNode.ip_addresses))
+
+        class FabricNode(DummyNode):
+            """ Dummy node that reports a whole fabric """
+            guid_lookups = []
+
+            @property
+            def guid(self):
+                """ Count GUID lookups """
+                FabricNode.guid_lookups.append(self.ip_address)
+                return self.bmc.unique_guid
+
+            @staticmethod
+            def get_fabric_ipinfo():
+                """ Report the current IP addresses """
+                return dict(ipinfo)
+
+        fabric = Fabric(DummyNode.ip_addresses[0], node=FabricNode)
+        old_nodes = dict(fabric.nodes)
+
+        ipinfo[3] = "192.168.100.250"
+        del FabricNode.guid_lookups[:]
+        fabric.refresh(incremental=True)
+        self.assertEqual(FabricNode.guid_lookups.count("192.168.100.250"),
+                         1)
+        for node_id in xrange(3):
+            self.assertTrue(fabric.nodes[node_id] is old_nodes[node_id])
+        self.assertEqual(fabric.nodes[3].ip_address, "192.168.100.250")
@@ -32,15 +32,20 @@
 
 """Unit tests for the Node class."""
 
+import os
+import time
 import shutil
 import tempfile
 import unittest
-from mock import call
+from threading import Event, Thread
+from mock import Mock, call
 
 from cxmanage_api.tests import DummyBMC, DummyUbootEnv, DummyIPRetriever
 from cxmanage_api.tests import TestImage, random_file
+from cxmanage_api import temp_file
 from cxmanage_api.node import Node
 from cxmanage_api.firmware_package import FirmwarePackage
+from cxmanage_api.cx_exceptions import TaskCancelledError
 
 
 class NodeTest(unittest.TestCase):
@@ -122,6 +127,132 @@ class NodeTest(unittest.TestCase):
                 result["Board Temp"].sensor_reading.endswith("degrees C")
             )
 
+    def test_get_firmware_info(self):
+        """ Test node.get_firmware_info caching """
+        for node in self.nodes:
+            result = node.get_firmware_info()
+            self.assertEqual(node.bmc.method_calls, [call.get_firmware_info()])
+            self.assertEqual(len(result), len(node.bmc.partitions))
+
+            # Cached, and callers get their own copies
+            result[0].version = "changed"
+            self.assertNotEqual(node.get_firmware_info()[0].version,
+                                "changed")
+            node.get_versions()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 1)
+
+            # Forced, expired and invalidated reads go to the node
+            node.get_firmware_info(fresh=True)
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 2)
+            node.FIRMWARE_INFO_TTL = -1
+            node.get_firmware_info()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 3)
+            del node.FIRMWARE_INFO_TTL
+
+            node.set_boot_order(["disk"])
+            count = node.bmc.get_firmware_info.call_count
+            node.get_firmware_info()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, count + 1)
+
+            node.mc_reset()
+            node.get_firmware_info()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, count + 2)
+
+    def test_coalesce(self):
+        """ Test that concurrent identical reads share one IPMI command """
+        node = self.nodes[0]
+        started = Event()
+        release = Event()
+
+        def get_chassis_status():
+            """ Slow chassis status """
+            started.set()
+            release.wait()
+            if isinstance(outcome, Exception):
+                raise outcome
+            return Mock(power_on=outcome)
+        node.bmc.get_chassis_status = Mock(side_effect=get_chassis_status)
+
+        def run(count):
+            """ Call get_power from several threads at once """
+            results = []
+
+            def get_power():
+                """ Record the result or error """
+                try:
+                    results.append(node.get_power())
+                except Exception as error:  # pylint: disable=W0703
+                    results.append(error)
+
+            threads = [Thread(target=get_power) for _ in range(count)]
+            threads[0].start()
+            started.wait()
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+            started.clear()
+            release.clear()
+            return results
+
+        outcome = True
+        self.assertEqual(run(5), [True] * 5)
+        self.assertEqual(node.bmc.get_chassis_status.call_count, 1)
+
+        outcome = ValueError("failed")
+        self.assertEqual(run(3), [outcome] * 3)
+        self.assertEqual(node.bmc.get_chassis_status.call_count, 2)
+
+        # Nothing in flight, so the next call goes to the BMC again
+        outcome = False
+        release.set()
+        self.assertEqual(node.get_power(), False)
+        self.assertEqual(node.bmc.get_chassis_status.call_count, 3)
+
+    def test_coalesce_cancelled(self):
+        """ Test that a cancelled call isn't shared with the callers waiting
+        on it """
+        node = self.nodes[0]
+        started = Event()
+        release = Event()
+        outcomes = [TaskCancelledError("Task was cancelled")]
+
+        def get_chassis_status():
+            """ Slow chassis status, cancelled the first time """
+            outcome = outcomes.pop(0) if outcomes else True
+            if isinstance(outcome, Exception):
+                started.set()
+                release.wait()
+                raise outcome
+            return Mock(power_on=outcome)
+        node.bmc.get_chassis_status = Mock(side_effect=get_chassis_status)
+
+        results = {}
+
+        def get_power(name):
+            """ Record the result or error """
+            try:
+                results[name] = node.get_power()
+            except Exception as error:  # pylint: disable=W0703
+                results[name] = error
+
+        leader = Thread(target=get_power, args=("leader",))
+        leader.start()
+        started.wait()
+        waiters = [Thread(target=get_power, args=(x,)) for x in range(2)]
+        for thread in waiters:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + waiters:
+            thread.join()
+
+        self.assertTrue(isinstance(results["leader"], TaskCancelledError))
+        self.assertEqual([results[0], results[1]], [True, True])
+        self.assertTrue(node.bmc.get_chassis_status.call_count > 1)
+
     def test_is_updatable(self):
         """ Test node.is_updatable method """
         for node in self.nodes:
@@ -274,10 +405,93 @@ class NodeTest(unittest.TestCase):
 
             self.assertEqual(result, ["disk", "pxe"])
 
+    def test_firmware_info_invalidation(self):
+        """ Test when the firmware info cache is and isn't dropped """
+        for node in self.nodes:
+            node.get_firmware_info()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 1)
+
+            # Refreshing from the same node at the same address keeps it
+            node.guid = "guid"
+            same = Node(ip_address=node.ip_address, bmc=DummyBMC)
+            same.guid = "guid"
+            node.refresh(same)
+            node.get_firmware_info()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 1)
+
+            # A read that lands while the reset is going on isn't kept
+            node.bmc.mc_reset = Mock(
+                side_effect=lambda *args: node.get_firmware_info()
+            )
+            node.mc_reset()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 2)
+            node.get_firmware_info()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 3)
+
+            # A new address drops it
+            moved = Node(ip_address="192.168.100.250", bmc=DummyBMC)
+            moved.guid = "guid"
+            node.refresh(moved)
+            node.get_firmware_info()
+            self.assertEqual(node.bmc.get_firmware_info.call_count, 4)
+
+    def test_get_ubootenv(self):
+        """ Test node.get_ubootenv caching """
+        for node in self.nodes:
+            ubootenv_partition = node.bmc.partitions[5]
+
+            node.get_ubootenv().set_boot_order(["pxe"])
+            self.assertEqual(node.get_boot_order(), ["disk", "pxe"])
+            node.get_pxe_interface()
+            self.assertEqual(ubootenv_partition.retrieves, 1)
+
+            # Still cached when the partition table is re-read...
+            node.get_firmware_info(fresh=True)
+            node.get_boot_order()
+            self.assertEqual(ubootenv_partition.retrieves, 1)
+
+            # ...but not when the partition changes
+            node.bmc.partitions[5].fwinfo.priority = "%8x" % 20
+            node.get_firmware_info(fresh=True)
+            node.get_boot_order()
+            self.assertEqual(ubootenv_partition.retrieves, 2)
+
+            # ...or it's written through this node
+            node.set_pxe_interface("eth1")
+            node.get_boot_order()
+            self.assertEqual(ubootenv_partition.retrieves, 3)
+
+    def test_edit_ubootenv(self):
+        """ Test node.edit_ubootenv and node.update_ubootenv """
+        for node in self.nodes:
+            ubootenv_partition = node.bmc.partitions[5]
+
+            # Several changes, one download and one upload
+            node.update_ubootenv(boot_args=["disk"], interface="eth1",
+                                 variables={"bootdelay": "3"})
+            self.assertEqual(ubootenv_partition.retrieves, 1)
+            self.assertEqual(ubootenv_partition.updates, 1)
+            self.assertEqual(ubootenv_partition.activates, 1)
+
+            # An aborted edit writes nothing
+            def abort():
+                """ Raise inside the edit """
+                with node.edit_ubootenv() as ubootenv:
+                    ubootenv.variables["bootdelay"] = "5"
+                    raise ValueError()
+            self.assertRaises(ValueError, abort)
+            self.assertEqual(ubootenv_partition.updates, 1)
+
+            # No changes, no upload
+            with node.edit_ubootenv() as ubootenv:
+                ubootenv.set_pxe_interface(ubootenv.get_pxe_interface())
+            self.assertEqual(ubootenv_partition.updates, 1)
+            self.assertEqual(ubootenv_partition.retrieves, 2)
+
     def test_set_pxe_interface(self):
         """ Test node.set_pxe_interface method """
         for node in self.nodes:
-            node.set_pxe_interface("eth0")
+            node.set_pxe_interface("eth1")
 
             partitions = node.bmc.partitions
             ubootenv_partition = partitions[5]
@@ -333,6 +547,67 @@ class NodeTest(unittest.TestCase):
                     "ecme_timestamp"]:
                 self.assertTrue(hasattr(result, attr))
 
+    def test_transport_affinity(self):
+        """ Test that nodes remember which TFTP transport works """
+        for node in self.nodes:
+            # The dummy ECME's own TFTP server never works
+            link_map = node.bmc.fabric_info_get_link_map
+            node.get_linkmap()
+            self.assertEqual(link_map.call_count, 3)
+            node.get_linkmap()
+            self.assertEqual(link_map.call_count, 4)
+            node.get_boot_order()
+            self.assertEqual(node.bmc.register_firmware_read.call_count, 0)
+            self.assertEqual(node.bmc.partitions[5].retrieves, 1)
+
+            # Once the affinity expires, it's tried again
+            node.TRANSPORT_AFFINITY_TTL = -1
+            node.get_linkmap()
+            self.assertEqual(link_map.call_count, 5)
+            node.get_linkmap()
+            self.assertEqual(link_map.call_count, 8)
+
+    def test_race_transports(self):
+        """ Test racing both TFTP transports on reads """
+        for node in self.nodes:
+            node.RACE_TRANSPORTS = True
+            self.assertEqual(node.get_linkmap(), {1: 2, 3: 1, 4: 3})
+            self.assertEqual(node._get_transport(), "host")
+
+            # Once the working transport is known, there's no race
+            self.assertEqual(node.get_boot_order(), ["disk", "pxe"])
+            self.assertEqual(node.bmc.register_firmware_read.call_count, 0)
+
+    def test_race_loser_cleanup(self):
+        """ Test that the loser of a TFTP race throws its file away """
+        node = self.nodes[0]
+        started = Event()
+        finish = Event()
+        files = []
+
+        def ecme():
+            """ Slow transport that finishes after the race is over """
+            started.set()
+            finish.wait(10)
+            files.append(temp_file())
+            return files[-1]
+
+        def host():
+            """ Fast transport """
+            started.wait(10)
+            files.append(temp_file())
+            return files[-1]
+
+        self.assertEqual(node._race_transfer(ecme, host), files[0])
+        self.assertEqual(node._get_transport(), "host")
+        finish.set()
+        for _ in range(100):
+            if len(files) == 2 and not os.path.exists(files[1]):
+                break
+            time.sleep(0.05)
+        self.assertTrue(os.path.exists(files[0]))
+        self.assertFalse(os.path.exists(files[1]))
+
     def test_get_fabric_ipinfo(self):
         """ Test node.get_fabric_ipinfo method """
         for node in self.nodes:
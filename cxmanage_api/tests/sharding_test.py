@@ -0,0 +1,107 @@
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-public-methods
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+"""Unit tests for sharding node commands across processes."""
+
+import unittest
+
+from cxmanage_api import decorators
+from cxmanage_api.node import Node
+from cxmanage_api.sharding import run_sharded
+from cxmanage_api.tasks import gather
+from cxmanage_api.cx_exceptions import CommandFailedError, ShardError
+from cxmanage_api.tests import DummyNode, DummyFailNode, DummyBMC
+
+
+class ShardingTest(unittest.TestCase):
+    """ Tests for run_sharded """
+
+    def setUp(self):
+        self.nodes = [DummyNode(i) for i in DummyNode.ip_addresses]
+
+    def test_list(self):
+        """ Test that results come back in the same order as the nodes """
+        for node in self.nodes:
+            node.sel = [node.ip_address]
+        results = gather(run_sharded(self.nodes, "get_sel", processes=2),
+                         timeout=30)
+        self.assertEqual(results, [[x.ip_address] for x in self.nodes])
+
+        tasks = run_sharded(self.nodes, "bmc.get_chassis_status",
+                            processes=3)
+        self.assertEqual(len(gather(tasks, timeout=30)), len(self.nodes))
+
+    def test_dict(self):
+        """ Test that results are keyed like the nodes """
+        nodes = dict(enumerate(self.nodes))
+        results = gather(run_sharded(nodes, "get_power_policy",
+                                     processes=2), timeout=30)
+        self.assertEqual(results, dict((i, "always-off") for i in nodes))
+
+    def test_errors(self):
+        """ Test that errors come back, even ones that can't be pickled """
+        nodes = [DummyFailNode(i) for i in DummyNode.ip_addresses]
+        tasks = run_sharded(nodes, "get_power", processes=2)
+        try:
+            gather(tasks, timeout=30)
+            self.fail()
+        except CommandFailedError as err:
+            self.assertEqual(len(err.errors), len(nodes))
+            for error in err.errors.itervalues():
+                self.assertTrue(isinstance(error, ShardError))
+                self.assertTrue("DummyFailError" in str(error))
+
+        tasks = run_sharded(self.nodes, "no_such_method", processes=2)
+        results = gather(tasks, timeout=30, return_exceptions=True)
+        for result in results:
+            self.assertTrue(isinstance(result, AttributeError))
+
+    def test_locks_held_at_fork(self):
+        """ Test that locks held in this process don't hang the workers """
+        nodes = [Node(ip_address=x, bmc=DummyBMC, tftp=DummyBMC.tftp)
+                 for x in DummyBMC.ip_addresses]
+        # pylint: disable=W0212
+        locks = [decorators._COALESCE_LOCK] + [x._cache_lock for x in nodes]
+        for lock in locks:
+            lock.acquire()
+        try:
+            results = gather(run_sharded(nodes, "get_firmware_info_dict",
+                                         processes=2), timeout=30)
+        finally:
+            for lock in locks:
+                lock.release()
+        self.assertEqual(len(results), len(nodes))
+
+    def test_empty(self):
+        """ Test sharding an empty node list """
+        self.assertEqual(run_sharded([], "get_power"), [])
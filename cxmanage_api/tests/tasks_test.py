@@ -35,8 +35,13 @@
 
 import unittest
 import time
+from threading import Event
 
-from cxmanage_api.tasks import TaskQueue
+from cxmanage_api.tasks import TaskQueue, Task, TokenBucket, PRIORITY_HIGH, \
+        PRIORITY_LOW, check_cancelled, as_completed, wait, gather, \
+        FIRST_EXCEPTION, RollingHistogram, TaskGraph, AdaptiveLimit
+from cxmanage_api.cx_exceptions import CommandFailedError, \
+        TaskCancelledError, TimeoutError
 
 
 class TaskTest(unittest.TestCase):
@@ -69,6 +74,489 @@ class TaskTest(unittest.TestCase):
 
         self.assertGreaterEqual(finish - start, 2.0)
 
+    def test_persistent_workers(self):
+        """ Test that workers are reused between batches of tasks """
+        task_queue = TaskQueue(threads=4)
+        for _ in xrange(4):
+            tasks = [task_queue.put(time.sleep, 0.01) for _ in xrange(16)]
+            for task in tasks:
+                task.join()
+
+        self.assertLessEqual(len(task_queue._workers), 4)
+        workers = set(task_queue._workers)
+        task_queue.put(time.sleep, 0).join()
+        self.assertTrue(task_queue._workers <= workers)
+
+        task_queue.shutdown()
+        self.assertEqual(len(task_queue._workers), 0)
+        self.assertFalse(any(x.is_alive() for x in workers))
+
+    def test_idle_timeout(self):
+        """ Test that idle workers are retired """
+        task_queue = TaskQueue(threads=4, idle_timeout=0.1)
+        tasks = [task_queue.put(time.sleep, 0.05) for _ in xrange(8)]
+        for task in tasks:
+            task.join()
+
+        deadline = time.time() + 5
+        while task_queue._workers and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(task_queue._workers), 0)
+
+        # The pool should grow back when it's needed again
+        counter = Counter()
+        task_queue.put(counter.add, 1).join()
+        self.assertEqual(counter.value, 1)
+
+    def test_shutdown(self):
+        """ Test that shutdown drains the queue and refuses new tasks """
+        task_queue = TaskQueue(threads=1)
+        counter = Counter()
+        tasks = [task_queue.put(counter.add, 1) for _ in xrange(8)]
+        task_queue.shutdown()
+
+        self.assertFalse(any(x.is_alive() for x in tasks))
+        self.assertEqual(counter.value, 8)
+        with self.assertRaises(RuntimeError):
+            task_queue.put(counter.add, 1)
+
+    def test_priorities(self):
+        """ Test that higher priority tasks are dispatched first """
+        task_queue = TaskQueue(threads=1)
+        gate = Event()
+        task_queue.put(gate.wait)
+
+        order = []
+        tasks = [
+            task_queue.put_task(Task(order.append, "low"),
+                                priority=PRIORITY_LOW),
+            task_queue.put(order.append, "normal"),
+            task_queue.put_task(Task(order.append, "high"),
+                                priority=PRIORITY_HIGH)
+        ]
+        gate.set()
+        for task in tasks:
+            task.join()
+
+        self.assertEqual(order, ["high", "normal", "low"])
+
+    def test_fair_lanes(self):
+        """ Test weighted-fair scheduling across lanes """
+        task_queue = TaskQueue(threads=1)
+        gate = Event()
+        task_queue.put(gate.wait)
+
+        order = []
+        bulk = task_queue.lane("bulk")
+        light = task_queue.lane("light", weight=2)
+        tasks = [bulk.put(order.append, "bulk") for _ in xrange(12)]
+        tasks += [light.put(order.append, "light") for _ in xrange(4)]
+        self.assertEqual(bulk.depth, 12)
+        self.assertEqual(light.depth, 4)
+
+        gate.set()
+        for task in tasks:
+            task.join()
+
+        # The light lane should be done long before the bulk lane
+        self.assertEqual(order[:6].count("light"), 4)
+        self.assertEqual(bulk.depth, 0)
+        self.assertEqual(bulk.dispatched, 12)
+        self.assertGreater(bulk.max_wait, 0)
+        self.assertGreaterEqual(bulk.max_wait, bulk.average_wait)
+
+    def test_token_bucket(self):
+        """ Test the TokenBucket rate limiter """
+        bucket = TokenBucket(rate=10, burst=3)
+        for _ in xrange(3):
+            self.assertEqual(bucket.consume(), 0)
+        self.assertGreater(bucket.consume(), 0)
+        self.assertGreater(bucket.available(), 0)
+
+        time.sleep(0.15)
+        self.assertEqual(bucket.available(), 0)
+        self.assertEqual(bucket.consume(), 0)
+
+    def test_rate_limits(self):
+        """ Test per-node rate limiting in the task queue """
+        task_queue = TaskQueue(threads=8, rate_limits={"node": (20, 2)})
+        slow, fast = Counter(), Counter()
+
+        start = time.time()
+        tasks = [
+            task_queue.put_task(Task(slow.add, 1), rate_keys={"node": "a"})
+            for _ in xrange(6)
+        ]
+        tasks += [
+            task_queue.put_task(Task(fast.add, 1), rate_keys={"node": x})
+            for x in xrange(6)
+        ]
+
+        # Tasks for other nodes shouldn't wait behind the limited node
+        for task in tasks[6:]:
+            task.join()
+        self.assertEqual(fast.value, 6)
+        self.assertLess(time.time() - start, 0.15)
+
+        # 2 burst tokens, then 4 more at 20 per second
+        for task in tasks[:6]:
+            task.join()
+        self.assertEqual(slow.value, 6)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+    def test_cancel_queued(self):
+        """ Test cancelling a task before it starts """
+        task_queue = TaskQueue(threads=1)
+        gate = Event()
+        blocker = task_queue.put(gate.wait)
+        counter = Counter()
+        task = task_queue.put(counter.add, 1)
+
+        self.assertFalse(task.join(timeout=0.05))
+        self.assertTrue(task.cancel())
+        self.assertFalse(task.is_alive())
+        self.assertEqual(task.status, "Cancelled")
+        self.assertTrue(isinstance(task.error, TaskCancelledError))
+        self.assertEqual(task_queue.lanes["default"].depth, 0)
+
+        gate.set()
+        blocker.join()
+        task_queue.put(counter.add, 2).join()
+        self.assertEqual(counter.value, 2)
+        self.assertFalse(task.cancel())
+
+    def test_cancel_running(self):
+        """ Test cooperative cancellation of a running task """
+        task_queue = TaskQueue(threads=1)
+        started = Event()
+
+        def poll():
+            """ Poll until cancelled """
+            started.set()
+            while True:
+                check_cancelled()
+                time.sleep(0.01)
+
+        task = task_queue.put(poll)
+        started.wait()
+        self.assertFalse(task.cancel())
+        self.assertTrue(task.join(timeout=5))
+        self.assertEqual(task.status, "Cancelled")
+
+    def test_deadlines(self):
+        """ Test that tasks fail when they miss their deadline """
+        task_queue = TaskQueue(threads=1)
+        gate = Event()
+        running = task_queue.put_task(Task(gate.wait), timeout=0.1)
+        counter = Counter()
+        queued = task_queue.put_task(Task(counter.add, 1), timeout=0.2)
+
+        start = time.time()
+        self.assertTrue(running.join(timeout=5))
+        self.assertTrue(queued.join(timeout=5))
+        self.assertLess(time.time() - start, 1)
+
+        for task in [running, queued]:
+            self.assertEqual(task.status, "Failed")
+            self.assertTrue(isinstance(task.error, TimeoutError))
+
+        # The late result is discarded, and the queued task never runs
+        gate.set()
+        task_queue.put(counter.add, 2).join()
+        self.assertEqual(running.result, None)
+        self.assertEqual(counter.value, 2)
+
+    def test_future_methods(self):
+        """ Test the future-style accessors and done callbacks """
+        task_queue = TaskQueue(threads=1)
+        gate = Event()
+
+        def answer():
+            """ Wait for the gate, then return the answer """
+            gate.wait()
+            return 42
+
+        task = task_queue.put(answer)
+        finished = []
+        task.add_done_callback(finished.append)
+
+        self.assertFalse(task.done())
+        self.assertRaises(TimeoutError, task.get_result, 0.05)
+        gate.set()
+        self.assertEqual(task.get_result(timeout=5), 42)
+        self.assertEqual(task.get_error(), None)
+        self.assertTrue(task.done())
+        self.assertFalse(task.running())
+        self.assertFalse(task.cancelled())
+        self.assertEqual(finished, [task])
+
+        # Callbacks on a finished task run right away
+        task.add_done_callback(finished.append)
+        self.assertEqual(finished, [task, task])
+
+        failed = task_queue.put(int, "not a number")
+        self.assertRaises(ValueError, failed.get_result)
+        self.assertTrue(isinstance(failed.get_error(), ValueError))
+
+    def test_as_completed(self):
+        """ Test that as_completed yields tasks in the order they finish """
+        task_queue = TaskQueue()
+        gates = [Event() for _ in xrange(3)]
+        tasks = dict((i, task_queue.put(gates[i].wait)) for i in xrange(3))
+
+        order = []
+        for i in [2, 0, 1]:
+            gates[i].set()
+            tasks[i].join()
+        for key, task in as_completed(tasks, timeout=5):
+            self.assertTrue(tasks[key] is task)
+            order.append(key)
+        self.assertEqual(sorted(order), [0, 1, 2])
+
+        gate = Event()
+        slow = task_queue.put(gate.wait)
+        fast = task_queue.put(int, 1)
+        iterator = as_completed([slow, fast], timeout=0.2)
+        self.assertTrue(iterator.next() is fast)
+        self.assertRaises(TimeoutError, iterator.next)
+        gate.set()
+
+    def test_wait(self):
+        """ Test waiting for some of the tasks """
+        task_queue = TaskQueue()
+        gates = [Event() for _ in xrange(4)]
+        tasks = [task_queue.put(x.wait) for x in gates]
+
+        done, not_done = wait(tasks, timeout=0.05)
+        self.assertEqual((len(done), len(not_done)), (0, 4))
+
+        gates[1].set()
+        gates[3].set()
+        done, not_done = wait(tasks, timeout=5, num_tasks=2)
+        self.assertEqual(done, set([tasks[1], tasks[3]]))
+        self.assertEqual(not_done, set([tasks[0], tasks[2]]))
+
+        failed = task_queue.put(int, "not a number")
+        done, not_done = wait(tasks + [failed], timeout=5,
+                return_when=FIRST_EXCEPTION)
+        self.assertTrue(failed in done)
+        self.assertEqual(len(not_done), 2)
+
+        for gate in gates:
+            gate.set()
+        done, not_done = wait(dict(enumerate(tasks)))
+        self.assertEqual(sorted(done.keys()), [0, 1, 2, 3])
+        self.assertEqual(not_done, {})
+
+    def test_gather(self):
+        """ Test gathering results from a list or dictionary of tasks """
+        task_queue = TaskQueue()
+        tasks = [task_queue.put(int, x) for x in ["1", "2", "3"]]
+        self.assertEqual(gather(tasks), [1, 2, 3])
+
+        tasks = {"a": task_queue.put(int, "1"), "b": task_queue.put(int, "x")}
+        try:
+            gather(tasks)
+            self.fail()
+        except CommandFailedError as err:
+            self.assertEqual(err.results, {"a": 1})
+            self.assertTrue(isinstance(err.errors["b"], ValueError))
+
+        results = gather(tasks, return_exceptions=True)
+        self.assertEqual(results["a"], 1)
+        self.assertTrue(isinstance(results["b"], ValueError))
+
+    def test_stats(self):
+        """ Test task timestamps and queue statistics """
+        task_queue = TaskQueue(threads=2)
+        tasks = [task_queue.put(time.sleep, 0.05) for _ in xrange(4)]
+        for task in tasks:
+            task.join()
+            self.assertGreaterEqual(task.run_time, 0.04)
+            self.assertGreaterEqual(task.wait_time, 0)
+            self.assertTrue(task.enqueue_time <= task.start_time
+                            <= task.finish_time)
+        time.sleep(0.01)
+
+        stats = task_queue.get_stats()
+        self.assertEqual(stats["threads"], 2)
+        self.assertEqual(stats["workers"], 2)
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["wait_time"]["count"], 4)
+        self.assertEqual(stats["run_time"]["count"], 4)
+        self.assertGreaterEqual(stats["run_time"]["p50"], 0.04)
+        self.assertGreater(stats["wait_time"]["max"], 0.04)
+        self.assertGreater(stats["utilization"], 0.2)
+        self.assertLessEqual(stats["capacity"], stats["utilization"])
+        self.assertEqual(stats["lanes"]["default"]["dispatched"], 4)
+
+        task_queue.reset_stats()
+        stats = task_queue.get_stats()
+        self.assertEqual(stats["run_time"]["count"], 0)
+        self.assertEqual(stats["lanes"]["default"]["dispatched"], 0)
+
+    def test_rolling_histogram(self):
+        """ Test the rolling histogram """
+        histogram = RollingHistogram(window=4, bounds=(1, 10))
+        for value in [0.5, 2, 3, 20, 5]:
+            histogram.add(value)
+        self.assertEqual(len(histogram), 4)
+        self.assertEqual(histogram.total, 5)
+        self.assertEqual(histogram.percentile(0), 2)
+        self.assertEqual(histogram.percentile(100), 20)
+        self.assertEqual(histogram.buckets(), [(1, 0), (10, 3), (None, 1)])
+        self.assertEqual(histogram.summary()["mean"], 7.5)
+
+    def test_task_graph(self):
+        """ Test that chains move along independently """
+        task_queue = TaskQueue(threads=4)
+        graph = TaskGraph(task_queue)
+        gate = Event()
+        order = []
+
+        slow = graph.put(Task(gate.wait))
+        slow_next = graph.put(Task(order.append, "slow"), after=[slow])
+        fast = graph.put(Task(order.append, "fast 1"))
+        fast_next = graph.put(Task(order.append, "fast 2"), after=[fast])
+
+        self.assertTrue(fast_next.join(timeout=5))
+        self.assertEqual(order, ["fast 1", "fast 2"])
+        self.assertTrue(slow_next.is_alive())
+
+        gate.set()
+        self.assertTrue(graph.join(timeout=5))
+        self.assertEqual(order, ["fast 1", "fast 2", "slow"])
+
+    def test_task_graph_failures(self):
+        """ Test failure propagation and gates """
+        task_queue = TaskQueue(threads=4)
+        graph = TaskGraph(task_queue)
+        counter = Counter()
+
+        failed = graph.put(Task(int, "x"))
+        skipped = graph.put(Task(counter.add, 1), after=[failed])
+        forced = graph.put(Task(counter.add, 2), after=[failed],
+                           require_success=False)
+        self.assertTrue(graph.join(timeout=5))
+        self.assertEqual(skipped.status, "Failed")
+        self.assertTrue(skipped.error is failed.error)
+        self.assertEqual(forced.status, "Completed")
+        self.assertEqual(counter.value, 2)
+
+        checks = [graph.put(Task(int, x)) for x in ["1", "2"]]
+        gate = graph.gate(checks)
+        after = graph.put(Task(counter.add, 4), after=[gate])
+        self.assertEqual(gate.get_result(timeout=5), [1, 2])
+        after.join()
+        self.assertEqual(counter.value, 6)
+
+        checks = [graph.put(Task(int, x)) for x in ["1", "x"]]
+        gate = graph.gate(checks, "Aborted")
+        after = graph.put(Task(counter.add, 8), after=[gate])
+        self.assertTrue(after.join(timeout=5))
+        self.assertEqual(after.status, "Cancelled")
+        self.assertEqual(str(after.error), "Aborted")
+        self.assertEqual(counter.value, 6)
+
+    def test_task_graph_cancel(self):
+        """ Test cancelling every task in a graph """
+        task_queue = TaskQueue(threads=1)
+        graph = TaskGraph(task_queue)
+        gate = Event()
+        first = graph.put(Task(gate.wait))
+        second = graph.put(Task(int, "1"), after=[first])
+        graph.cancel()
+        gate.set()
+        self.assertTrue(graph.join(timeout=5))
+        self.assertEqual(second.status, "Cancelled")
+
+    def test_adaptive_limit(self):
+        """ Test additive increase and multiplicative decrease """
+        limit = AdaptiveLimit(initial=2, maximum=4, decrease=0.5,
+                              congestion_errors=(TimeoutError,))
+        ok, timed_out, failed = Task(int), Task(int), Task(int)
+        ok.status, timed_out.status, failed.status = (["Completed"] +
+                                                      ["Failed"] * 2)
+        timed_out.error, failed.error = TimeoutError("slow"), ValueError()
+
+        # Grows by about one per limit's worth of saturated successes
+        for _ in xrange(3):
+            tokens = [limit.acquire() for _ in xrange(int(limit.limit))]
+            self.assertFalse(limit.available())
+            for token in tokens:
+                limit.release(token, ok, 0.1)
+        self.assertEqual(int(limit.limit), 3)
+        self.assertEqual(limit.increases, 1)
+
+        # Doesn't grow when the limit isn't what's holding things back
+        limit.release(limit.acquire(), ok, 0.1)
+        self.assertEqual(int(limit.limit), 3)
+
+        # Non-congestion failures leave the limit alone
+        limit.release(limit.acquire(), failed, 0.1)
+        self.assertEqual(int(limit.limit), 3)
+
+        # Timeouts from one round of tasks only cut the limit once
+        tokens = [limit.acquire() for _ in xrange(3)]
+        for token in tokens:
+            limit.release(token, timed_out, 0.1)
+        self.assertEqual(int(limit.limit), 1)
+        self.assertEqual(limit.decreases, 1)
+        self.assertEqual(limit.in_flight, 0)
+
+        # Slow tasks count as congestion too
+        limit = AdaptiveLimit(initial=4, max_latency=1)
+        limit.release(limit.acquire(), ok, 2)
+        self.assertEqual(limit.limit, 2)
+
+    def test_adaptive_concurrency(self):
+        """ Test that the task queue follows its concurrency limits """
+        task_queue = TaskQueue(threads=8, concurrency={
+            "global": {"initial": 2, "maximum": 2},
+            "node": {"initial": 1, "maximum": 1}
+        })
+        lock = Event()
+        counter = Counter()
+        peak = Counter()
+
+        def work(amount):
+            """ Track the number of tasks running at once """
+            counter.add(1)
+            peak.value = max(peak.value, counter.value)
+            lock.wait(0.05)
+            counter.add(-1)
+            return amount
+
+        tasks = [task_queue.put_task(Task(work, x), rate_keys={"node": x % 2})
+                 for x in xrange(8)]
+        self.assertEqual(gather(tasks), range(8))
+        self.assertLessEqual(peak.value, 2)
+        self.assertLessEqual(task_queue.get_stats()["workers"], 2)
+        time.sleep(0.05)
+
+        stats = task_queue.get_stats()["concurrency"]
+        self.assertEqual(stats["global"]["limit"], 2)
+        self.assertEqual(stats["node 0"]["limit"], 1)
+        self.assertEqual(stats["node 1"]["in_flight"], 0)
+
+    def test_get(self):
+        """ Test that tasks taken with get() give their slots back """
+        task_queue = TaskQueue(threads=0, concurrency={
+            "node": {"initial": 1, "maximum": 1}
+        })
+        tasks = [task_queue.put_task(Task(lambda: 1), rate_keys={"node": 0})
+                 for _ in xrange(2)]
+        task = task_queue.get()
+        self.assertEqual(task_queue.get_stats()["in_flight"], 1)
+        self.assertRaises(IndexError, task_queue.get)  # Node limit is full
+
+        task._run()  # pylint: disable=W0212
+        stats = task_queue.get_stats()
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["run_time"]["count"], 1)
+        self.assertEqual(stats["concurrency"]["node 0"]["in_flight"], 0)
+        self.assertTrue(task_queue.get() is tasks[1])
+
 
 class Counter(object):
     """ Simple counter object for testing purposes """
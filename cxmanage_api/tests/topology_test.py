@@ -0,0 +1,152 @@
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-public-methods
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+"""Unit tests for the fabric topology model."""
+
+import unittest
+
+from cxmanage_api import topology
+from cxmanage_api.fabric import Fabric
+from cxmanage_api.topology import FabricTopology, UNREACHABLE
+from cxmanage_api.tests import DummyNode
+
+
+# Node 0 is linked to everything, nodes 2 and 3 are also linked to each other
+LINKMAP = {
+    0: {1: 1, 2: 2, 3: 3},
+    1: {0: 0},
+    2: {0: 0, 4: 3},
+    3: {0: 0, 4: 2}
+}
+
+ROUTING_TABLE = {
+    0: {1: [0, 3, 0, 0, 0], 2: [0, 0, 3, 0, 0], 3: [0, 0, 0, 3, 0]},
+    1: {0: [3, 0, 0, 0, 0], 2: [3, 0, 0, 0, 0], 3: [0, 0, 0, 0, 0]},
+    2: {0: [3, 0, 0, 0, 2], 1: [3, 0, 0, 0, 0], 3: [2, 0, 0, 0, 3]},
+    3: {0: [3, 0, 0, 0, 2], 1: [3, 0, 0, 0, 0], 2: [2, 0, 0, 0, 3]}
+}
+
+DEPTH_CHART = {
+    2: {3: {"shortest": (3, 0)}},
+    3: {2: {"shortest": (0, 1)}}
+}
+
+
+@unittest.skipIf(topology.numpy is None, "numpy is not installed")
+class FabricTopologyTest(unittest.TestCase):
+    """ Tests for FabricTopology """
+
+    def setUp(self):
+        self.topology = FabricTopology(LINKMAP, ROUTING_TABLE, DEPTH_CHART)
+
+    def test_hop_counts(self):
+        """ Test hop counts and diameter """
+        self.assertEqual(self.topology.hop_counts().tolist(), [
+            [0, 1, 1, 1],
+            [1, 0, 2, 2],
+            [1, 2, 0, 1],
+            [1, 2, 1, 0]
+        ])
+        self.assertEqual(self.topology.hop_count(1, 3), 2)
+        self.assertEqual(self.topology.diameter(), 2)
+        self.assertTrue(self.topology.is_connected())
+        self.assertEqual(self.topology.reachable(1), [0, 2, 3])
+        self.assertEqual(self.topology.unreachable_pairs(), [])
+
+    def test_disconnected(self):
+        """ Test a fabric that's split in two """
+        topo = FabricTopology({0: {1: 1}, 1: {0: 0}, 2: {3: 3}, 3: {2: 2}})
+        self.assertEqual(topo.hop_counts()[0, 2], UNREACHABLE)
+        self.assertEqual(topo.hop_count(0, 3), None)
+        self.assertEqual(topo.diameter(), None)
+        self.assertFalse(topo.is_connected())
+        self.assertEqual(topo.reachable(2), [3])
+        self.assertEqual(
+            topo.unreachable_pairs(),
+            [(0, 2), (0, 3), (1, 2), (1, 3), (2, 0), (2, 1), (3, 0), (3, 1)]
+        )
+        self.assertEqual(topo.single_points_of_failure(), [])
+
+    def test_links(self):
+        """ Test link checks """
+        self.assertEqual(self.topology.asymmetric_links(), [])
+        topo = FabricTopology({0: {1: 1}, 1: {}})
+        self.assertEqual(topo.asymmetric_links(), [(0, 1)])
+        self.assertEqual(topo.reachable(1), [])
+
+    def test_routes(self):
+        """ Test routing table and depth chart checks """
+        self.assertEqual(self.topology.missing_routes(), [(1, 3)])
+        self.assertEqual(self.topology.asymmetric_routes(), [(1, 3), (2, 3)])
+        self.assertEqual(self.topology.next_hops(2, 3), [3, 0])
+        self.assertEqual(self.topology.next_hops(1, 3), [])
+
+        topo = FabricTopology(LINKMAP)
+        self.assertRaises(ValueError, topo.missing_routes)
+        self.assertRaises(ValueError, topo.asymmetric_routes)
+        self.assertRaises(ValueError, topo.next_hops, 0, 1)
+
+    def test_single_points_of_failure(self):
+        """ Test finding single points of failure """
+        self.assertEqual(self.topology.single_points_of_failure(), [0])
+
+        # A chain: every node in the middle holds it together
+        chain = dict((x, {}) for x in range(6))
+        for x in range(5):
+            chain[x][1] = x + 1
+            chain[x + 1][0] = x
+        topo = FabricTopology(chain)
+        self.assertEqual(topo.single_points_of_failure(), [1, 2, 3, 4])
+        self.assertEqual(topo.diameter(), 5)
+
+        # Closing it into a ring removes them all
+        chain[0][2] = 5
+        chain[5][2] = 0
+        self.assertEqual(
+            FabricTopology(chain).single_points_of_failure(), []
+        )
+
+    def test_fabric_get_topology(self):
+        """ Test building a topology from a fabric """
+        fabric = Fabric(DummyNode.ip_addresses[0], node=DummyNode)
+        fabric._nodes = dict((i, DummyNode(x))
+                             for i, x in enumerate(DummyNode.ip_addresses))
+        for node_id, node in fabric.nodes.iteritems():
+            node.get_linkmap = lambda n=node_id: LINKMAP[n]
+            node.get_routing_table = lambda n=node_id: ROUTING_TABLE[n]
+            node.get_depth_chart = lambda n=node_id: DEPTH_CHART.get(n, {})
+
+        topo = fabric.get_topology()
+        self.assertEqual(topo.node_ids.tolist(), [0, 1, 2, 3])
+        self.assertEqual(topo.diameter(), 2)
+        self.assertEqual(topo.missing_routes(), [(1, 3)])
@@ -0,0 +1,392 @@
+"""Calxeda: topology.py"""
+
+
+# Copyright (c) 2012-2013, Calxeda Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# * Neither the name of Calxeda Inc. nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+# pylint: disable=E1101
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Hop count for pairs of nodes that can't reach each other
+UNREACHABLE = -1
+
+
+class FabricTopology(object):
+    """A model of a fabric's links, routes and depth chart, built from the
+    results of get_linkmap, get_routing_table and get_depth_chart. The data
+    is held in NumPy arrays indexed by node position, so queries over the
+    whole fabric are done with array operations rather than per-node dict
+    walks.
+
+    NumPy is an optional dependency: pip install cxmanage[topology]
+
+    >>> topology = fabric.get_topology()
+    >>> topology.diameter()
+    3
+    >>> topology.single_points_of_failure()
+    [0]
+
+    :param linkmap: Linkmap for each node, as returned by Fabric.get_linkmap.
+    :type linkmap: dictionary
+    :param routing_table: Routing table for each node, as returned by
+                          Fabric.get_routing_table.
+    :type routing_table: dictionary
+    :param depth_chart: Depth chart for each node, as returned by
+                        Fabric.get_depth_chart.
+    :type depth_chart: dictionary
+
+    :raises ImportError: If NumPy is not installed.
+
+    """
+
+    def __init__(self, linkmap, routing_table=None, depth_chart=None):
+        if numpy is None:
+            raise ImportError(
+                "FabricTopology requires numpy "
+                "(pip install cxmanage[topology])"
+            )
+
+        node_ids = set(linkmap)
+        for links in linkmap.itervalues():
+            node_ids.update(links.itervalues())
+        for table in (routing_table or {}, depth_chart or {}):
+            for node_id, entries in table.iteritems():
+                node_ids.add(node_id)
+                node_ids.update(entries)
+
+        self.node_ids = numpy.array(sorted(node_ids), dtype=int)
+        self._index = dict((x, i) for i, x in enumerate(sorted(node_ids)))
+        size = len(self.node_ids)
+
+        # links[a, b] is the link on node a that connects to node b, or -1
+        self.links = numpy.full((size, size), -1, dtype=numpy.int8)
+        for node_id, links in linkmap.iteritems():
+            for link, neighbor in links.iteritems():
+                if neighbor != node_id:
+                    self.links[self._index[node_id],
+                               self._index[neighbor]] = link
+        self.adjacency = self.links >= 0
+
+        # routes[a, b] is True if node a has a route to node b
+        self.routing_table = routing_table
+        self.routes = None
+        self._has_routes = numpy.zeros(size, dtype=bool)
+        if routing_table is not None:
+            self.routes = numpy.zeros((size, size), dtype=bool)
+            for node_id, entries in routing_table.iteritems():
+                row = self._index[node_id]
+                self._has_routes[row] = True
+                targets = [self._index[x] for x, y in entries.iteritems()
+                           if any(y)]
+                self.routes[row, targets] = True
+
+        # depths[a, b] is the shortest hop count from a to b reported by a's
+        # depth chart, or -1
+        self.depths = None
+        if depth_chart is not None:
+            self.depths = numpy.full((size, size), UNREACHABLE,
+                                     dtype=numpy.int32)
+            for node_id, entries in depth_chart.iteritems():
+                row = self._index[node_id]
+                for target, entry in entries.iteritems():
+                    self.depths[row, self._index[target]] = (
+                        entry["shortest"][1]
+                    )
+
+        self._hop_counts = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def hop_counts(self):
+        """Get the number of hops between every pair of nodes, following the
+        links in the linkmap.
+
+        >>> topology.hop_counts()
+        array([[ 0,  1,  1,  1],
+               [ 1,  0,  2,  2],
+               [ 1,  2,  0,  1],
+               [ 1,  2,  1,  0]], dtype=int32)
+
+        :return: Hop counts, indexed by position in node_ids. Pairs that
+                 can't reach each other are UNREACHABLE (-1).
+        :rtype: numpy.ndarray
+
+        """
+        if self._hop_counts is None:
+            self._hop_counts = self._distances(
+                self.adjacency, numpy.arange(len(self))
+            )
+        return self._hop_counts
+
+    def hop_count(self, source, target):
+        """Get the number of hops from one node to another.
+
+        >>> topology.hop_count(1, 3)
+        2
+
+        :param source: Source node ID.
+        :type source: integer
+        :param target: Target node ID.
+        :type target: integer
+
+        :return: Number of hops, or None if target can't be reached.
+        :rtype: integer
+
+        """
+        hops = self.hop_counts()[self._index[source], self._index[target]]
+        if hops == UNREACHABLE:
+            return None
+        return int(hops)
+
+    def diameter(self):
+        """Get the fabric diameter, i.e. the longest shortest path between
+        any two nodes.
+
+        >>> topology.diameter()
+        2
+
+        :return: The diameter, or None if some nodes can't reach others.
+        :rtype: integer
+
+        """
+        hops = self.hop_counts()
+        if (hops == UNREACHABLE).any():
+            return None
+        return int(hops.max()) if len(self) else 0
+
+    def is_connected(self):
+        """Check that every node can reach every other node.
+
+        :rtype: boolean
+
+        """
+        return not (self.hop_counts() == UNREACHABLE).any()
+
+    def reachable(self, node_id):
+        """Get the nodes that a node can reach over the fabric.
+
+        >>> topology.reachable(1)
+        [0, 2, 3]
+
+        :param node_id: Source node ID.
+        :type node_id: integer
+
+        :rtype: list
+
+        """
+        hops = self.hop_counts()[self._index[node_id]]
+        return self._ids(numpy.nonzero(hops > 0)[0])
+
+    def unreachable_pairs(self):
+        """Get every (source, target) pair where the source can't reach the
+        target over the fabric.
+
+        :rtype: list
+
+        """
+        return self._pairs(self.hop_counts() == UNREACHABLE)
+
+    def asymmetric_links(self):
+        """Get every (node, neighbor) pair where the node has a link to the
+        neighbor, but the neighbor has no link back.
+
+        :rtype: list
+
+        """
+        return self._pairs(self.adjacency & ~self.adjacency.T)
+
+    def missing_routes(self):
+        """Get every (source, target) pair where the source reported a
+        routing table, but has no route to the target.
+
+        >>> topology.missing_routes()
+        [(1, 3)]
+
+        :rtype: list
+
+        :raises ValueError: If there is no routing table.
+
+        """
+        if self.routes is None:
+            raise ValueError("No routing table in this topology")
+        missing = ~self.routes & self._has_routes[:, numpy.newaxis]
+        numpy.fill_diagonal(missing, False)
+        return self._pairs(missing)
+
+    def asymmetric_routes(self):
+        """Get every (a, b) pair, with a < b, where the routes between the
+        two nodes differ by direction: one way has a route and the other
+        doesn't, or the depth charts disagree on the hop count.
+
+        :rtype: list
+
+        :raises ValueError: If there is no routing table or depth chart.
+
+        """
+        if self.routes is None and self.depths is None:
+            raise ValueError("No routing table or depth chart in this "
+                             "topology")
+
+        asymmetric = numpy.zeros(self.adjacency.shape, dtype=bool)
+        if self.routes is not None:
+            both = (self._has_routes[:, numpy.newaxis] &
+                    self._has_routes[numpy.newaxis, :])
+            asymmetric |= both & (self.routes != self.routes.T)
+        if self.depths is not None:
+            known = (self.depths != UNREACHABLE) & \
+                    (self.depths.T != UNREACHABLE)
+            asymmetric |= known & (self.depths != self.depths.T)
+        return self._pairs(numpy.triu(asymmetric, 1))
+
+    def single_points_of_failure(self):
+        """Get the nodes whose failure would cut other nodes off from each
+        other. Links are treated as usable in both directions.
+
+        >>> topology.single_points_of_failure()
+        [0]
+
+        :rtype: list
+
+        """
+        adjacency = self.adjacency | self.adjacency.T
+        candidates = numpy.nonzero(adjacency.sum(axis=1) > 1)[0]
+        if not len(candidates):
+            return []
+
+        # Start a search from a neighbor of each candidate, with and without
+        # the candidate in the fabric. If it reaches fewer nodes without it,
+        # the candidate was holding part of the fabric together.
+        starts = adjacency[candidates].argmax(axis=1)
+        before = self._distances(adjacency, starts) != UNREACHABLE
+        after = self._distances(adjacency, starts,
+                                excluded=candidates) != UNREACHABLE
+        lost = before.sum(axis=1) - 1 > after.sum(axis=1)
+        return self._ids(candidates[lost])
+
+    def next_hops(self, source, target):
+        """Get the neighbors that a node routes through to reach a target,
+        best route first.
+
+        >>> topology.next_hops(1, 3)
+        [0]
+
+        :param source: Source node ID.
+        :type source: integer
+        :param target: Target node ID.
+        :type target: integer
+
+        :rtype: list
+
+        :raises ValueError: If there is no routing table.
+
+        """
+        if self.routing_table is None:
+            raise ValueError("No routing table in this topology")
+
+        entries = self.routing_table.get(source, {}).get(target, [])
+        neighbors = dict(
+            (int(self.links[self._index[source], x]), int(self.node_ids[x]))
+            for x in numpy.nonzero(self.adjacency[self._index[source]])[0]
+        )
+        links = sorted((x for x in range(len(entries)) if entries[x]),
+                       key=lambda x: -entries[x])
+        return [neighbors[x] for x in links if x in neighbors]
+
+    ############################ Private methods ############################
+
+    def _ids(self, indices):
+        """Convert an array of node positions to a list of node IDs."""
+        return [int(x) for x in self.node_ids[indices]]
+
+    def _pairs(self, mask):
+        """Convert a boolean matrix to a list of (node ID, node ID) pairs."""
+        rows, columns = numpy.nonzero(mask)
+        return zip(self._ids(rows), self._ids(columns))
+
+    def _distances(self, adjacency, starts, excluded=None):
+        """Breadth-first search from several start nodes at once.
+
+        The searches are bit-packed: row v of the frontier holds one bit per
+        search, set if that search reached node v in the last step. A node
+        joins the frontier if any of its predecessors is in it, which is a
+        gather of rows over a fixed-width predecessor table, OR'd together.
+        Row len(self) is a sentinel that is never reached, used to pad the
+        table. Hop counts are the number of steps a node stays unvisited.
+
+        If excluded is given, search i treats node excluded[i] as missing
+        from the fabric.
+
+        """
+        size = len(self)
+        count = len(starts)
+        searches = numpy.arange(count)
+
+        # predecessors[b] lists the nodes with a link to b
+        counts = adjacency.sum(axis=0)
+        width = max(int(counts.max()) if size else 0, 1)
+        targets, sources = numpy.nonzero(adjacency.T)
+        offsets = numpy.cumsum(counts) - counts
+        predecessors = numpy.full((size, width), size, dtype=int)
+        predecessors[targets, numpy.arange(len(targets)) -
+                     offsets[targets]] = sources
+
+        frontier = numpy.zeros((size + 1, count), dtype=bool)
+        frontier[starts, searches] = True
+        blocked = numpy.zeros((size + 1, count), dtype=bool)
+        blocked[size] = True
+        if excluded is not None:
+            blocked[excluded, searches] = True
+        frontier = numpy.packbits(frontier, axis=1)
+        seen = frontier.copy()
+        visited = frontier | numpy.packbits(blocked, axis=1)
+
+        distances = numpy.zeros((size, count), dtype=numpy.int32)
+        while frontier.any():
+            distances += numpy.unpackbits(~visited[:size], axis=1)[:, :count]
+            reached = numpy.zeros_like(frontier)
+            for column in predecessors.T:
+                reached[:size] |= frontier[column]
+            reached &= ~visited
+            visited |= reached
+            seen |= reached
+            frontier = reached
+
+        seen = numpy.unpackbits(seen[:size], axis=1)[:, :count]
+        distances[seen == 0] = UNREACHABLE
+        return distances.T
+
+
+# End of file: ./topology.py
@@ -76,6 +76,7 @@ setup(
     ],
     extras_require={
         'docs': ['sphinx', 'cloud_sptheme'],
+        'topology': ['numpy'],
     },
     classifiers=[
         'License :: OSI Approved :: BSD License',